@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+"""Fake OAuth 1.0a and 2.0 provider for benchmarks.
+
+FakeProvider answers token and user profile requests of every provider
+configured in a handler's PROVIDERS. It can be used in-process with
+FakeProviderTransport, or served over HTTP with FakeProviderServer and
+reached through RoutingTransport.
+"""
+import BaseHTTPServer
+import SocketServer
+import json
+import threading
+import time
+import urlparse
+
+from simpleauth import Transport, PooledTransport, Response
+
+
+# Profile responses keyed by host + path prefix of user info endpoints.
+PROFILES = {
+  'www.googleapis.com/userinfo/v2/me': json.dumps({
+    'id': '1234567890', 'email': 'bench@example.org',
+    'verified_email': True, 'name': 'Bench User', 'given_name': 'Bench',
+    'family_name': 'User', 'link': 'https://plus.google.com/1234567890',
+    'picture': 'https://example.org/photo.jpg', 'locale': 'en'}),
+  'www.googleapis.com/plus/v1/people/me': json.dumps({
+    'kind': 'plus#person', 'id': '1234567890',
+    'displayName': 'Bench User', 'url': 'https://plus.google.com/1234567890',
+    'image': {'url': 'https://example.org/photo.jpg'},
+    'emails': [{'value': 'bench@example.org', 'type': 'account'}]}),
+  'apis.live.net/v5.0/me': json.dumps({
+    'id': '8c8ce076ca27823f', 'name': 'Bench User',
+    'first_name': 'Bench', 'last_name': 'User',
+    'link': 'https://profile.live.com/', 'locale': 'en_US'}),
+  'graph.facebook.com/me': json.dumps({
+    'id': '100001234567890', 'name': 'Bench User',
+    'first_name': 'Bench', 'last_name': 'User',
+    'link': 'https://www.facebook.com/bench', 'locale': 'en_US'}),
+  'api.foursquare.com/v2/users/self': json.dumps({
+    'meta': {'code': 200},
+    'response': {'user': {
+      'id': '1234567', 'firstName': 'Bench', 'lastName': 'User',
+      'photo': {'prefix': 'https://example.org/', 'suffix': '/photo.jpg'},
+      'contact': {'email': 'bench@example.org'}}}}),
+  'api.linkedin.com/v1/people/': (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    '<person>\n'
+    '  <id>AbCdEfGhIj</id>\n'
+    '  <first-name>Bench</first-name>\n'
+    '  <last-name>User</last-name>\n'
+    '  <picture-url>https://example.org/photo.jpg</picture-url>\n'
+    '  <public-profile-url>https://www.linkedin.com/in/bench'
+    '</public-profile-url>\n'
+    '  <headline>Benchmarks things</headline>\n'
+    '</person>\n'),
+  'api.twitter.com/1.1/account/verify_credentials.json': json.dumps({
+    'id': 123456789, 'id_str': '123456789', 'name': 'Bench User',
+    'screen_name': 'bench', 'location': 'Internet',
+    'profile_image_url_https': 'https://example.org/photo.jpg'}),
+}
+
+# Served for user info endpoints not in PROFILES
+DEFAULT_PROFILE = json.dumps({'id': '1', 'name': 'Bench User'})
+
+OAUTH1_REQUEST_TOKEN = ('oauth_token=bench-request-token&'
+                        'oauth_token_secret=bench-request-secret&'
+                        'oauth_callback_confirmed=true')
+OAUTH1_ACCESS_TOKEN = ('oauth_token=bench-access-token&'
+                       'oauth_token_secret=bench-access-secret&'
+                       'user_id=123456789&screen_name=bench')
+OAUTH2_ACCESS_TOKEN = {'access_token': 'bench-access-token',
+                       'token_type': 'Bearer', 'expires_in': 3600}
+
+
+class FakeProvider(object):
+  """Answers requests to token and user info endpoints of all providers
+  configured in handler_class.PROVIDERS.
+  """
+
+  def __init__(self, handler_class, latency=0):
+    """
+    Args:
+      handler_class: SimpleAuthHandler subclass.
+      latency: float, seconds every response is delayed by.
+    """
+    self.latency = latency
+    self._tokens = {}
+    for name, config in handler_class.PROVIDERS.items():
+      auth_type = config[0]
+      if auth_type == 'oauth1':
+        self._tokens[_endpoint(config[1]['request'])] = OAUTH1_REQUEST_TOKEN
+        self._tokens[_endpoint(config[2])] = OAUTH1_ACCESS_TOKEN
+      elif auth_type == 'oauth2':
+        parser = handler_class.TOKEN_RESPONSE_PARSERS.get(name)
+        if parser == '_query_string_parser':
+          content = '&'.join('%s=%s' % i for i in OAUTH2_ACCESS_TOKEN.items())
+        else:
+          content = json.dumps(OAUTH2_ACCESS_TOKEN)
+        self._tokens[_endpoint(config[2])] = content
+
+  def respond(self, method, url):
+    """Returns (status_code, content) of a request."""
+    if self.latency:
+      time.sleep(self.latency)
+    endpoint = _endpoint(url)
+    if endpoint in self._tokens:
+      return 200, self._tokens[endpoint]
+    for prefix, content in PROFILES.items():
+      if endpoint.startswith(prefix):
+        return 200, content
+    return 200, DEFAULT_PROFILE
+
+
+class FakeProviderTransport(Transport):
+  """Answers requests in-process, without any I/O."""
+
+  def __init__(self, provider):
+    super(FakeProviderTransport, self).__init__()
+    self.provider = provider
+
+  def fetch(self, url, payload=None, method='GET', headers=None,
+            deadline=None):
+    # answered right away, so there's no deadline to miss
+    status_code, content = self.provider.respond(method, url)
+    return Response(status_code, content)
+
+
+class RoutingTransport(PooledTransport):
+  """Sends requests for all provider hosts to a FakeProviderServer.
+
+  https://api.twitter.com/oauth/request_token becomes
+  http://<server>/api.twitter.com/oauth/request_token
+  """
+
+  def __init__(self, server_address, **kwargs):
+    super(RoutingTransport, self).__init__(**kwargs)
+    self.base_url = 'http://%s:%d/' % server_address
+
+  def fetch(self, url, payload=None, method='GET', headers=None,
+            deadline=None):
+    url = self.base_url + url.split('://', 1)[1]
+    return super(RoutingTransport, self).fetch(url, payload, method, headers,
+                                               deadline=deadline)
+
+
+class FakeProviderServer(SocketServer.ThreadingMixIn,
+                         BaseHTTPServer.HTTPServer):
+  """Local HTTP/1.1 server in front of a FakeProvider."""
+
+  daemon_threads = True
+
+  def __init__(self, provider, address=('127.0.0.1', 0)):
+    BaseHTTPServer.HTTPServer.__init__(self, address, _RequestHandler)
+    self.provider = provider
+
+  def start(self):
+    thread = threading.Thread(target=self.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+  def stop(self):
+    self.shutdown()
+    self.server_close()
+
+
+class _RequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+  protocol_version = 'HTTP/1.1'
+  # send a response in one write, otherwise Nagle's algorithm and delayed
+  # ACKs add ~40ms to every request on a keep-alive connection
+  wbufsize = -1
+  disable_nagle_algorithm = True
+
+  def do_GET(self):
+    self._respond()
+
+  def do_POST(self):
+    self.rfile.read(int(self.headers.get('content-length') or 0))
+    self._respond()
+
+  def _respond(self):
+    status_code, content = self.server.provider.respond(
+        self.command, 'http:/' + self.path)
+    self.send_response(status_code)
+    self.send_header('Content-Length', str(len(content)))
+    self.end_headers()
+    self.wfile.write(content)
+
+  def log_message(self, *args):
+    pass
+
+
+def _endpoint(url):
+  """Returns host + path of a URL or a URL template."""
+  parts = urlparse.urlsplit(url)
+  return parts.netloc + parts.path
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+"""Benchmarks import time of the simpleauth package.
+
+Each run imports simpleauth in a fresh interpreter and reports how long
+the import took and how many modules it loaded. Modules which should
+only be loaded on first use, e.g. by OAuth 1.0 or OpenID logins, are
+listed if the import pulls them in, and the exit status is then 1.
+
+Usage:
+
+  PYTHONPATH=.:./example/lib:$GAE_SDK python bench/import_bench.py [-n 20]
+"""
+import optparse
+import os
+import subprocess
+import sys
+
+# Loaded on first use of OAuth 1.0, OpenID, XML user info, PooledTransport,
+# memcache or datastore backed caches or tasklets only. ssl isn't listed:
+# urllib imports it.
+LAZY_MODULES = [
+  'oauth2',
+  'httplib2',
+  'httplib',
+  'lxml',
+  'xml.etree.ElementTree',
+  'google.appengine.api.users',
+  'google.appengine.api.urlfetch',
+  'google.appengine.api.memcache',
+  'google.appengine.ext.ndb',
+  'webapp2_extras.security',
+]
+
+# Runs in a fresh interpreter. sys.path is set up the same way as in
+# tests/__init__.py.
+SCRIPT = """
+import sys, time
+from dev_appserver import fix_sys_path
+saved_path = [p for p in sys.path]
+fix_sys_path()
+sys.path.extend(saved_path)
+before = set(m for m in sys.modules if sys.modules[m] is not None)
+start = time.time()
+import simpleauth
+duration = time.time() - start
+loaded = set(m for m in sys.modules if sys.modules[m] is not None) - before
+print duration
+print ' '.join(sorted(loaded))
+"""
+
+
+def import_once():
+  """Returns (seconds, set of module names) of a single import."""
+  out = subprocess.check_output([sys.executable, '-c', SCRIPT],
+                                env=os.environ)
+  duration, modules = out.splitlines()[-2:]
+  return float(duration), set(modules.split())
+
+
+def main(argv):
+  parser = optparse.OptionParser(usage='%prog [options]')
+  parser.add_option('-n', '--runs', type='int', default=20,
+                    help='fresh interpreters to import in [%default]')
+  opts, _ = parser.parse_args(argv)
+
+  durations = []
+  for _ in xrange(opts.runs):
+    duration, modules = import_once()
+    durations.append(duration)
+  durations.sort()
+
+  print 'import simpleauth, %d runs' % opts.runs
+  print 'min: %.1f ms, median: %.1f ms, modules loaded: %d' % (
+    durations[0] * 1000, durations[len(durations) // 2] * 1000, len(modules))
+
+  eager = [m for m in LAZY_MODULES if m in modules]
+  if eager:
+    print 'loaded on import, should be lazy: %s' % ', '.join(eager)
+    return 1
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main(sys.argv[1:]))
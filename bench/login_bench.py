@@ -0,0 +1,247 @@
+# -*- coding: utf-8 -*-
+"""Benchmarks the full login path, init to callback, of every provider.
+
+Each login is two requests through a webapp2 app: /auth/<provider> and
+/auth/<provider>/callback, with all provider calls answered by a fake
+provider. Reported per provider:
+
+  logins/s   sequential logins per second
+  p50, p99   latency of a whole login, ms
+  init       p50 of the init request, ms
+  callback   p50 of the callback request, ms
+  fetch      p50 of time spent waiting for the provider per login, ms
+  objs       gc-tracked objects left behind per login (leak check)
+
+Usage:
+
+  make bench FLAGS="-n 500 --latency 20 --http"
+
+Without --http provider calls never leave the process, which measures
+the handler's own overhead. With --http they go over keep-alive
+connections to a local server through PooledTransport.
+"""
+import gc
+import logging
+import optparse
+import resource
+import sys
+import time
+import urlparse
+
+from urllib import urlencode
+
+# Same as tests/__init__.py
+from dev_appserver import fix_sys_path
+saved_path = [p for p in sys.path]
+fix_sys_path() # wipes out sys.path
+sys.path.extend(saved_path) # put back our original paths
+
+from google.appengine.ext import testbed
+
+import webapp2
+
+from simpleauth import SimpleAuthHandler, AsyncSimpleAuthHandler, Transport
+
+import fakeprovider
+
+
+class BenchAuthHandler(webapp2.RequestHandler, SimpleAuthHandler):
+  """Keeps the session in request environ, so that it can be carried over
+  from init to callback request without any serialization.
+  """
+
+  @property
+  def session(self):
+    return self.request.environ['bench.session']
+
+  def _on_signin(self, user_data, auth_info, provider, extra=None):
+    self.response.write(user_data['id'] if 'id' in user_data else '')
+
+  def _callback_uri_for(self, provider):
+    return self.uri_for('callback', provider=provider, _full=True)
+
+  def _get_consumer_info_for(self, provider):
+    if self.PROVIDERS[provider][0] == 'oauth1':
+      return 'bench-key', 'bench-secret'
+    return 'bench-client-id', 'bench-client-secret', 'email'
+
+
+class AsyncBenchAuthHandler(BenchAuthHandler, AsyncSimpleAuthHandler):
+  pass
+
+
+class TimingTransport(Transport):
+  """Accumulates time spent in another transport's fetch()."""
+
+  def __init__(self, transport):
+    super(TimingTransport, self).__init__()
+    self.transport = transport
+    self.elapsed = 0.0
+
+  def fetch(self, url, payload=None, method='GET', headers=None,
+            deadline=None):
+    start = time.time()
+    try:
+      return self.transport.fetch(url, payload, method, headers,
+                                  deadline=deadline)
+    finally:
+      self.elapsed += time.time() - start
+
+
+def make_app(handler_class):
+  return webapp2.WSGIApplication([
+    webapp2.Route('/auth/<provider>', handler=handler_class,
+                  handler_method='_simple_auth'),
+    webapp2.Route('/auth/<provider>/callback', handler=handler_class,
+                  handler_method='_auth_callback', name='callback'),
+  ])
+
+
+def get(app, url, session):
+  req = webapp2.Request.blank(url)
+  req.environ['bench.session'] = session
+  resp = req.get_response(app)
+  if resp.status_int >= 400:
+    raise RuntimeError('%s: %s\n%s' % (url, resp.status, resp.body))
+  return resp
+
+
+def callback_query(auth_type, location):
+  """Returns query string a provider would call us back with."""
+  if auth_type == 'oauth2':
+    query = dict(urlparse.parse_qsl(urlparse.urlsplit(location).query))
+    params = {'code': 'bench-auth-code'}
+    if 'state' in query:
+      params['state'] = query['state']
+  elif auth_type == 'oauth1':
+    params = {'oauth_token': 'bench-request-token',
+              'oauth_verifier': 'bench-verifier'}
+  else:
+    params = {}
+  return urlencode(params)
+
+
+def login(app, provider, auth_type):
+  """Returns (init, callback) duration of a single login."""
+  session = {}
+  start = time.time()
+  resp = get(app, '/auth/%s' % provider, session)
+  init = time.time() - start
+
+  query = callback_query(auth_type, resp.headers['Location'])
+  start = time.time()
+  get(app, '/auth/%s/callback?%s' % (provider, query), session)
+  return init, time.time() - start
+
+
+def percentile(values, p):
+  """Nearest-rank percentile of sorted values."""
+  if not values:
+    return 0.0
+  k = int(round(p / 100.0 * len(values) + 0.5)) - 1
+  return values[max(0, min(k, len(values) - 1))]
+
+
+def run(app, handler_class, timer, provider, logins, warmup):
+  auth_type = handler_class.PROVIDERS[provider][0]
+  for _ in xrange(warmup):
+    login(app, provider, auth_type)
+
+  gc.collect()
+  objects = len(gc.get_objects())
+  totals, inits, callbacks, fetches = [], [], [], []
+  started = time.time()
+  for _ in xrange(logins):
+    timer.elapsed = 0.0
+    init, callback = login(app, provider, auth_type)
+    inits.append(init)
+    callbacks.append(callback)
+    totals.append(init + callback)
+    fetches.append(timer.elapsed)
+  duration = time.time() - started
+  gc.collect()
+
+  for values in (totals, inits, callbacks, fetches):
+    values.sort()
+  ms = lambda v: v * 1000
+  return {
+    'provider': provider,
+    'type': auth_type,
+    'rate': logins / duration,
+    'p50': ms(percentile(totals, 50)),
+    'p99': ms(percentile(totals, 99)),
+    'init': ms(percentile(inits, 50)),
+    'callback': ms(percentile(callbacks, 50)),
+    'fetch': ms(percentile(fetches, 50)),
+    'objs': float(len(gc.get_objects()) - objects) / logins,
+  }
+
+
+HEADER = ('%-14s %-7s %9s %8s %8s %8s %8s %8s %6s' % (
+  'provider', 'type', 'logins/s', 'p50', 'p99', 'init', 'callback', 'fetch',
+  'objs'))
+ROW = ('%(provider)-14s %(type)-7s %(rate)9.1f %(p50)8.2f %(p99)8.2f '
+       '%(init)8.2f %(callback)8.2f %(fetch)8.2f %(objs)6.1f')
+
+
+def main(argv):
+  parser = optparse.OptionParser(usage='%prog [options] [provider ...]')
+  parser.add_option('-n', '--logins', type='int', default=200,
+                    help='logins per provider [%default]')
+  parser.add_option('-w', '--warmup', type='int', default=20,
+                    help='logins per provider before measuring [%default]')
+  parser.add_option('-l', '--latency', type='float', default=0,
+                    help='fake provider response latency, ms [%default]')
+  parser.add_option('--http', action='store_true', default=False,
+                    help='serve fake provider over local HTTP')
+  parser.add_option('--async', action='store_true', default=False,
+                    help='use AsyncSimpleAuthHandler')
+  opts, providers = parser.parse_args(argv)
+
+  # deprecation warnings of some providers would be logged on every login
+  logging.getLogger().setLevel(logging.ERROR)
+
+  bed = testbed.Testbed()
+  bed.activate()
+  bed.init_memcache_stub()
+  bed.init_datastore_v3_stub()
+  bed.init_user_stub()
+  bed.setup_env(overwrite=True, user_email='bench@example.org',
+                user_id='1234567890',
+                federated_identity='https://example.org/openid/bench',
+                federated_provider='example.org')
+
+  handler_class = AsyncBenchAuthHandler if opts.async else BenchAuthHandler
+  provider = fakeprovider.FakeProvider(handler_class,
+                                       latency=opts.latency / 1000.0)
+  server = None
+  if opts.http:
+    server = fakeprovider.FakeProviderServer(provider)
+    server.start()
+    transport = fakeprovider.RoutingTransport(server.server_address)
+  else:
+    transport = fakeprovider.FakeProviderTransport(provider)
+  timer = TimingTransport(transport)
+  handler_class.TRANSPORT = timer
+
+  app = make_app(handler_class)
+  print 'logins: %d, latency: %.1f ms, transport: %s, handler: %s' % (
+    opts.logins, opts.latency, transport.__class__.__name__,
+    handler_class.__name__)
+  print '(times in ms)'
+  print HEADER
+  try:
+    for name in providers or sorted(handler_class.PROVIDERS):
+      print ROW % run(app, handler_class, timer, name,
+                      opts.logins, opts.warmup)
+  finally:
+    if server is not None:
+      server.stop()
+    bed.deactivate()
+
+  maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  print 'max RSS: %.1f MB' % (maxrss / 1024.0)
+
+
+if __name__ == '__main__':
+  main(sys.argv[1:])
@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+"""Benchmarks LinkedIn XML profile parsing.
+
+Compares three ways to read LinkedIn fields of a profile:
+
+  tree      whole document parsed into a tree, which is what
+            _parse_xml_user_info() used to do
+  stream    incremental parsing which stops once all fields are found
+  default   _parse_xml_user_info(), i.e. tree below XML_STREAM_MIN_SIZE
+            and stream above it
+
+Profiles are padded with positions to the given size, with the fields
+either at the top of the document, as LinkedIn sends them, or at the very
+end.
+
+Usage:
+
+  PYTHONPATH=.:./example/lib:$GAE_SDK python bench/xml_bench.py [-n 200]
+"""
+import optparse
+import sys
+import timeit
+
+# Same as tests/__init__.py
+from dev_appserver import fix_sys_path
+saved_path = [p for p in sys.path]
+fix_sys_path() # wipes out sys.path
+sys.path.extend(saved_path) # put back our original paths
+
+from simpleauth import SimpleAuthHandler
+from simpleauth import handler as handler_module
+from simpleauth.handler import etree, LINKEDIN_FIELDS
+
+
+FIELDS = (
+  '  <id>AbCdEfGhIj</id>\n'
+  '  <first-name>Bench</first-name>\n'
+  '  <last-name>User</last-name>\n'
+  '  <picture-url>https://example.org/photo.jpg</picture-url>\n'
+  '  <public-profile-url>https://www.linkedin.com/in/bench'
+  '</public-profile-url>\n'
+  '  <headline>Benchmarks things</headline>\n')
+
+POSITION = (
+  '    <position>\n'
+  '      <id>%d</id>\n'
+  '      <title>Engineer</title>\n'
+  '      <summary>Worked on things, some of them large &amp; slow.</summary>\n'
+  '      <start-date><year>2010</year><month>1</month></start-date>\n'
+  '      <is-current>false</is-current>\n'
+  '      <company><id>%d</id><name>Example Inc</name>'
+  '<industry>Internet</industry></company>\n'
+  '    </position>\n')
+
+
+def make_profile(size, fields_first=True):
+  """Returns a LinkedIn profile document of about size bytes."""
+  positions = []
+  total = 0
+  while total < size:
+    position = POSITION % (len(positions), len(positions))
+    positions.append(position)
+    total += len(position)
+  padding = '  <positions total="%d">\n%s  </positions>\n' % (
+    len(positions), ''.join(positions))
+  body = FIELDS + padding if fields_first else padding + FIELDS
+  return ('<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+          '<person>\n%s</person>\n' % body)
+
+
+def parse_tree(content):
+  """The full tree approach."""
+  person = etree.fromstring(content)
+  uinfo = {}
+  for e in person:
+    uinfo.setdefault(e.tag, e.text)
+  return uinfo
+
+
+def main(argv):
+  parser = optparse.OptionParser(usage='%prog [options]')
+  parser.add_option('-n', '--number', type='int', default=200,
+                    help='parses per measurement [%default]')
+  opts, _ = parser.parse_args(argv)
+
+  handler = SimpleAuthHandler()
+  min_size = handler_module.XML_STREAM_MIN_SIZE
+
+  def stream(content):
+    handler_module.XML_STREAM_MIN_SIZE = 0
+    try:
+      return handler._parse_xml_user_info(content, LINKEDIN_FIELDS)
+    finally:
+      handler_module.XML_STREAM_MIN_SIZE = min_size
+
+  parsers = [
+    ('tree', parse_tree),
+    ('stream', stream),
+    ('default', lambda c: handler._parse_xml_user_info(c, LINKEDIN_FIELDS)),
+  ]
+
+  print 'parser: %s, parses: %d, stream min size: %dK' % (
+    etree.__name__, opts.number, min_size // 1024)
+  print '(times in us per parse)'
+  print '%-8s %-7s %10s %10s %10s' % ('size', 'fields', 'tree', 'stream',
+                                      'default')
+  for size in (1, 16, 128, 256, 1024):
+    for fields_first in (True, False):
+      content = make_profile(size * 1024, fields_first)
+      expected = parse_tree(content)
+      row = []
+      for name, parse in parsers:
+        result = parse(content)
+        for field in LINKEDIN_FIELDS:
+          assert result[field] == expected[field], (name, field)
+        seconds = timeit.timeit(lambda: parse(content), number=opts.number)
+        row.append(seconds / opts.number * 1e6)
+      print '%-8s %-7s %10.1f %10.1f %10.1f' % tuple(
+        ['%dK' % size, 'first' if fields_first else 'last'] + row)
+
+if __name__ == '__main__':
+  main(sys.argv[1:])
@@ -150,6 +150,17 @@ class AuthHandler(BaseRequestHandler, SimpleAuthHandler):
     }
   }
 
+  # Fields of USER_ATTRS, so that providers don't send the whole profile
+  USER_INFO_FIELDS = {
+    'facebook': ('name', 'link'),
+    # the userinfo endpoint has no 'profile' field: Google would reject
+    # the request. It's only an id_token claim.
+    'google': ('picture', 'name'),
+    'googleplus': ('image', 'displayName', 'url'),
+    'linkedin': ('picture-url', 'first-name', 'public-profile-url'),
+    'linkedin2': ('picture-url', 'first-name', 'public-profile-url'),
+  }
+
   def _on_signin(self, data, auth_info, provider, extra=None):
     """Callback whenever a new or existing user is logging in.
      data is a user info dictionary.
@@ -29,6 +29,9 @@ import random
 import urlparse
 import hmac
 import binascii
+import collections
+import re
+import threading
 import httplib2
 
 try:
@@ -682,6 +685,142 @@ class Client(httplib2.Http):
             connection_type=connection_type)
 
 
+class MemoryNonceStore(object):
+    """Remembers nonces of verified requests to reject replays.
+
+    Nonces are kept in memory until their timestamp is out of the
+    server's window, in a ring of at most max_size entries, so that both
+    checking and adding a nonce are O(1). If the ring fills up with nonces
+    still in the window, the oldest are dropped and requests with
+    timestamps not newer than theirs are rejected from then on, so that
+    a dropped nonce can't be replayed.
+
+    Each process has its own ring. To reject replays across workers too,
+    pass a shared backend: any object with memcache-like
+    add(key, value, time) method, which returns False if the key already
+    exists, e.g. google.appengine.api.memcache.Client(). If it also has
+    add_multi(mapping, time), batches of nonces are added with one call.
+
+    Thread-safe.
+    """
+
+    def __init__(self, max_size=100000, backend=None, prefix='oauth_nonce:'):
+        self.max_size = max_size
+        self.backend = backend
+        self.prefix = prefix
+        # nonce key: expires
+        self._expires = {}
+        # (expires, timestamp, nonce key) in order of addition
+        self._ring = collections.deque()
+        # requests with timestamps up to this one are rejected
+        self.floor = None
+        self._lock = threading.Lock()
+
+    def seen(self, key, timestamp):
+        """Returns True if key was added already or timestamp is too old
+        to tell. Only the local ring is checked."""
+        if self.floor is not None and timestamp <= self.floor:
+            return True
+        expires = self._expires.get(key)
+        return expires is not None and expires > time.time()
+
+    def add(self, key, timestamp, ttl):
+        """Adds a nonce key which is valid for ttl seconds.
+
+        Returns False if the key was added already, here or in backend.
+        """
+        return self.add_multi([(key, timestamp)], ttl)[0]
+
+    def add_multi(self, keys, ttl):
+        """Adds a list of (key, timestamp) tuples.
+
+        Returns a list of booleans, same as add() of each key.
+        """
+        now = time.time()
+        added = []
+        with self._lock:
+            self._expire(now)
+            for key, timestamp in keys:
+                if self.seen(key, timestamp):
+                    added.append(False)
+                    continue
+                expires = now + ttl
+                self._expires[key] = expires
+                self._ring.append((expires, timestamp, key))
+                added.append(True)
+            self._evict()
+
+        if self.backend is not None:
+            new_keys = [key for (key, _), ok in zip(keys, added) if ok]
+            if new_keys:
+                exists = self._backend_add(new_keys, ttl)
+                added = [ok and key not in exists
+                         for (key, _), ok in zip(keys, added)]
+        return added
+
+    def clear(self):
+        with self._lock:
+            self._expires.clear()
+            self._ring.clear()
+            self.floor = None
+
+    def _expire(self, now):
+        ring = self._ring
+        while ring and ring[0][0] <= now:
+            expires, _, key = ring.popleft()
+            if self._expires.get(key) == expires:
+                del self._expires[key]
+
+    def _evict(self):
+        ring = self._ring
+        while len(ring) > self.max_size:
+            _, timestamp, key = ring.popleft()
+            self._expires.pop(key, None)
+            if self.floor is None or timestamp > self.floor:
+                self.floor = timestamp
+
+    def _backend_add(self, keys, ttl):
+        """Returns a set of keys which already existed in backend."""
+        ttl = int(ttl) + 1
+        mapping = dict((self._backend_key(key), key) for key in keys)
+        add_multi = getattr(self.backend, 'add_multi', None)
+        if add_multi is not None:
+            not_added = add_multi(dict.fromkeys(mapping, 1), time=ttl)
+            return set(mapping[k] for k in not_added or ())
+        return set(key for backend_key, key in mapping.iteritems()
+                   if not self.backend.add(backend_key, 1, time=ttl))
+
+    def _backend_key(self, key):
+        # nonces come from clients: keep keys short and printable
+        return self.prefix + sha('\0'.join(map(to_utf8, key))).hexdigest()
+
+
+class CachedLookup(object):
+    """Caches results of a lookup function, e.g. of consumer secrets.
+
+    Results, including None, are kept for ttl seconds. Once there are
+    max_size of them, all are dropped.
+    """
+
+    def __init__(self, lookup, ttl=300, max_size=10000):
+        self.lookup = lookup
+        self.ttl = ttl
+        self.max_size = max_size
+        # args: (expires, result)
+        self._results = {}
+
+    def __call__(self, *args):
+        item = self._results.get(args)
+        now = time.time()
+        if item is not None and item[0] > now:
+            return item[1]
+        result = self.lookup(*args)
+        if len(self._results) >= self.max_size:
+            self._results = {}
+        self._results[args] = (now + self.ttl, result)
+        return result
+
+
 class Server(object):
     """A skeletal implementation of a service provider, providing protected
     resources to requests from authorized consumers.
@@ -689,14 +828,33 @@ class Server(object):
     This class implements the logic to check requests for authorization. You
     can use it with your web server or web framework to protect certain
     resources with OAuth.
+
+    With a nonce_store, e.g. MemoryNonceStore(), nonces of verified
+    requests are remembered and replayed requests are rejected.
+    With consumer_lookup and token_lookup functions, verify() and
+    verify_requests() find consumers and tokens of requests themselves.
+    Lookup results are cached for lookup_ttl seconds.
     """
 
     timestamp_threshold = 300 # In seconds, five minutes.
     version = OAUTH_VERSION
     signature_methods = None
+    nonce_store = None
 
-    def __init__(self, signature_methods=None):
+    def __init__(self, signature_methods=None, nonce_store=None,
+                 consumer_lookup=None, token_lookup=None, lookup_ttl=300):
+        """
+        consumer_lookup(consumer_key) returns a Consumer or None.
+        token_lookup(consumer, token_key) returns a Token or None.
+        """
         self.signature_methods = signature_methods or {}
+        self.nonce_store = nonce_store
+        self.consumer_lookup = None
+        self.token_lookup = None
+        if consumer_lookup is not None:
+            self.consumer_lookup = CachedLookup(consumer_lookup, lookup_ttl)
+        if token_lookup is not None:
+            self.token_lookup = CachedLookup(token_lookup, lookup_ttl)
 
     def add_signature_method(self, signature_method):
         self.signature_methods[signature_method.name] = signature_method
@@ -707,13 +865,82 @@ class Server(object):
 
         self._check_version(request)
         self._check_signature(request, consumer, token)
+        if self.nonce_store is not None:
+            if not self.nonce_store.add(*self._nonce(request, consumer, token)):
+                raise Error('Nonce already used.')
         parameters = request.get_nonoauth_parameters()
         return parameters
 
+    def verify(self, request):
+        """Same as verify_request() but finds the consumer and token of
+        request with consumer_lookup and token_lookup."""
+        consumer, token = self._lookup(request)
+        return self.verify_request(request, consumer, token)
+
+    def verify_requests(self, requests):
+        """Verifies a batch of requests.
+
+        Returns a list with non-OAuth parameters of each valid request,
+        or the Error it failed with. Nonces of all valid requests are added
+        to the nonce store at once.
+        """
+        results = []
+        nonces = []
+        for request in requests:
+            try:
+                consumer, token = self._lookup(request)
+                self._check_version(request)
+                self._check_signature(request, consumer, token)
+                if self.nonce_store is not None:
+                    nonces.append((len(results),
+                                   self._nonce(request, consumer, token)))
+                results.append(request.get_nonoauth_parameters())
+            except Error, e:
+                results.append(e)
+
+        if nonces:
+            ttl = max(nonce[2] for _, nonce in nonces)
+            added = self.nonce_store.add_multi(
+                [nonce[:2] for _, nonce in nonces], ttl)
+            for (i, _), ok in zip(nonces, added):
+                if not ok:
+                    results[i] = Error('Nonce already used.')
+        return results
+
     def build_authenticate_header(self, realm=''):
         """Optional support for the authenticate header."""
         return {'WWW-Authenticate': 'OAuth realm="%s"' % realm}
 
+    def _lookup(self, request):
+        """Returns (consumer, token) of a request."""
+        if self.consumer_lookup is None:
+            raise Error('No consumer lookup.')
+        consumer_key = request.get_parameter('oauth_consumer_key')
+        consumer = self.consumer_lookup(consumer_key)
+        if consumer is None:
+            raise Error('Invalid consumer.')
+
+        token = None
+        token_key = request.get('oauth_token')
+        if token_key:
+            if self.token_lookup is None:
+                raise Error('No token lookup.')
+            token = self.token_lookup(consumer, token_key)
+            if token is None:
+                raise Error('Invalid token.')
+        return consumer, token
+
+    def _nonce(self, request, consumer, token):
+        """Returns (key, timestamp, ttl) of the request nonce for the nonce
+        store. RFC 5849 section 3.3: a nonce is unique for a timestamp,
+        consumer and token."""
+        timestamp, nonce = request._get_timestamp_nonce()
+        timestamp = int(timestamp)
+        key = (consumer.key, token and token.key or '', str(timestamp), nonce)
+        # a nonce is useless once its timestamp is out of the window
+        ttl = max(timestamp + self.timestamp_threshold - time.time(), 1)
+        return key, timestamp, ttl
+
     def _check_version(self, request):
         """Verify the correct version of the request for this server."""
         version = self._get_version(request)
@@ -749,7 +976,10 @@ class Server(object):
         return request.get_parameter('oauth_verifier')
 
     def _check_signature(self, request, consumer, token):
-        timestamp, nonce = request._get_timestamp_nonce()
+        try:
+            timestamp, nonce = request._get_timestamp_nonce()
+        except KeyError, e:
+            raise Error('Missing %s.' % e)
         self._check_timestamp(timestamp)
         signature_method = self._get_signature_method(request)
 
@@ -758,6 +988,11 @@ class Server(object):
         except:
             raise MissingSignature('Missing oauth_signature.')
 
+        if self.nonce_store is not None and self.nonce_store.seen(
+                self._nonce(request, consumer, token)[0], int(timestamp)):
+            # cheap rejection of local replays, before any hashing
+            raise Error('Nonce already used.')
+
         # Validate the signature.
         valid = signature_method.check(request, consumer, token, signature)
 
@@ -769,13 +1004,20 @@ class Server(object):
 
     def _check_timestamp(self, timestamp):
         """Verify that timestamp is recentish."""
-        timestamp = int(timestamp)
+        try:
+            timestamp = int(timestamp)
+        except ValueError:
+            raise Error('Invalid timestamp: %s' % timestamp)
         now = int(time.time())
         lapsed = now - timestamp
         if lapsed > self.timestamp_threshold:
             raise Error('Expired timestamp: given %d and now %s has a '
                 'greater difference than threshold %d' % (timestamp, now, 
                     self.timestamp_threshold))
+        if self.nonce_store is not None and -lapsed > self.timestamp_threshold:
+            # nonces of such requests would have to be kept for too long
+            raise Error('Timestamp in the future: given %d and now %s' % (
+                timestamp, now))
 
 
 class SignatureMethod(object):
@@ -843,6 +1085,121 @@ class SignatureMethod_HMAC_SHA1(SignatureMethod):
         return binascii.b2a_base64(hashed.digest())[:-1]
 
 
+def _utf8(s):
+    """Same as to_utf8_if_string() but without decoding unicode twice."""
+    if isinstance(s, unicode):
+        return s.encode('utf-8')
+    if isinstance(s, str):
+        try:
+            s.decode('utf-8')
+        except UnicodeDecodeError:
+            # raises an instructive TypeError
+            return to_utf8(s)
+    return s
+
+
+# Strings made of RFC 5849 unreserved characters only, which are not
+# percent-encoded.
+_is_unreserved = re.compile(r'[A-Za-z0-9._~-]*\Z').match
+
+
+def _quote(s):
+    """Percent-encodes a utf-8 string as per RFC 5849 section 3.6."""
+    if _is_unreserved(s):
+        return s
+    return urllib.quote(s, '~')
+
+
+class FastSignatureMethod_HMAC_SHA1(SignatureMethod_HMAC_SHA1):
+    """Produces the same signatures as SignatureMethod_HMAC_SHA1, faster.
+
+    Parameters are percent-encoded once, as per RFC 5849 section 3.6,
+    instead of being urlencoded and then patched up. HMAC objects keyed
+    with consumer and token secrets are kept, so that signing a request
+    only hashes its signature base string. A single instance can be shared
+    by all clients and threads.
+    """
+
+    # Number of (consumer secret, token secret) pairs to keep keyed HMAC
+    # objects for, and of encoded URLs. All of them are dropped once there
+    # are more.
+    max_keys = 1024
+
+    def __init__(self):
+        self._hmacs = {}
+        self._urls = {}
+
+    def signing_base(self, request, consumer, token):
+        return self._key(consumer, token), self._signature_base(request)
+
+    def sign(self, request, consumer, token):
+        """Builds the base signature string."""
+        hashed = self._keyed_hmac(consumer, token).copy()
+        hashed.update(self._signature_base(request))
+
+        # Calculate the digest base 64.
+        return binascii.b2a_base64(hashed.digest())[:-1]
+
+    def _key(self, consumer, token):
+        key = '%s&' % escape(consumer.secret)
+        if token:
+            key += escape(token.secret)
+        return key
+
+    def _keyed_hmac(self, consumer, token):
+        secrets = (consumer.secret, token and token.secret)
+        hashed = self._hmacs.get(secrets)
+        if hashed is None:
+            if len(self._hmacs) >= self.max_keys:
+                self._hmacs = {}
+            hashed = hmac.new(self._key(consumer, token), digestmod=sha)
+            self._hmacs[secrets] = hashed
+        return hashed
+
+    def _signature_base(self, request):
+        url = getattr(request, 'normalized_url', None)
+        if url is None:
+            raise ValueError("Base URL for request is not set.")
+        encoded_url = self._urls.get(url)
+        if encoded_url is None:
+            if len(self._urls) >= self.max_keys:
+                self._urls = {}
+            encoded_url = self._urls[url] = _quote(_utf8(url))
+
+        # normalized parameters are already percent-encoded, so the only
+        # characters left to encode are these three
+        params = self._normalized_parameters(request)
+        params = params.replace('%', '%25').replace('=', '%3D').replace(
+            '&', '%26')
+        return '%s&%s&%s' % (_quote(_utf8(request.method)), encoded_url,
+                             params)
+
+    def _normalized_parameters(self, request):
+        """Same as request.get_normalized_parameters()."""
+        items = []
+        for key, value in request.iteritems():
+            if key == 'oauth_signature':
+                continue
+            key = _utf8(key)
+            if isinstance(value, basestring):
+                items.append((key, _utf8(value)))
+            elif hasattr(value, '__iter__'):
+                items.extend((key, _utf8(item)) for item in value)
+            else:
+                items.append((key, value))
+
+        # Include any query string parameters from the provided URL
+        if '?' in request.url:
+            query = urlparse.urlparse(request.url)[4]
+            url_items = request._split_url_string(query).items()
+            items.extend((to_utf8(k), to_utf8(v)) for k, v in url_items
+                         if k != 'oauth_signature')
+
+        items.sort()
+        return '&'.join(['%s=%s' % (_quote(str(k)), _quote(str(v)))
+                         for k, v in items])
+
+
 class SignatureMethod_PLAINTEXT(SignatureMethod):
 
     name = 'PLAINTEXT'
@@ -11,3 +11,39 @@ __all__ = []
 
 from handler import *
 __all__ += handler.__all__
+
+from transport import *
+__all__ += transport.__all__
+
+from cache import *
+__all__ += cache.__all__
+
+from tracing import *
+__all__ += tracing.__all__
+
+from idtoken import *
+__all__ += idtoken.__all__
+
+from keys import *
+__all__ += keys.__all__
+
+from discovery import *
+__all__ += discovery.__all__
+
+from state import *
+__all__ += state.__all__
+
+from breaker import *
+__all__ += breaker.__all__
+
+from singleflight import *
+__all__ += singleflight.__all__
+
+from tokens import *
+__all__ += tokens.__all__
+
+from bulk import *
+__all__ += bulk.__all__
+
+from async_handler import *
+__all__ += async_handler.__all__
@@ -0,0 +1,414 @@
+# -*- coding: utf-8 -*-
+"""SimpleAuthHandler flavour built on App Engine ndb tasklets.
+
+Every step of the auth flow which talks to a provider has a tasklet
+counterpart named with _async suffix, e.g. _auth_callback_async() or
+_get_google_user_info_async(). Tasklets return ndb.Future, so a request
+doesn't hold on to a thread while waiting for a provider: other tasklets
+run in the meantime.
+"""
+import logging
+import json
+import copy
+import functools
+import sys
+import time
+
+from urllib import urlencode
+
+from lazy import LazyModule
+from handler import SimpleAuthHandler, LINKEDIN_FIELDS, oauth1
+from handler import AuthProviderResponseError
+from singleflight import DuplicateCallError
+from transport import TransportError
+
+# imported on first tasklet call, so that importing simpleauth doesn't
+# pull in ndb and with it the datastore and urlfetch APIs
+ndb = LazyModule('google.appengine.ext.ndb')
+
+__all__ = ['AsyncSimpleAuthHandler']
+
+
+def _tasklet(func):
+  """Same as ndb.tasklet decorator, but ndb is imported on first call."""
+  wrapped = []
+
+  @functools.wraps(func)
+  def tasklet(*args, **kwargs):
+    if not wrapped:
+      wrapped.append(ndb.tasklet(func))
+    return wrapped[0](*args, **kwargs)
+  return tasklet
+
+
+@_tasklet
+def _get_result(future):
+  """Waits for a transport future inside a tasklet and returns its result.
+
+  URLfetch RPCs are handed over to ndb event loop so that other tasklets can
+  run meanwhile. Other futures, e.g. transport.ThreadFuture, simply block.
+  """
+  rpc = getattr(future, 'rpc', None)
+  if rpc is not None:
+    yield rpc
+  raise ndb.Return(future.get_result())
+
+
+class AsyncSimpleAuthHandler(SimpleAuthHandler):
+  """A mixin to be used with a real request handler, same as
+  SimpleAuthHandler, but provider calls are made from ndb tasklets.
+
+  _simple_auth() and _auth_callback() entry points are kept so that routing
+  stays the same. They run the corresponding tasklets and wait for the result.
+  If you already have a tasklet, yield _simple_auth_async() or
+  _auth_callback_async() instead.
+
+  Custom providers need a _get_<provider>_user_info_async() tasklet.
+  """
+
+  # Provider records resolve to tasklets
+  AUTH_METHOD_SUFFIX = '_async'
+
+  def _simple_auth(self, provider=None):
+    self._simple_auth_async(provider).get_result()
+
+  def _auth_callback(self, provider=None):
+    self._auth_callback_async(provider).get_result()
+
+  @_tasklet
+  def _simple_auth_async(self, provider=None):
+    """Tasklet version of _simple_auth().
+
+    Calls _<authtype>_init_async() method.
+    """
+    extra = None
+    if self.request is not None and self.request.params is not None:
+      extra = self.request.params.items()
+
+    p = self._provider(provider)
+    self._check_circuit(provider, 'init')
+    self._active_provider = provider
+    try:
+      with self.TRACER.span(provider, 'init'):
+        yield p.init(self, provider, p.init_arg, extra)
+    finally:
+      self._active_provider = None
+
+  @_tasklet
+  def _auth_callback_async(self, provider=None):
+    """Tasklet version of _auth_callback().
+
+    Calls _<authtype>_callback_async() method.
+    """
+    p = self._provider(provider)
+    self._check_circuit(provider, 'callback')
+    self._active_provider = provider
+    self._deadline = self._callback_deadline(provider)
+    try:
+      with self.TRACER.span(provider, 'callback'):
+        result = yield p.callback(self, provider, p.callback_arg)
+    finally:
+      self._active_provider = self._deadline = None
+    user_data, auth_info = result[0], result[1]
+
+    extra = None
+    if len(result) > 2:
+      extra = result[2]
+
+    with self.TRACER.span(provider, 'signin'):
+      self._on_signin(user_data, auth_info, provider, extra=extra)
+
+  @_tasklet
+  def _oauth2_init_async(self, provider, auth_url, extra=None):
+    """OAuth 2.0 init step makes no requests: this just redirects."""
+    self._oauth2_init(provider, auth_url, extra)
+
+  @_tasklet
+  def _oauth2_callback_async(self, provider, access_token_url):
+    """Tasklet version of _oauth2_callback().
+
+    With CALLBACK_SINGLEFLIGHT, duplicate callbacks block while waiting for
+    the first one.
+    """
+    payload, extra = self._oauth2_access_token_payload(provider)
+    key = self._singleflight_key(provider, payload['code'])
+    if key is None:
+      result = yield self._oauth2_exchange_async(provider, access_token_url,
+                                                 payload, extra)
+      raise ndb.Return(result)
+
+    flight, leader = self.CALLBACK_SINGLEFLIGHT.begin(key)
+    if not leader:
+      if flight.wait(self.CALLBACK_SINGLEFLIGHT.wait):
+        try:
+          result = flight.get_result()
+        except DuplicateCallError:
+          raise AuthProviderResponseError('Duplicate callback', provider)
+        raise ndb.Return(result)
+      logging.warning('Timed out waiting for a duplicate %s callback',
+                      provider)
+    try:
+      result = yield self._oauth2_exchange_async(provider, access_token_url,
+                                                 payload, extra)
+    except Exception:
+      if leader:
+        flight.fail(sys.exc_info())
+      raise
+    if leader:
+      flight.finish(result)
+    raise ndb.Return(result)
+
+  @_tasklet
+  def _oauth2_exchange_async(self, provider, access_token_url, payload, extra):
+    """Tasklet version of _oauth2_exchange()."""
+    client_id, client_secret = payload['client_id'], payload['client_secret']
+
+    with self.TRACER.span(provider, 'token') as span:
+      resp = yield self._fetch_async(
+          access_token_url,
+          payload=urlencode(payload),
+          method='POST',
+          headers={'Content-Type': 'application/x-www-form-urlencoded'})
+      span.status = resp.status_code
+
+    auth_info = self._parse_token_response(provider, resp.content)
+    pending = self._oauth2_prefetch(provider, auth_info)
+    user_data = yield self._get_user_info_async(
+        provider, auth_info, key=client_id, secret=client_secret)
+    self._merge_prefetched(provider, user_data, pending)
+    self._save_tokens(provider, user_data, auth_info)
+    raise ndb.Return((user_data, auth_info, extra))
+
+  @_tasklet
+  def _oidc_init_async(self, provider, issuer, extra=None):
+    """Discovery document is normally cached, so this just redirects."""
+    self._oidc_init(provider, issuer, extra)
+
+  @_tasklet
+  def _oidc_callback_async(self, provider, issuer):
+    """Tasklet version of _oidc_callback()."""
+    doc = self._oidc_discovery(provider, issuer)
+    result = yield self._oauth2_callback_async(provider, doc['token_endpoint'])
+    raise ndb.Return(result)
+
+  @_tasklet
+  def _oauth1_init_async(self, provider, auth_urls, extra=None):
+    """Tasklet version of _oauth1_init()."""
+    key, secret = self._get_consumer_info_for(provider)
+    callback_url = self._callback_uri_for(provider)
+
+    client = self._oauth1_client(consumer_key=key, consumer_secret=secret)
+    body = urlencode({'oauth_callback': callback_url})
+    with self.TRACER.span(provider, 'request_token') as span:
+      resp = yield self._send_async(lambda **kwargs: client.request_async(
+          auth_urls['request'], "POST", body, **kwargs))
+      span.status = resp.status_code
+    self._oauth1_authorize(provider, auth_urls, resp, resp.content)
+
+  @_tasklet
+  def _oauth1_callback_async(self, provider, access_token_url):
+    """Tasklet version of _oauth1_callback()."""
+    token = self._oauth1_verified_token(provider)
+    consumer_key, consumer_secret = self._get_consumer_info_for(provider)
+    client = self._oauth1_client(consumer_key=consumer_key,
+                                 consumer_secret=consumer_secret)
+    with self.TRACER.span(provider, 'token') as span:
+      resp = yield self._send_async(lambda **kwargs: client.request_async(
+          access_token_url, "POST", token=token, **kwargs))
+      span.status = resp.status_code
+
+    auth_info = self._parse_token_response(provider, resp.content)
+    user_data = yield self._get_user_info_async(
+        provider, auth_info, key=consumer_key, secret=consumer_secret)
+    raise ndb.Return((user_data, auth_info))
+
+  @_tasklet
+  def _openid_init_async(self, provider='openid', identity=None, extra=None):
+    """OpenID uses App Engine users API which makes no remote calls."""
+    self._openid_init(provider, identity, extra)
+
+  @_tasklet
+  def _openid_callback_async(self, provider='openid', _identity=None):
+    raise ndb.Return(self._openid_callback(provider, _identity))
+
+  #
+  # user profile/info
+  #
+
+  @_tasklet
+  def _get_user_info_async(self, provider, auth_info, key=None, secret=None):
+    """Tasklet version of _get_user_info()."""
+    # keys are cached, so verifying a token normally makes no requests
+    user_data = self._id_token_user_info(provider, auth_info, key)
+    if user_data is not None:
+      raise ndb.Return(user_data)
+
+    cache_key = self._user_info_cache_key(provider, auth_info)
+    if cache_key is not None:
+      user_data = self.USER_INFO_CACHE.get(cache_key)
+      if user_data is not None:
+        raise ndb.Return(copy.deepcopy(user_data))
+
+    _fetcher = self._provider(provider).fetcher
+    with self.TRACER.span(provider, 'user_info'):
+      user_data = yield _fetcher(self, auth_info, key=key, secret=secret)
+
+    if cache_key is not None and user_data is not None:
+      self.USER_INFO_CACHE.set(cache_key, copy.deepcopy(user_data))
+    raise ndb.Return(user_data)
+
+  @_tasklet
+  def _get_oidc_user_info_async(self, provider, auth_info, key=None,
+                                secret=None):
+    """Tasklet version of _get_oidc_user_info()."""
+    url, headers = self._oidc_user_info_request(provider, auth_info)
+    resp = yield self._fetch_async(url, headers=headers,
+                                   retries=self.USER_INFO_RETRIES)
+    raise ndb.Return(self._parse_oidc_user_info(provider, resp))
+
+  @_tasklet
+  def _get_google_user_info_async(self, auth_info, key=None, secret=None):
+    """Tasklet version of _get_google_user_info()."""
+    url = self._user_info_url(
+        'https://www.googleapis.com/userinfo/v2/me?{0}', 'google')
+    resp = yield self._oauth2_request_tasklet(url, auth_info['access_token'])
+    data = json.loads(resp)
+    if 'id' not in data and 'sub' in data:
+      data['id'] = data['sub']
+    raise ndb.Return(data)
+
+  @_tasklet
+  def _get_googleplus_user_info_async(self, auth_info, key=None, secret=None):
+    """Tasklet version of _get_googleplus_user_info()."""
+    logging.warn('Google+ API endpoint is deprecated. '
+                 'Use Google API (google provider): '
+                 'https://developers.google.com/+/api-shutdown')
+    url = self._user_info_url(
+        'https://www.googleapis.com/plus/v1/people/me?{0}', 'googleplus')
+    resp = yield self._oauth2_request_tasklet(url, auth_info['access_token'])
+    raise ndb.Return(json.loads(resp))
+
+  @_tasklet
+  def _get_windows_live_user_info_async(self, auth_info, key=None,
+                                        secret=None):
+    """Tasklet version of _get_windows_live_user_info()."""
+    resp = yield self._oauth2_request_tasklet(
+        'https://apis.live.net/v5.0/me?{0}', auth_info['access_token'])
+    uinfo = json.loads(resp)
+    avurl = 'https://apis.live.net/v5.0/{0}/picture'.format(uinfo['id'])
+    uinfo.update(avatar_url=avurl)
+    raise ndb.Return(uinfo)
+
+  @_tasklet
+  def _get_facebook_user_info_async(self, auth_info, key=None, secret=None):
+    """Tasklet version of _get_facebook_user_info()."""
+    url = self._user_info_url('https://graph.facebook.com/me?{0}', 'facebook')
+    resp = yield self._oauth2_request_tasklet(url, auth_info['access_token'])
+    raise ndb.Return(json.loads(resp))
+
+  @_tasklet
+  def _get_foursquare_user_info_async(self, auth_info, key=None, secret=None):
+    """Tasklet version of _get_foursquare_user_info()."""
+    resp = yield self._oauth2_request_tasklet(
+        'https://api.foursquare.com/v2/users/self?{0}&v=20130204',
+        auth_info['access_token'], 'oauth_token')
+    data = json.loads(resp)
+    if data['meta']['code'] != 200:
+      logging.error(data['meta']['errorDetail'])
+    raise ndb.Return(data['response'].get('user'))
+
+  @_tasklet
+  def _get_linkedin_user_info_async(self, auth_info, key=None, secret=None):
+    """Tasklet version of _get_linkedin_user_info()."""
+    logging.warn('LinkedIn OAuth 1.0a is deprecated. '
+                 'Use LinkedIn with OAuth 2.0: '
+                 'https://developer.linkedin.com/documents/authentication')
+    token = oauth1.Token(key=auth_info['oauth_token'],
+                         secret=auth_info['oauth_token_secret'])
+    client = self._oauth1_client(consumer_key=key, consumer_secret=secret)
+
+    fields = self._user_info_fields('linkedin', LINKEDIN_FIELDS)
+    url = 'http://api.linkedin.com/v1/people/~:(%s)' % ','.join(fields)
+    resp = yield self._send_async(
+        lambda **kwargs: client.request_async(url, token=token, **kwargs),
+        retries=self.USER_INFO_RETRIES)
+    raise ndb.Return(self._parse_xml_user_info(resp.content, fields))
+
+  @_tasklet
+  def _get_linkedin2_user_info_async(self, auth_info, key=None, secret=None):
+    """Tasklet version of _get_linkedin2_user_info()."""
+    fields = self._user_info_fields('linkedin2', LINKEDIN_FIELDS)
+    url = 'https://api.linkedin.com/v1/people/~:(%s)?{0}' % ','.join(fields)
+    resp = yield self._oauth2_request_tasklet(
+        url, auth_info['access_token'], token_param='oauth2_access_token')
+    raise ndb.Return(self._parse_xml_user_info(resp, fields))
+
+  @_tasklet
+  def _get_twitter_user_info_async(self, auth_info, key=None, secret=None):
+    """Tasklet version of _get_twitter_user_info()."""
+    token = oauth1.Token(key=auth_info['oauth_token'],
+                         secret=auth_info['oauth_token_secret'])
+    client = self._oauth1_client(consumer_key=key, consumer_secret=secret)
+
+    url = 'https://api.twitter.com/1.1/account/verify_credentials.json'
+    resp = yield self._send_async(
+        lambda **kwargs: client.request_async(url, token=token, **kwargs),
+        retries=self.USER_INFO_RETRIES)
+    uinfo = json.loads(resp.content)
+    uinfo.setdefault('link', 'http://twitter.com/%s' % uinfo['screen_name'])
+    raise ndb.Return(uinfo)
+
+  #
+  # aux methods
+  #
+
+  @_tasklet
+  def _fetch_async(self, url, payload=None, method='GET', headers=None,
+                   retries=0):
+    """Makes an HTTP request using self.TRANSPORT.
+
+    Returns transport.Response. See _send() for retries.
+    """
+    resp = yield self._send_async(self.TRANSPORT.fetch_async, retries=retries,
+                                  url=url, payload=payload, method=method,
+                                  headers=headers)
+    raise ndb.Return(resp)
+
+  @_tasklet
+  def _send_async(self, send_async, retries=0, **kwargs):
+    """Tasklet version of _send(). send_async(**kwargs) must return
+    a transport future, e.g. self.TRANSPORT.fetch_async.
+    """
+    attempt = 0
+    while True:
+      deadline = self._time_left()
+      if deadline is not None:
+        kwargs['deadline'] = deadline
+      start = time.time()
+      try:
+        with self.TRACER.span(self._active_provider, 'fetch') as span:
+          resp = yield _get_result(send_async(**kwargs))
+          self._trace_response(span, resp)
+      except Exception as e:
+        self._record_request(start, failed=True)
+        self._time_left()
+        if attempt >= retries:
+          if isinstance(e, TransportError):
+            raise AuthProviderResponseError(str(e), self._active_provider)
+          raise
+        logging.warning('Provider request failed, retrying', exc_info=True)
+      else:
+        self._record_request(start, failed=resp.status_code >= 500)
+        if resp.status_code < 500 or attempt >= retries:
+          raise ndb.Return(resp)
+        logging.warning('Provider request failed (status: %d), retrying',
+                        resp.status_code)
+      attempt += 1
+      yield ndb.sleep(self._retry_delay(attempt))
+
+  @_tasklet
+  def _oauth2_request_tasklet(self, url, token, token_param='access_token'):
+    """Tasklet version of _oauth2_request(). Returns response body."""
+    target_url = url.format(urlencode({token_param: token}))
+    resp = yield self._fetch_async(target_url, retries=self.USER_INFO_RETRIES)
+    raise ndb.Return(resp.content)
@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+"""Per-provider circuit breaker.
+
+While a provider is down or slow, every login callback with it would wait
+on the provider and hold on to a request thread. CircuitBreaker tracks
+errors and slow responses of token and user info requests of each provider.
+Once too many of them fail, the provider's circuit opens and its logins
+fail fast with ProviderUnavailableError for open_for seconds. Then the
+circuit is half-open: one probe login is let through, which closes the
+circuit if its first request succeeds or opens it again if it fails.
+"""
+import collections
+import logging
+import threading
+import time
+
+__all__ = ['CircuitBreaker']
+
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+class _Circuit(object):
+  __slots__ = ('state', 'opened', 'probe', 'events', 'failures')
+
+  def __init__(self):
+    self.state = CLOSED
+    # when the circuit was last opened
+    self.opened = 0
+    # when the probe of a half-open circuit was let through, or None
+    self.probe = None
+    # (timestamp, failed) of recent requests
+    self.events = collections.deque()
+    self.failures = 0
+
+
+class CircuitBreaker(object):
+  """Opens a provider's circuit when its requests keep failing.
+
+  A request fails if it raises, gets a 5xx response or takes longer than
+  slow_call seconds. The circuit opens when at least min_requests were made
+  within the last window seconds and failure_rate of them failed.
+
+  A single instance is meant to be shared by the whole process, e.g.
+  SimpleAuthHandler.CIRCUIT_BREAKER. It is thread-safe.
+  """
+
+  def __init__(self, failure_rate=0.5, min_requests=10, window=60,
+               slow_call=5.0, open_for=30, max_events=1000):
+    """
+    Args:
+      failure_rate: float, share of failed requests which opens a circuit.
+      min_requests: int, requests within window needed to open a circuit.
+      window: int, seconds of requests failure rate is computed over.
+      slow_call: float, seconds after which a request counts as failed,
+                 or None.
+      open_for: int, seconds a circuit stays open before a probe is let
+                through. Also how long a probe may take before another one
+                is let through.
+      max_events: int, at most this many recent requests are kept per
+                  provider.
+    """
+    self.failure_rate = failure_rate
+    self.min_requests = min_requests
+    self.window = window
+    self.slow_call = slow_call
+    self.open_for = open_for
+    self.max_events = max_events
+    # provider: _Circuit
+    self._circuits = {}
+    self._lock = threading.Lock()
+
+  def allow(self, provider):
+    """Returns True if a login callback with provider may go ahead.
+
+    Lets one probe at a time through a half-open circuit.
+    """
+    c = self._circuits.get(provider)
+    if c is None or c.state == CLOSED:
+      return True
+    now = time.time()
+    with self._lock:
+      if c.state == OPEN:
+        if now - c.opened < self.open_for:
+          return False
+        c.state = HALF_OPEN
+        c.probe = None
+        logging.info('Circuit of %s is half-open', provider)
+      if c.state == HALF_OPEN:
+        if c.probe is not None and now - c.probe < self.open_for:
+          return False
+        c.probe = now
+      return True
+
+  def is_open(self, provider):
+    """Returns True if provider's circuit is open and not due for a probe.
+
+    Unlike allow(), this never lets a probe through, so it's suitable for
+    refusing to start new logins.
+    """
+    c = self._circuits.get(provider)
+    return (c is not None and c.state == OPEN and
+            time.time() - c.opened < self.open_for)
+
+  def state(self, provider):
+    """Returns 'closed', 'open' or 'half_open'."""
+    c = self._circuits.get(provider)
+    if c is None:
+      return CLOSED
+    return c.state
+
+  def record(self, provider, duration, failed=False):
+    """Records a request to provider.
+
+    Args:
+      provider: string, provider name.
+      duration: float, seconds the request took.
+      failed: bool, True if the request raised or got a 5xx response.
+    """
+    if self.slow_call is not None and duration > self.slow_call:
+      failed = True
+    now = time.time()
+    with self._lock:
+      c = self._circuits.get(provider)
+      if c is None:
+        c = self._circuits[provider] = _Circuit()
+      if c.state == HALF_OPEN:
+        if failed:
+          self._open(provider, c, now)
+        else:
+          self._close(provider, c)
+        return
+      if c.state == OPEN:
+        # a request which started before the circuit opened
+        return
+
+      c.events.append((now, failed))
+      c.failures += failed
+      cutoff = now - self.window
+      while c.events and (c.events[0][0] < cutoff or
+                          len(c.events) > self.max_events):
+        c.failures -= c.events.popleft()[1]
+      if (len(c.events) >= self.min_requests and
+          c.failures >= self.failure_rate * len(c.events)):
+        self._open(provider, c, now)
+
+  def clear(self):
+    with self._lock:
+      self._circuits.clear()
+
+  def _open(self, provider, c, now):
+    logging.warning('Circuit of %s is open', provider)
+    c.state = OPEN
+    c.opened = now
+    c.probe = None
+    c.events.clear()
+    c.failures = 0
+
+  def _close(self, provider, c):
+    logging.info('Circuit of %s is closed', provider)
+    c.state = CLOSED
+    c.probe = None
@@ -0,0 +1,257 @@
+# -*- coding: utf-8 -*-
+"""Bulk user info refresh.
+
+Apps which keep profiles of linked accounts up to date, e.g. names and
+avatars, re-fetch user info of many stored tokens at once. ProfileRefresher
+does it with a few worker threads, per-provider rate limits and Graph API
+batch requests for Facebook, while reading the tokens as a stream, so that
+memory use doesn't grow with the number of accounts.
+"""
+import collections
+import json
+import logging
+import threading
+import time
+
+from urllib import urlencode
+
+from handler import AuthProviderResponseError
+from lazy import LazyModule
+
+# only bulk jobs need it
+Queue = LazyModule('Queue')
+
+__all__ = ['ProfileRefresher', 'RateLimiter', 'RefreshResult']
+
+
+# Facebook Graph API takes at most 50 requests in a batch
+FACEBOOK_BATCH_SIZE = 50
+
+# One user info refresh. user_data is None if it failed with error.
+RefreshResult = collections.namedtuple(
+    'RefreshResult', ['provider', 'auth_info', 'user_data', 'error'])
+
+
+class RateLimiter(object):
+  """Token bucket which allows rate calls per second, and up to burst
+  calls at once after a pause. It is thread-safe.
+  """
+
+  def __init__(self, rate, burst=1):
+    self.rate = float(rate)
+    self.burst = burst
+    self._tokens = float(burst)
+    self._last = time.time()
+    self._lock = threading.Lock()
+
+  def acquire(self):
+    """Blocks until a call is allowed."""
+    while True:
+      with self._lock:
+        now = time.time()
+        self._tokens = min(self.burst,
+                           self._tokens + (now - self._last) * self.rate)
+        self._last = now
+        if self._tokens >= 1:
+          self._tokens -= 1
+          return
+        wait = (1 - self._tokens) / self.rate
+      time.sleep(wait)
+
+
+class ProfileRefresher(object):
+  """Fetches user info of many (provider, auth_info) pairs, e.g.
+
+    refresher = ProfileRefresher(AuthHandler(), concurrency=10,
+                                 rate_limits={'google': 20, '*': 5})
+    for result in refresher.refresh(linked_accounts()):
+      ...
+
+  Each pair is fetched with provider's user info method, the same as on
+  sign in, except for providers in BATCH_FETCHERS, whose pairs are grouped
+  and fetched batch_size at a time. Results are yielded as RefreshResult
+  in the order they complete, not in the order of pairs.
+
+  At most concurrency requests are in flight and only as many pairs are
+  read ahead, plus a partial batch of each batch provider.
+  """
+
+  # Providers with a batch endpoint. Maps provider name to a method which
+  # takes provider name and a list of auth_info dicts, and returns a list
+  # of the same length of user_data dicts or exceptions.
+  BATCH_FETCHERS = {
+    'facebook': '_fetch_facebook_batch',
+  }
+
+  def __init__(self, handler, concurrency=10, rate_limits=None,
+               batch_size=FACEBOOK_BATCH_SIZE):
+    """
+    Args:
+      handler: SimpleAuthHandler instance whose providers and
+               transport are used. It needs no request.
+      concurrency: int, number of worker threads.
+      rate_limits: dict of provider name to max requests per second, or
+                   to a RateLimiter. Other providers get the '*' rate
+                   each, if it's set. A batch is one request.
+      batch_size: int, max pairs in a batch request.
+    """
+    self.handler = handler
+    self.concurrency = concurrency
+    self.batch_size = batch_size
+    rate_limits = dict(rate_limits or {})
+    self._default_rate = rate_limits.pop('*', None)
+    self._limiters = {}
+    for provider, limit in rate_limits.items():
+      if not isinstance(limit, RateLimiter):
+        limit = RateLimiter(limit)
+      self._limiters[provider] = limit
+    self._lock = threading.Lock()
+
+  def refresh(self, pairs):
+    """Yields a RefreshResult of each (provider, auth_info) pair of pairs,
+    which can be any iterable, e.g. a query. It is read in the calling
+    thread only.
+    """
+    jobs = Queue.Queue()
+    results = Queue.Queue()
+    workers = [threading.Thread(target=self._work, args=(jobs, results))
+               for _ in range(self.concurrency)]
+    for w in workers:
+      w.daemon = True
+      w.start()
+
+    # provider: list of auth_info waiting for a full batch
+    batches = {}
+    pairs = iter(pairs)
+    in_flight = 0
+    try:
+      while True:
+        while pairs is not None and in_flight < self.concurrency:
+          try:
+            provider, auth_info = next(pairs)
+          except StopIteration:
+            pairs = None
+            for provider, batch in batches.items():
+              jobs.put((provider, batch))
+              in_flight += 1
+            break
+          if provider not in self.BATCH_FETCHERS:
+            jobs.put((provider, auth_info))
+            in_flight += 1
+            continue
+          batch = batches.setdefault(provider, [])
+          batch.append(auth_info)
+          if len(batch) >= self.batch_size:
+            jobs.put((provider, batches.pop(provider)))
+            in_flight += 1
+
+        if not in_flight:
+          return
+        for result in results.get():
+          yield result
+        in_flight -= 1
+    finally:
+      for _ in workers:
+        jobs.put(None)
+
+  def _work(self, jobs, results):
+    for provider, job in iter(jobs.get, None):
+      if isinstance(job, list):
+        results.put(self._fetch_batch(provider, job))
+      else:
+        results.put([self._fetch(provider, job)])
+
+  def _fetch(self, provider, auth_info):
+    """Returns a RefreshResult of a single user info fetch."""
+    try:
+      fetcher = self.handler._provider(provider).fetcher
+      if fetcher is None:
+        raise ValueError('%s has no user info to refresh' % provider)
+      key, secret = self._consumer_info(provider)
+      self._acquire(provider)
+      user_data = fetcher(self.handler, auth_info, key=key, secret=secret)
+      if hasattr(user_data, 'get_result'):
+        # a tasklet of AsyncSimpleAuthHandler
+        user_data = user_data.get_result()
+    except Exception as e:
+      logging.warning('Failed to refresh %s user info: %s', provider, e)
+      return RefreshResult(provider, auth_info, None, e)
+    return RefreshResult(provider, auth_info, user_data, None)
+
+  def _fetch_batch(self, provider, batch):
+    """Returns a list of RefreshResult of a batch of auth_info dicts."""
+    try:
+      self._acquire(provider)
+      fetched = getattr(self, self.BATCH_FETCHERS[provider])(provider, batch)
+    except Exception as e:
+      logging.warning('Failed to refresh %s user info batch: %s', provider, e)
+      fetched = [e] * len(batch)
+
+    results = []
+    for auth_info, user_data in zip(batch, fetched):
+      if isinstance(user_data, Exception):
+        results.append(RefreshResult(provider, auth_info, None, user_data))
+      else:
+        results.append(RefreshResult(provider, auth_info, user_data, None))
+    return results
+
+  def _fetch_facebook_batch(self, provider, batch):
+    """Graph API batch request of each user's /me, authorized with
+    the app access token.
+    https://developers.facebook.com/docs/graph-api/batch-requests
+    """
+    url = self.handler._user_info_url('me?{0}', provider)
+    requests = [
+      {'method': 'GET',
+       'relative_url': url.format(urlencode(
+           {'access_token': auth_info['access_token']}))}
+      for auth_info in batch]
+    key, secret = self._consumer_info(provider)
+    payload = urlencode({
+      'access_token': '%s|%s' % (key, secret),
+      'batch': json.dumps(requests, separators=(',', ':')),
+      'include_headers': 'false',
+    })
+    resp = self.handler._send(
+        self.handler.TRANSPORT.fetch,
+        retries=self.handler.USER_INFO_RETRIES,
+        url='https://graph.facebook.com/',
+        payload=payload,
+        method='POST',
+        headers={'Content-Type': 'application/x-www-form-urlencoded'})
+    if resp.status_code != 200:
+      raise AuthProviderResponseError(
+          '%s (status: %d)' % (resp.content, resp.status_code), provider)
+
+    items = json.loads(resp.content)
+    if len(items) != len(batch):
+      raise AuthProviderResponseError(
+          'Expected %d batch responses, got %d' % (len(batch), len(items)),
+          provider)
+
+    fetched = []
+    for item in items:
+      if item is None:
+        # the batch took too long and this request wasn't made
+        fetched.append(AuthProviderResponseError('Timed out', provider))
+      elif item.get('code') != 200:
+        fetched.append(AuthProviderResponseError(
+            '%s (status: %s)' % (item.get('body'), item.get('code')),
+            provider))
+      else:
+        fetched.append(json.loads(item['body']))
+    return fetched
+
+  def _consumer_info(self, provider):
+    info = self.handler._get_consumer_info_for(provider)
+    return info[0], info[1]
+
+  def _acquire(self, provider):
+    limiter = self._limiters.get(provider)
+    if limiter is None:
+      if self._default_rate is None:
+        return
+      with self._lock:
+        limiter = self._limiters.setdefault(
+            provider, RateLimiter(self._default_rate))
+    limiter.acquire()
@@ -0,0 +1,220 @@
+# -*- coding: utf-8 -*-
+"""Cache backends.
+
+All backends have the same interface: get(key), set(key, value, ttl=None),
+add(key, value, ttl=None) and delete(key). get() returns None on a miss.
+Each backend instance counts its hits and misses.
+"""
+import collections
+import threading
+import time
+
+from lazy import LazyModule
+
+# imported on first use of MemcacheCache or DatastoreCache
+memcache = LazyModule('google.appengine.api.memcache')
+ndb = LazyModule('google.appengine.ext.ndb')
+
+__all__ = ['Cache',
+           'LRUCache',
+           'MemcacheCache',
+           'DatastoreCache']
+
+
+class Cache(object):
+  """Base class for cache backends."""
+
+  def __init__(self, ttl=None):
+    """
+    Args:
+      ttl: int, default time to live in seconds. None means no expiration.
+    """
+    self.ttl = ttl
+    self.hits = 0
+    self.misses = 0
+
+  def get(self, key):
+    """Returns a cached value or None."""
+    raise NotImplementedError
+
+  def set(self, key, value, ttl=None):
+    """Caches a value. ttl overrides the default time to live."""
+    raise NotImplementedError
+
+  def add(self, key, value, ttl=None):
+    """Caches a value unless key is already cached. Returns True if it
+    was added.
+
+    The default implementation isn't atomic. Backends override it where
+    the storage can do better.
+    """
+    if self.get(key) is not None:
+      return False
+    self.set(key, value, ttl=ttl)
+    return True
+
+  def delete(self, key):
+    raise NotImplementedError
+
+  def stats(self):
+    """Returns a dict of hits and misses counters."""
+    return {'hits': self.hits, 'misses': self.misses}
+
+  def _count(self, value):
+    if value is None:
+      self.misses += 1
+    else:
+      self.hits += 1
+    return value
+
+
+class LRUCache(Cache):
+  """In-memory, per process cache.
+
+  Least recently used items are evicted once there are more than max_size
+  of them. Thread-safe.
+  """
+
+  def __init__(self, max_size=1024, ttl=None):
+    super(LRUCache, self).__init__(ttl)
+    self.max_size = max_size
+    self._items = collections.OrderedDict()
+    self._lock = threading.Lock()
+
+  def get(self, key):
+    with self._lock:
+      item = self._items.pop(key, None)
+      if item is None:
+        return self._count(None)
+      expires, value = item
+      if expires is not None and expires <= time.time():
+        return self._count(None)
+      # most recently used items are at the end
+      self._items[key] = item
+      return self._count(value)
+
+  def set(self, key, value, ttl=None):
+    with self._lock:
+      self._put(key, value, ttl)
+
+  def add(self, key, value, ttl=None):
+    with self._lock:
+      item = self._items.get(key)
+      if item is not None and (item[0] is None or item[0] > time.time()):
+        return False
+      self._put(key, value, ttl)
+      return True
+
+  def delete(self, key):
+    with self._lock:
+      self._items.pop(key, None)
+
+  def clear(self):
+    with self._lock:
+      self._items.clear()
+
+  def keys(self):
+    """Returns a list of cached keys, least recently used first."""
+    with self._lock:
+      return self._items.keys()
+
+  def _put(self, key, value, ttl):
+    """Caches a value. Must be called with the lock held."""
+    if ttl is None:
+      ttl = self.ttl
+    expires = None
+    if ttl:
+      expires = time.time() + ttl
+    self._items.pop(key, None)
+    self._items[key] = (expires, value)
+    while len(self._items) > self.max_size:
+      self._items.popitem(last=False)
+
+  def __len__(self):
+    return len(self._items)
+
+
+class MemcacheCache(Cache):
+  """App Engine memcache backed cache, shared by all instances of the app.
+
+  Values must be picklable.
+  """
+
+  def __init__(self, namespace='simpleauth', ttl=None):
+    super(MemcacheCache, self).__init__(ttl)
+    self.namespace = namespace
+
+  def get(self, key):
+    return self._count(memcache.get(key, namespace=self.namespace))
+
+  def set(self, key, value, ttl=None):
+    if ttl is None:
+      ttl = self.ttl
+    memcache.set(key, value, time=ttl or 0, namespace=self.namespace)
+
+  def add(self, key, value, ttl=None):
+    if ttl is None:
+      ttl = self.ttl
+    return memcache.add(key, value, time=ttl or 0, namespace=self.namespace)
+
+  def delete(self, key):
+    memcache.delete(key, namespace=self.namespace)
+
+
+_CACHE_ENTRY = None
+
+
+def _cache_entry():
+  """Returns the DatastoreCache entry model, defined on first use so that
+  ndb isn't imported before it's needed.
+  """
+  global _CACHE_ENTRY
+  if _CACHE_ENTRY is None:
+    class _CacheEntry(ndb.Model):
+      """DatastoreCache entry. Entity key name is the cache key."""
+      value = ndb.PickleProperty()
+      expires = ndb.FloatProperty()
+
+      @classmethod
+      def _get_kind(cls):
+        return 'SimpleAuthCache'
+
+    _CACHE_ENTRY = _CacheEntry
+  return _CACHE_ENTRY
+
+
+class DatastoreCache(Cache):
+  """Datastore backed cache, for values which must not be lost to memcache
+  evictions. Values must be picklable.
+
+  Expired entries are deleted when read. Call purge() periodically, e.g.
+  from a cron handler, to delete those which are never read.
+  """
+
+  def get(self, key):
+    entry = _cache_entry().get_by_id(key)
+    if entry is None:
+      return self._count(None)
+    if entry.expires is not None and entry.expires <= time.time():
+      entry.key.delete()
+      return self._count(None)
+    return self._count(entry.value)
+
+  def set(self, key, value, ttl=None):
+    if ttl is None:
+      ttl = self.ttl
+    expires = None
+    if ttl:
+      expires = time.time() + ttl
+    _cache_entry()(id=key, value=value, expires=expires).put()
+
+  def delete(self, key):
+    ndb.Key(_cache_entry(), key).delete()
+
+  def purge(self, limit=500):
+    """Deletes up to limit expired entries. Returns number of deleted."""
+    entry = _cache_entry()
+    query = entry.query(entry.expires < time.time())
+    keys = query.fetch(limit, keys_only=True)
+    ndb.delete_multi(keys)
+    return len(keys)
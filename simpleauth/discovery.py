@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+"""OpenID Connect discovery.
+
+Providers of 'oidc' type are configured with just an issuer URL, e.g.
+https://accounts.google.com. Their endpoints and public keys URL are read
+from the issuer's /.well-known/openid-configuration document, which is
+fetched on first use and then served from memory.
+"""
+import json
+import logging
+import threading
+import time
+
+__all__ = ['DiscoveryError',
+           'DiscoveryCache']
+
+
+# Discovery document fields a provider can't be used without
+REQUIRED_FIELDS = ('issuer', 'authorization_endpoint', 'token_endpoint',
+                   'jwks_uri')
+
+WELL_KNOWN_PATH = '/.well-known/openid-configuration'
+
+
+class DiscoveryError(ValueError):
+  """Raised when a discovery document can't be fetched or is invalid."""
+  pass
+
+
+class DiscoveryCache(object):
+  """Caches discovery documents of OpenID Connect issuers.
+
+  Documents are kept in memory for ttl seconds. If store is set, e.g.
+  cache.MemcacheCache(), they are also shared with other app instances,
+  so that a new instance doesn't have to fetch them from the provider.
+
+  A single instance is meant to be shared by the whole process, e.g.
+  SimpleAuthHandler.OIDC_DISCOVERY. It is thread-safe.
+  """
+
+  def __init__(self, ttl=86400, store=None):
+    """
+    Args:
+      ttl: int, seconds a document is kept.
+      store: cache.Cache backend shared by app instances, or None.
+    """
+    self.ttl = ttl
+    self.store = store
+    # issuer: (expires, document)
+    self._documents = {}
+    self._lock = threading.Lock()
+
+  def get(self, issuer, transport):
+    """Returns discovery document of issuer as a dict.
+
+    The document is fetched with transport if it is neither in memory
+    nor in the store, or has expired.
+
+    Raises DiscoveryError.
+    """
+    item = self._documents.get(issuer)
+    if item is not None and time.time() < item[0]:
+      return item[1]
+
+    doc = None
+    if self.store is not None:
+      doc = self.store.get(self._store_key(issuer))
+    if doc is None:
+      doc = self.fetch(issuer, transport)
+      if self.store is not None:
+        self.store.set(self._store_key(issuer), doc, ttl=self.ttl)
+
+    with self._lock:
+      self._documents[issuer] = (time.time() + self.ttl, doc)
+    return doc
+
+  def fetch(self, issuer, transport):
+    """Fetches and validates discovery document of issuer.
+
+    Raises DiscoveryError.
+    """
+    url = issuer.rstrip('/') + WELL_KNOWN_PATH
+    try:
+      resp = transport.fetch(url)
+    except Exception as e:
+      raise DiscoveryError('Could not fetch %s: %s' % (url, e))
+    if resp.status_code != 200:
+      raise DiscoveryError('Could not fetch %s (status: %d)' % (
+          url, resp.status_code))
+    try:
+      doc = json.loads(resp.content)
+    except ValueError as e:
+      raise DiscoveryError('Invalid discovery document %s: %s' % (url, e))
+    if not isinstance(doc, dict):
+      raise DiscoveryError('Invalid discovery document %s' % url)
+
+    missing = [f for f in REQUIRED_FIELDS if not doc.get(f)]
+    if missing:
+      raise DiscoveryError('Discovery document %s has no %s' % (
+          url, ', '.join(missing)))
+    # OpenID Connect Discovery 1.0, section 4.3
+    if doc['issuer'].rstrip('/') != issuer.rstrip('/'):
+      raise DiscoveryError('Issuer mismatch: %s vs %s' % (
+          doc['issuer'], issuer))
+    logging.debug('Fetched discovery document of %s', issuer)
+    return doc
+
+  def clear(self):
+    with self._lock:
+      self._documents.clear()
+
+  def _store_key(self, issuer):
+    return 'oidc_discovery:%s' % issuer
@@ -3,6 +3,11 @@ import os
 import sys
 import logging
 import json
+import copy
+import hashlib
+import hmac
+import collections
+import random
 
 from urllib import urlencode
 import urlparse
@@ -23,12 +28,28 @@ except ImportError:
     # at this point ImportError will be raised
     # if none of the above could be imported
 
-# it's a OAuth 1.0 spec even though the lib is called oauth2
-import oauth2 as oauth1
+from cStringIO import StringIO
+
+from lazy import LazyModule
 
+# Dependencies of some of the providers only are imported on first use.
+#
+# lxml is one of the third party libs available on App Engine out of the
+# box. See example/app.yaml for more info.
+etree = LazyModule('lxml.etree', 'xml.etree.cElementTree',
+                   'xml.etree.ElementTree')
+# it's a OAuth 1.0 spec even though the lib is called oauth2
+oauth1 = LazyModule('oauth2')
 # users module is needed for OpenID authentication.
-from google.appengine.api import urlfetch, users
-from webapp2_extras import security
+users = LazyModule('google.appengine.api.users')
+security = LazyModule('webapp2_extras.security')
+
+from transport import OAuth1Client, TransportError, URLFetchTransport
+from tracing import NullTracer
+from keys import KeyManager
+from discovery import DiscoveryCache, DiscoveryError
+from singleflight import DuplicateCallError
+import idtoken
 
 __all__ = ['SimpleAuthHandler',
            'Error',
@@ -36,12 +57,37 @@ __all__ = ['SimpleAuthHandler',
            'AuthProviderResponseError',
            'InvalidCSRFTokenError',
            'InvalidOAuthRequestToken',
-           'InvalidOpenIDUserError']
+           'InvalidOpenIDUserError',
+           'InvalidIdTokenError',
+           'ProviderUnavailableError',
+           'GOOGLE_OIDC']
 
 
 OAUTH1 = 'oauth1'
 OAUTH2 = 'oauth2'
 OPENID = 'openid'
+OIDC = 'oidc'
+
+# OIDC_ID_TOKEN config of Google
+GOOGLE_OIDC = {
+  'jwks_uri': 'https://www.googleapis.com/oauth2/v3/certs',
+  'issuers': ('https://accounts.google.com', 'accounts.google.com'),
+}
+
+# JWT claims which are not about the user and are left out of user info
+# made of an ID token
+_ID_TOKEN_CLAIMS = frozenset(['iss', 'aud', 'azp', 'exp', 'iat', 'nbf',
+                              'auth_time', 'nonce', 'at_hash', 'c_hash',
+                              'jti', 'acr', 'amr'])
+
+# LinkedIn profile fields requested by both LinkedIn providers
+LINKEDIN_FIELDS = ('id', 'first-name', 'last-name', 'picture-url',
+                   'public-profile-url', 'headline')
+
+# XML user info documents smaller than this are parsed into a tree at once:
+# parsers read input in chunks of 16-32K anyway, so stopping early saves
+# nothing on them. See bench/xml_bench.py.
+XML_STREAM_MIN_SIZE = 128 * 1024
 
 
 class Error(Exception):
@@ -68,6 +114,43 @@ class InvalidOpenIDUserError(Error):
   """Error during OpenID auth callback"""
   pass
 
+class InvalidIdTokenError(Error):
+  """OpenID Connect ID token could not be verified"""
+  pass
+
+class ProviderUnavailableError(Error):
+  """Provider's circuit is open: its requests have been failing lately"""
+  pass
+
+
+# Shared OAuth 1.0 signing clients, keyed by (consumer key, consumer secret,
+# transport). See SimpleAuthHandler._oauth1_client().
+_OAUTH1_CLIENTS = {}
+
+
+# A provider resolved from PROVIDERS and TOKEN_RESPONSE_PARSERS.
+# init, callback, parser and fetcher are handler methods, called with
+# the handler instance as the first arg. parser and fetcher are None
+# for OpenID. init_arg and callback_arg of OpenID Connect providers
+# are the issuer URL.
+Provider = collections.namedtuple('Provider', [
+    'name', 'auth_type', 'init', 'init_arg', 'callback', 'callback_arg',
+    'parser', 'fetcher'])
+
+
+class ProviderRegistry(type):
+  """Metaclass which resolves each of the handler PROVIDERS into a Provider
+  record once, when the class is created.
+
+  A misconfigured provider, e.g. one without a token response parser
+  or user info method, raises UnknownAuthMethodError at import time.
+  """
+
+  def __init__(cls, name, bases, attrs):
+    super(ProviderRegistry, cls).__init__(name, bases, attrs)
+    cls._providers = dict((p, cls._build_provider(p, cfg))
+                          for p, cfg in cls.PROVIDERS.items())
+
 
 class SimpleAuthHandler(object):
   """A mixin to be used with a real request handler,
@@ -77,6 +160,8 @@ class SimpleAuthHandler(object):
   See README for docs on authentication flows.
   """
 
+  __metaclass__ = ProviderRegistry
+
   PROVIDERS = {
     # OAuth 2.0 providers
     'google': (OAUTH2,
@@ -124,6 +209,11 @@ class SimpleAuthHandler(object):
     'twitter': '_query_string_parser'
   }
 
+  # Suffix of the methods each provider resolves to, i.e.
+  # _<authtype>_init, _<authtype>_callback and _get_<provider>_user_info.
+  # AsyncSimpleAuthHandler sets it to '_async'.
+  AUTH_METHOD_SUFFIX = ''
+
   # Set this to True in your handler if you want to use
   # 'state' param during authorization phase to guard agains
   # cross-site-request-forgery
@@ -138,16 +228,262 @@ class SimpleAuthHandler(object):
   # You don't normally need to override it.
   OAUTH2_CSRF_DELIMITER = ':'
 
+  # Set this to a long random string to use stateless CSRF tokens instead
+  # of storing them in self.session. Tokens are then HMAC-signed and
+  # bound to a per-browser cookie, so that neither init nor callback step
+  # need to load or save a session.
+  OAUTH2_CSRF_SECRET = None
+  OAUTH2_CSRF_COOKIE = 'simpleauth_csrf'
+
+  # Where OAuth 1.0a request tokens are kept between init and callback.
+  # None means self.session, which grows session cookies.
+  # Set it to a cache backend, e.g. cache.MemcacheCache(), to keep them
+  # server-side instead, keyed by the oauth_token provider calls back with
+  # and bound to the browser's OAUTH2_CSRF_COOKIE, which is set if missing.
+  # The store has to be shared by all app instances, so LRUCache is only
+  # good for local development.
+  OAUTH1_REQUEST_TOKEN_STORE = None
+  OAUTH1_REQUEST_TOKEN_TIMEOUT = 600 # 10 min
+
   # Extra params passed to OAuth2 init handler are stored in the state
   # under this name.
   OAUTH2_STATE_EXTRA_PARAM = 'extra'
 
+  # Set this to a state.StateCodec() to send a compressed, optionally
+  # encrypted state instead of plain JSON. States over the codec size
+  # budget are kept in its store and only a reference is sent to provider.
+  # Plain JSON states are still accepted on callback.
+  OAUTH2_STATE_CODEC = None
+
+  # HTTP transport used for all requests to auth providers. It is shared
+  # by all handler instances, i.e. the whole process.
+  # Set it to transport.PooledTransport() to reuse keep-alive connections
+  # to provider hosts across requests.
+  TRANSPORT = URLFetchTransport()
+
+  # Seconds the callback step of a login, i.e. the token exchange and user
+  # info requests together, may take per provider. '*' applies to providers
+  # which aren't listed, e.g.
+  #
+  # CALLBACK_DEADLINES = {'*': 10, 'foursquare': 5}
+  #
+  # Each request gets the time left as its deadline, and once it's over
+  # AuthProviderResponseError is raised. Empty by default, i.e. requests
+  # get the transport's default deadline.
+  CALLBACK_DEADLINES = {}
+
+  # How many times user info GETs are retried on errors and 5xx responses,
+  # as long as the callback deadline allows. Retries wait a random time
+  # between half and all of RETRY_DELAY seconds, doubled on each attempt.
+  # Token requests are never retried.
+  USER_INFO_RETRIES = 0
+  RETRY_DELAY = 0.1
+
+  # Set to breaker.CircuitBreaker() to stop waiting on a provider whose
+  # requests keep failing or are too slow: its logins then fail fast with
+  # ProviderUnavailableError until a probe login succeeds again. Shared by
+  # all handler instances. See _check_circuit().
+  CIRCUIT_BREAKER = None
+
+  # Set to singleflight.SingleFlight() to coalesce duplicate OAuth 2.0
+  # callbacks, e.g. of double-clicks or browser retries: callbacks from
+  # the same browser with the same provider, authorization code and state
+  # wait for the first one's token exchange and user info fetch and get its
+  # result, rather than each exchanging the code, which the provider only
+  # accepts once. Shared by all handler instances. Keep ttl at 0, or a few
+  # seconds at most. With SingleFlight(store=MemcacheCache()) duplicates
+  # handled by other app instances wait too, and then fail with
+  # AuthProviderResponseError: results are never stored.
+  CALLBACK_SINGLEFLIGHT = None
+
+  # Set to tokens.TokenManager() to keep OAuth 2.0 access tokens of signed
+  # in users fresh: tokens of each callback are stored by provider's user ID,
+  # and _get_access_token() returns a valid one, refreshed with the refresh
+  # token ahead of expiry, in the request unless the manager is created with
+  # background=True. Shared by all handler instances.
+  # Use TokenManager(store=DatastoreCache()) so that tokens survive instance
+  # restarts.
+  TOKEN_MANAGER = None
+
+  # Receives timings of each phase of the auth flow, see tracing module.
+  # E.g. tracing.LoggingTracer() or tracing.StatsdTracer(statsd_client).
+  TRACER = NullTracer()
+
+  # OAuth 2.0 providers whose user info is read from the OpenID Connect
+  # id_token of the token response, verified locally with provider's public
+  # keys, instead of being fetched from the provider. Maps provider name
+  # to a dict of 'jwks_uri' and 'issuers', e.g.
+  #
+  # OIDC_ID_TOKEN = {'google': GOOGLE_OIDC}
+  #
+  # The scope must include 'openid', otherwise there's no id_token and
+  # user info is fetched as usual. Google includes name and picture in
+  # id_token only if the scope has 'profile'.
+  OIDC_ID_TOKEN = {}
+  # Caches provider public keys. Shared by all handler instances.
+  KEY_MANAGER = KeyManager()
+
+  # Caches discovery documents of 'oidc' providers, e.g.
+  #
+  # PROVIDERS = {'google': ('oidc', 'https://accounts.google.com')}
+  #
+  # Shared by all handler instances. Use DiscoveryCache(store=MemcacheCache())
+  # to share documents with other app instances too.
+  # User info of 'oidc' providers is read from the verified id_token,
+  # if there is one. Set OIDC_USE_ID_TOKEN to False to always fetch it
+  # from the userinfo endpoint.
+  OIDC_DISCOVERY = DiscoveryCache()
+  OIDC_USE_ID_TOKEN = True
+
+  # Secondary user info lookups made concurrently with the profile fetch,
+  # once OAuth 2.0 access token is obtained. Maps provider name to a dict
+  # of {user_data_key: url}. url must have a {0} placeholder for the access
+  # token query param. It can also be a (url, token_param) tuple if
+  # the provider doesn't use 'access_token' param name. E.g.
+  #
+  # OAUTH2_USER_INFO_EXTRAS = {
+  #   'facebook': {
+  #     'picture': 'https://graph.facebook.com/me/picture?redirect=0&{0}'
+  #   }
+  # }
+  #
+  # Responses are parsed as JSON and stored in user_data dict under
+  # user_data_key. Failed lookups are logged and left out.
+  OAUTH2_USER_INFO_EXTRAS = {}
+
+  # User profile fields to request from providers which can leave the rest
+  # out of their responses, e.g.
+  #
+  # USER_INFO_FIELDS = {
+  #   'facebook': ('name', 'link'),
+  #   'linkedin2': ('first-name', 'picture-url'),
+  # }
+  #
+  # Sent as Graph API fields= param to facebook, partial response fields=
+  # param to google and googleplus, and as field selectors to linkedin and
+  # linkedin2, which otherwise get LINKEDIN_FIELDS. 'id' is always
+  # requested. Other providers get their default profile.
+  USER_INFO_FIELDS = {}
+
+  # Cache of _get_<provider>_user_info() results keyed by access token,
+  # e.g. cache.LRUCache(max_size=1000, ttl=300) for a per-process cache
+  # or cache.MemcacheCache(ttl=300). Disabled by default.
+  USER_INFO_CACHE = None
+
+  # (provider, expiry timestamp) of the callback being handled, or None
+  _deadline = None
+  # Provider of the init or callback step being handled, or None
+  _active_provider = None
+
+  @classmethod
+  def register_provider(cls, name, config, parser=None):
+    """Adds a new provider or replaces an existing one on this class.
+
+    Subclasses created before the call are not affected. Normally, you'd
+    just define PROVIDERS and TOKEN_RESPONSE_PARSERS in the class body.
+
+    Args:
+      name: string, provider name as used in /auth/<provider> URLs.
+      config: tuple, same as PROVIDERS dict values.
+      parser: string, name of the token response parser method.
+              Required for OAuth 1.0 and 2.0.
+    """
+    # work on copies to keep parent classes intact
+    parsers = cls.TOKEN_RESPONSE_PARSERS
+    if parser is not None:
+      parsers = dict(parsers)
+      parsers[name] = parser
+
+    saved_parsers = cls.TOKEN_RESPONSE_PARSERS
+    cls.TOKEN_RESPONSE_PARSERS = parsers
+    try:
+      record = cls._build_provider(name, config)
+    except UnknownAuthMethodError:
+      cls.TOKEN_RESPONSE_PARSERS = saved_parsers
+      raise
+
+    cls.PROVIDERS = dict(cls.PROVIDERS)
+    cls.PROVIDERS[name] = config
+    cls._providers = dict(cls._providers)
+    cls._providers[name] = record
+
+  @classmethod
+  def _build_provider(cls, name, config):
+    """Resolves provider config and methods into a Provider record.
+
+    Raises UnknownAuthMethodError if a method is missing.
+    """
+    auth_type = config[0]
+
+    def resolve(method):
+      method += cls.AUTH_METHOD_SUFFIX
+      try:
+        return getattr(cls, method)
+      except AttributeError:
+        raise UnknownAuthMethodError('%s (provider: %s)' % (method, name))
+
+    init = resolve('_%s_init' % auth_type)
+    callback = resolve('_%s_callback' % auth_type)
+    parser = fetcher = None
+
+    if auth_type == OIDC:
+      # token responses are JSON, user info endpoint is discovered
+      parser_name = cls.TOKEN_RESPONSE_PARSERS.get(name, '_json_parser')
+      if not hasattr(cls, parser_name):
+        raise UnknownAuthMethodError(
+            'Token response parser %s (provider: %s)' % (parser_name, name))
+      parser = getattr(cls, parser_name)
+      method = '_get_%s_user_info%s' % (name, cls.AUTH_METHOD_SUFFIX)
+      if hasattr(cls, method):
+        fetcher = getattr(cls, method)
+      else:
+        fetcher = cls._oidc_fetcher(name, resolve('_get_oidc_user_info'))
+      if not urlparse.urlsplit(config[1] or '').netloc:
+        raise UnknownAuthMethodError(
+            'Invalid issuer URL: %s (provider: %s)' % (config[1], name))
+
+    elif auth_type in (OAUTH1, OAUTH2):
+      parser_name = cls.TOKEN_RESPONSE_PARSERS.get(name)
+      if not parser_name or not hasattr(cls, parser_name):
+        raise UnknownAuthMethodError(
+            'Token response parser %s (provider: %s)' % (parser_name, name))
+      parser = getattr(cls, parser_name)
+      fetcher = resolve('_get_%s_user_info' % name)
+
+      auth_url = config[1]
+      if auth_type == OAUTH1:
+        if not auth_url.get('request'):
+          raise UnknownAuthMethodError(
+              'No request token URL (provider: %s)' % name)
+        auth_url = auth_url.get('auth', '')
+      if '{0}' not in auth_url:
+        raise UnknownAuthMethodError(
+            'Authorization URL has no {0} placeholder: %s (provider: %s)' % (
+              auth_url, name))
+
+    return Provider(name, auth_type, init, config[1], callback, config[-1],
+                    parser, fetcher)
+
+  @classmethod
+  def _oidc_fetcher(cls, name, get_user_info):
+    """Returns a fetcher which calls _get_oidc_user_info() for provider."""
+    def fetcher(handler, auth_info, key=None, secret=None):
+      return get_user_info(handler, name, auth_info, key=key, secret=secret)
+    return fetcher
+
+  def _provider(self, name):
+    """Returns a Provider record or raises UnknownAuthMethodError."""
+    try:
+      return self._providers[name]
+    except KeyError:
+      raise UnknownAuthMethodError('Unknown provider: %s' % name)
+
   def _simple_auth(self, provider=None):
     """Dispatcher of auth init requests, e.g.
     GET /auth/PROVIDER
 
     Calls _<authtype>_init() method, where <authtype> is
-    oauth2, oauth1 or openid (defined in PROVIDERS dict).
+    oauth2, oauth1, oidc or openid (defined in PROVIDERS dict).
 
     May raise one of the exceptions defined at the beginning
     of the module. See README for details on error handling.
@@ -156,27 +492,38 @@ class SimpleAuthHandler(object):
     if self.request is not None and self.request.params is not None:
       extra = self.request.params.items()
 
-    cfg = self.PROVIDERS.get(provider, (None,))
-    meth = self._auth_method(cfg[0], 'init')
+    p = self._provider(provider)
+    self._check_circuit(provider, 'init')
     # We don't respond directly in here. Specific methods are in charge
     # with redirecting user to an auth endpoint
-    meth(provider, cfg[1], extra)
+    self._active_provider = provider
+    try:
+      with self.TRACER.span(provider, 'init'):
+        p.init(self, provider, p.init_arg, extra)
+    finally:
+      self._active_provider = None
 
   def _auth_callback(self, provider=None):
     """Dispatcher of callbacks from auth providers, e.g.
     /auth/PROVIDER/callback?params=...
 
     Calls _<authtype>_callback() method, where <authtype> is
-    oauth2, oauth1 or openid (defined in PROVIDERS dict).
+    oauth2, oauth1, oidc or openid (defined in PROVIDERS dict).
 
     May raise one of the exceptions defined at the beginning
     of the module. See README for details on error handling.
     """
-    cfg = self.PROVIDERS.get(provider, (None,))
-    meth = self._auth_method(cfg[0], 'callback')
+    p = self._provider(provider)
 
     # Get user profile data and their access token
-    result = meth(provider, *cfg[-1:])
+    self._check_circuit(provider, 'callback')
+    self._active_provider = provider
+    self._deadline = self._callback_deadline(provider)
+    try:
+      with self.TRACER.span(provider, 'callback'):
+        result = p.callback(self, provider, p.callback_arg)
+    finally:
+      self._active_provider = self._deadline = None
     user_data, auth_info = result[0], result[1]
 
     extra = None
@@ -184,23 +531,8 @@ class SimpleAuthHandler(object):
       extra = result[2]
 
     # The rest should be implemented by the actual app
-    self._on_signin(user_data, auth_info, provider, extra=extra)
-
-  def _auth_method(self, auth_type, step):
-    """Constructs proper method name and returns a callable.
-
-    Args:
-      auth_type: string, One of 'oauth2', 'oauth1' or 'openid'
-      step: string, Phase of the auth flow. Either 'init' or 'callback'
-
-    Raises UnknownAuthMethodError if expected method doesn't exist on the
-    handler instance processing the request.
-    """
-    method = '_%s_%s' % (auth_type, step)
-    try:
-      return getattr(self, method)
-    except AttributeError:
-      raise UnknownAuthMethodError(method)
+    with self.TRACER.span(provider, 'signin'):
+      self._on_signin(user_data, auth_info, provider, extra=extra)
 
   def _oauth2_init(self, provider, auth_url, extra=None):
     """Initiates OAuth 2.0 web flow"""
@@ -223,12 +555,13 @@ class SimpleAuthHandler(object):
     if self.OAUTH2_CSRF_STATE:
       csrf_token = self._generate_csrf_token()
       state_params[self.OAUTH2_CSRF_STATE_PARAM] = csrf_token
-      self.session[self.OAUTH2_CSRF_SESSION_PARAM] = csrf_token
+      if not self.OAUTH2_CSRF_SECRET:
+        self.session[self.OAUTH2_CSRF_SESSION_PARAM] = csrf_token
     if extra is not None:
       state_params[self.OAUTH2_STATE_EXTRA_PARAM] = extra
 
     if len(state_params):
-      params.update(state=json.dumps(state_params))
+      params.update(state=self._encode_oauth2_state(state_params))
 
     target_url = auth_url.format(urlencode(params))
     logging.debug('Redirecting user to %s', target_url)
@@ -237,6 +570,48 @@ class SimpleAuthHandler(object):
 
   def _oauth2_callback(self, provider, access_token_url):
     """Step 2 of OAuth 2.0, whenever the user accepts or denies access."""
+    payload, extra = self._oauth2_access_token_payload(provider)
+    key = self._singleflight_key(provider, payload['code'])
+    if key is None:
+      return self._oauth2_exchange(provider, access_token_url, payload, extra)
+    try:
+      return self.CALLBACK_SINGLEFLIGHT.do(key, lambda: self._oauth2_exchange(
+          provider, access_token_url, payload, extra))
+    except DuplicateCallError:
+      raise AuthProviderResponseError('Duplicate callback', provider)
+
+  def _oauth2_exchange(self, provider, access_token_url, payload, extra):
+    """Exchanges authorization code for access token and fetches user info.
+
+    Returns a (user_data, auth_info, extra) tuple.
+    """
+    client_id, client_secret = payload['client_id'], payload['client_secret']
+
+    with self.TRACER.span(provider, 'token') as span:
+      resp = self._send(
+          self.TRANSPORT.fetch,
+          url=access_token_url,
+          payload=urlencode(payload),
+          method='POST',
+          headers={'Content-Type': 'application/x-www-form-urlencoded'})
+      span.status = resp.status_code
+
+    auth_info = self._parse_token_response(provider, resp.content)
+    # secondary lookups are in flight while the profile is being fetched
+    pending = self._oauth2_prefetch(provider, auth_info)
+    user_data = self._get_user_info(provider, auth_info,
+                                    key=client_id, secret=client_secret)
+    self._merge_prefetched(provider, user_data, pending)
+    self._save_tokens(provider, user_data, auth_info)
+    return user_data, auth_info, extra
+
+  def _oauth2_access_token_payload(self, provider):
+    """Validates OAuth 2.0 callback request, including CSRF state token
+    if enabled.
+
+    Returns a (payload, extra) tuple, where payload is a dict of
+    access token request params.
+    """
     error = self.request.get('error')
     if error:
       raise AuthProviderResponseError(error, provider)
@@ -245,17 +620,19 @@ class SimpleAuthHandler(object):
     callback_url = self._callback_uri_for(provider)
     client_id, client_secret, scope = self._get_consumer_info_for(provider)
 
-    json_state = self.request.get('state')
-    logging.debug(json_state)
-    state = json.loads(json_state)
+    state = self._decode_oauth2_state(self.request.get('state'))
 
     if self.OAUTH2_CSRF_STATE:
-      _expected = self.session.pop(self.OAUTH2_CSRF_SESSION_PARAM, '')
-      _actual = state[self.OAUTH2_CSRF_STATE_PARAM]
-      # If _expected is '' it won't validate anyway.
-      if not self._validate_csrf_token(_expected, _actual):
-        raise InvalidCSRFTokenError(
-            '[%s] vs [%s]' % (_expected, _actual), provider)
+      with self.TRACER.span(provider, 'csrf'):
+        _actual = state[self.OAUTH2_CSRF_STATE_PARAM]
+        if self.OAUTH2_CSRF_SECRET:
+          _expected = self._expected_signed_csrf_token(_actual)
+        else:
+          _expected = self.session.pop(self.OAUTH2_CSRF_SESSION_PARAM, '')
+        # If _expected is '' it won't validate anyway.
+        if not self._validate_csrf_token(_expected, _actual):
+          raise InvalidCSRFTokenError(
+              '[%s] vs [%s]' % (_expected, _actual), provider)
 
     extra = state.get(self.OAUTH2_STATE_EXTRA_PARAM, None)
 
@@ -266,40 +643,156 @@ class SimpleAuthHandler(object):
       'redirect_uri': callback_url,
       'grant_type': 'authorization_code'
     }
+    return payload, extra
 
-    resp = urlfetch.fetch(
-        url=access_token_url,
-        payload=urlencode(payload),
-        method=urlfetch.POST,
-        headers={'Content-Type': 'application/x-www-form-urlencoded'})
+  def _singleflight_key(self, provider, code):
+    """Returns CALLBACK_SINGLEFLIGHT key of the authorization code, or None
+    if coalescing is disabled or there's no code.
 
-    _parser = getattr(self, self.TOKEN_RESPONSE_PARSERS[provider])
-    _fetcher = getattr(self, '_get_%s_user_info' % provider)
+    The key also covers the state param and the browser, i.e. the
+    OAUTH2_CSRF_COOKIE if OAUTH2_CSRF_SECRET is set, otherwise all cookies,
+    so that a leaked code alone doesn't get someone else's result. All of
+    it is hashed so that none of it ends up in the keys.
+    """
+    if self.CALLBACK_SINGLEFLIGHT is None or not code:
+      return None
+    if self.OAUTH2_CSRF_SECRET:
+      browser = self.request.cookies.get(self.OAUTH2_CSRF_COOKIE)
+    else:
+      browser = self.request.headers.get('Cookie')
+    parts = [provider, code, self.request.get('state'), browser or '']
+    digest = hashlib.sha256(u'\0'.join(
+        p.decode('utf-8') if isinstance(p, str) else p
+        for p in parts).encode('utf-8')).hexdigest()
+    return 'callback:%s' % digest
+
+  def _save_tokens(self, provider, user_data, auth_info):
+    """Stores tokens of a callback in TOKEN_MANAGER, if it's set."""
+    if self.TOKEN_MANAGER is None or 'access_token' not in auth_info:
+      return
+    if not isinstance(user_data, dict) or not user_data.get('id'):
+      logging.warning('No %s user ID, tokens are not stored', provider)
+      return
+    self.TOKEN_MANAGER.put(user_data['id'], provider, auth_info)
+
+  def _get_access_token(self, provider, user_id):
+    """Returns a valid OAuth 2.0 access token of the user from
+    TOKEN_MANAGER, or None if there is none. user_id is provider's user ID,
+    i.e. user_data['id'] of the callback.
+    """
+    return self.TOKEN_MANAGER.get(user_id, provider, self._oauth2_refresh)
 
-    auth_info = _parser(resp.content)
-    user_data = _fetcher(auth_info, key=client_id, secret=client_secret)
-    return user_data, auth_info, extra
+  def _oauth2_refresh(self, provider, refresh_token):
+    """Exchanges refresh token for a new access token.
+
+    Returns token response dict, like auth_info of the callback. Needs no
+    request, so it can be called from a cron job or a background thread.
+    """
+    p = self._provider(provider)
+    if p.auth_type == OIDC:
+      token_url = self._oidc_discovery(provider, p.callback_arg)[
+          'token_endpoint']
+    elif p.auth_type == OAUTH2:
+      token_url = p.callback_arg
+    else:
+      raise UnknownAuthMethodError(
+          'Tokens of %s providers cannot be refreshed' % p.auth_type)
+
+    client_id, client_secret = self._get_consumer_info_for(provider)[:2]
+    payload = {
+      'refresh_token': refresh_token,
+      'client_id': client_id,
+      'client_secret': client_secret,
+      'grant_type': 'refresh_token'
+    }
+    with self.TRACER.span(provider, 'refresh') as span:
+      resp = self._send(
+          self.TRANSPORT.fetch,
+          url=token_url,
+          payload=urlencode(payload),
+          method='POST',
+          headers={'Content-Type': 'application/x-www-form-urlencoded'})
+      span.status = resp.status_code
+
+    if resp.status_code != 200:
+      raise AuthProviderResponseError(
+          'Token refresh failed (%s): %s' % (resp.status_code, resp.content),
+          provider)
+    auth_info = self._parse_token_response(provider, resp.content)
+    if 'access_token' not in auth_info:
+      raise AuthProviderResponseError(
+          'No access token in refresh response', provider)
+    return auth_info
+
+  def _parse_token_response(self, provider, content):
+    """Parses access or request token response with provider's parser"""
+    with self.TRACER.span(provider, 'parse'):
+      return self._provider(provider).parser(self, content)
+
+  def _encode_oauth2_state(self, state):
+    """Returns a string to send as OAuth 2.0 'state' param"""
+    if self.OAUTH2_STATE_CODEC is None:
+      return json.dumps(state)
+    return self.OAUTH2_STATE_CODEC.encode(state)
+
+  def _decode_oauth2_state(self, state):
+    """Returns a dict of OAuth 2.0 'state' param"""
+    logging.debug(state)
+    if self.OAUTH2_STATE_CODEC is None:
+      return json.loads(state)
+    return self.OAUTH2_STATE_CODEC.decode(state)
+
+  def _oidc_init(self, provider, issuer, extra=None):
+    """Initiates OpenID Connect flow, i.e. OAuth 2.0 with endpoints
+    of issuer's discovery document.
+    """
+    doc = self._oidc_discovery(provider, issuer)
+    self._oauth2_init(provider, self._oidc_auth_url(doc), extra)
+
+  def _oidc_callback(self, provider, issuer):
+    """Step 2 of OpenID Connect, same as OAuth 2.0"""
+    doc = self._oidc_discovery(provider, issuer)
+    return self._oauth2_callback(provider, doc['token_endpoint'])
+
+  def _oidc_discovery(self, provider, issuer):
+    """Returns discovery document of issuer, normally from memory."""
+    try:
+      return self.OIDC_DISCOVERY.get(issuer, self.TRANSPORT)
+    except DiscoveryError as e:
+      raise AuthProviderResponseError(str(e), provider)
+
+  def _oidc_auth_url(self, doc):
+    """Returns authorization endpoint with {0} placeholder for params"""
+    url = doc['authorization_endpoint'].replace('{', '{{').replace('}', '}}')
+    return url + ('&{0}' if '?' in url else '?{0}')
 
   def _oauth1_init(self, provider, auth_urls, extra=None):
     """Initiates OAuth 1.0 dance"""
     key, secret = self._get_consumer_info_for(provider)
     callback_url = self._callback_uri_for(provider)
-    optional_params = self._get_optional_params_for(provider)
-    token_request_url = auth_urls.get('request', None)
-    auth_url = auth_urls.get('auth', None)
-    _parser = getattr(self, self.TOKEN_RESPONSE_PARSERS[provider], None)
 
     # make a request_token request
     client = self._oauth1_client(consumer_key=key, consumer_secret=secret)
     body = urlencode({'oauth_callback': callback_url})
-    resp, content = client.request(auth_urls['request'], "POST", body)
+    with self.TRACER.span(provider, 'request_token') as span:
+      resp, content = self._send(lambda **kwargs: client.request(
+          auth_urls['request'], "POST", body, **kwargs))
+      span.status = resp.status
+    self._oauth1_authorize(provider, auth_urls, resp, content)
+
+  def _oauth1_authorize(self, provider, auth_urls, resp, content):
+    """Parses request token response and redirects user to
+    the provider's authorization page.
+    """
+    callback_url = self._callback_uri_for(provider)
+    optional_params = self._get_optional_params_for(provider)
 
     if resp.status != 200:
       raise AuthProviderResponseError(
           '%s (status: %d)' % (content, resp.status), provider)
 
     # parse token request response
-    request_token = _parser(content)
+    request_token = self._parse_token_response(provider, content)
     if not request_token.get('oauth_token', None):
       raise AuthProviderResponseError(
           "Couldn't get a request token from %s" % str(request_token), provider)
@@ -315,34 +808,85 @@ class SimpleAuthHandler(object):
     logging.debug('Redirecting user to %s', target_url)
 
     # save request token for later, the callback
-    self.session['req_token'] = request_token
+    self._save_oauth1_request_token(provider, request_token)
     self.redirect(target_url)
 
   def _oauth1_callback(self, provider, access_token_url):
     """Third step of OAuth 1.0 dance."""
-    request_token = self.session.pop('req_token', None)
+    token = self._oauth1_verified_token(provider)
+    consumer_key, consumer_secret = self._get_consumer_info_for(provider)
+    client = self._oauth1_client(consumer_key=consumer_key,
+                                 consumer_secret=consumer_secret)
+    with self.TRACER.span(provider, 'token') as span:
+      resp, content = self._send(lambda **kwargs: client.request(
+          access_token_url, "POST", token=token, **kwargs))
+      span.status = resp.status
+
+    auth_info = self._parse_token_response(provider, content)
+    user_data = self._get_user_info(provider, auth_info,
+                                    key=consumer_key, secret=consumer_secret)
+    return (user_data, auth_info)
+
+  def _oauth1_verified_token(self, provider):
+    """Returns request token saved during init step, along with
+    the verifier the provider called us back with.
+    """
+    request_token = self._pop_oauth1_request_token(provider)
     if not request_token:
       raise InvalidOAuthRequestToken(
-          "No request token in user session", provider)
+          "No request token in user session or token store", provider)
 
     verifier = self.request.get('oauth_verifier')
     if not verifier:
       raise AuthProviderResponseError(
           "No OAuth verifier was provided", provider)
 
-    consumer_key, consumer_secret = self._get_consumer_info_for(provider)
     token = oauth1.Token(request_token['oauth_token'],
                          request_token['oauth_token_secret'])
     token.set_verifier(verifier)
-    client = self._oauth1_client(token, consumer_key, consumer_secret)
-    resp, content = client.request(access_token_url, "POST")
+    return token
+
+  def _save_oauth1_request_token(self, provider, request_token):
+    """Keeps request token until the callback step"""
+    store = self.OAUTH1_REQUEST_TOKEN_STORE
+    if store is None:
+      self.session['req_token'] = request_token
+      return
+    key = self._oauth1_request_token_key(provider, request_token['oauth_token'])
+    # only a hash of the cookie is stored, like in signed CSRF tokens
+    binding_hash = hashlib.sha256(self._csrf_binding(create=True)).hexdigest()
+    store.set(key, (binding_hash, request_token),
+              ttl=self.OAUTH1_REQUEST_TOKEN_TIMEOUT)
+
+  def _pop_oauth1_request_token(self, provider):
+    """Returns request token saved during init step and forgets about it,
+    or None if there's no such token.
+
+    Raises InvalidOAuthRequestToken if the token in the store was issued
+    to another browser.
+    """
+    store = self.OAUTH1_REQUEST_TOKEN_STORE
+    if store is None:
+      return self.session.pop('req_token', None)
+
+    oauth_token = self.request.get('oauth_token')
+    if not oauth_token:
+      return None
+    key = self._oauth1_request_token_key(provider, oauth_token)
+    entry = store.get(key)
+    if entry is None:
+      return None
+    binding_hash, request_token = entry
+    binding = self._csrf_binding()
+    if not binding or not security.compare_hashes(
+        binding_hash, hashlib.sha256(binding).hexdigest()):
+      raise InvalidOAuthRequestToken(
+          "Request token was issued to another browser", provider)
+    store.delete(key)
+    return request_token
 
-    _parser = getattr(self, self.TOKEN_RESPONSE_PARSERS[provider])
-    _fetcher = getattr(self, '_get_%s_user_info' % provider)
-
-    auth_info = _parser(content)
-    user_data = _fetcher(auth_info, key=consumer_key, secret=consumer_secret)
-    return (user_data, auth_info)
+  def _oauth1_request_token_key(self, provider, oauth_token):
+    return 'oauth1_req_token:%s:%s' % (provider, oauth_token)
 
   def _openid_init(self, provider='openid', identity=None, extra=None):
     """Initiates OpenID dance using App Engine users module API."""
@@ -418,14 +962,137 @@ class SimpleAuthHandler(object):
   # user profile/info
   #
 
+  def _get_user_info(self, provider, auth_info, key=None, secret=None):
+    """Returns a dict of user info using _get_<provider>_user_info().
+
+    If USER_INFO_CACHE is set, a response for the same access token is
+    returned from the cache instead.
+    If provider is in OIDC_ID_TOKEN or is an 'oidc' provider, user info is
+    read from the id_token.
+    """
+    user_data = self._id_token_user_info(provider, auth_info, key)
+    if user_data is not None:
+      return user_data
+
+    cache_key = self._user_info_cache_key(provider, auth_info)
+    if cache_key is not None:
+      user_data = self.USER_INFO_CACHE.get(cache_key)
+      if user_data is not None:
+        # callers are free to modify it, e.g. _merge_prefetched()
+        return copy.deepcopy(user_data)
+
+    _fetcher = self._provider(provider).fetcher
+    with self.TRACER.span(provider, 'user_info'):
+      user_data = _fetcher(self, auth_info, key=key, secret=secret)
+
+    if cache_key is not None and user_data is not None:
+      self.USER_INFO_CACHE.set(cache_key, copy.deepcopy(user_data))
+    return user_data
+
+  def _id_token_user_info(self, provider, auth_info, client_id):
+    """Returns user info of a verified OpenID Connect id_token, or None
+    if provider isn't in OIDC_ID_TOKEN or there's no id_token in auth_info.
+
+    Raises InvalidIdTokenError if the token doesn't verify, or if there's
+    no client_id to check its audience against.
+    """
+    config = self._id_token_config(provider)
+    if config is None or not isinstance(auth_info, dict):
+      return None
+    token = auth_info.get('id_token')
+    if not token:
+      return None
+    if not client_id:
+      raise InvalidIdTokenError('No client ID to verify id_token audience',
+                                provider)
+
+    def _get_key(kid):
+      return self.KEY_MANAGER.get_key(config['jwks_uri'], kid, self.TRANSPORT)
+
+    with self.TRACER.span(provider, 'id_token'):
+      try:
+        claims = idtoken.decode(token, _get_key, audience=client_id,
+                                issuers=config.get('issuers'))
+      except idtoken.InvalidTokenError as e:
+        raise InvalidIdTokenError(str(e), provider)
+      if not claims.get('sub'):
+        raise InvalidIdTokenError('No sub claim in id_token', provider)
+
+    user_data = dict((k, v) for k, v in claims.items()
+                     if k not in _ID_TOKEN_CLAIMS)
+    # same as in user info endpoint responses
+    user_data['id'] = claims['sub']
+    if 'email_verified' in claims:
+      user_data.setdefault('verified_email', claims['email_verified'])
+    return user_data
+
+  def _id_token_config(self, provider):
+    """Returns a dict of 'jwks_uri' and 'issuers' to verify id_token of
+    provider with, or None.
+
+    'oidc' providers take it from their discovery document.
+    """
+    config = self.OIDC_ID_TOKEN.get(provider)
+    if config is not None or not self.OIDC_USE_ID_TOKEN:
+      return config
+    p = self._providers.get(provider)
+    if p is None or p.auth_type != OIDC:
+      return None
+    doc = self._oidc_discovery(provider, p.init_arg)
+    return {'jwks_uri': doc['jwks_uri'], 'issuers': (doc['issuer'],)}
+
+  def _user_info_cache_key(self, provider, auth_info):
+    """Returns USER_INFO_CACHE key for the access token in auth_info,
+    or None if caching is disabled or there's no token.
+
+    Tokens are hashed so they don't end up in the cache keys.
+    """
+    if self.USER_INFO_CACHE is None or not isinstance(auth_info, dict):
+      return None
+    # OAuth 2.0 or OAuth 1.0
+    token = auth_info.get('access_token') or auth_info.get('oauth_token')
+    if not token:
+      return None
+    secret = auth_info.get('oauth_token_secret', '')
+    digest = hashlib.sha256('%s:%s' % (token, secret)).hexdigest()
+    return 'user_info:%s:%s' % (provider, digest)
+
+  def _get_oidc_user_info(self, provider, auth_info, key=None, secret=None):
+    """Returns a dict of currently logging in user from userinfo endpoint
+    of an 'oidc' provider.
+    """
+    url, headers = self._oidc_user_info_request(provider, auth_info)
+    resp = self._send(self.TRANSPORT.fetch, retries=self.USER_INFO_RETRIES,
+                      url=url, headers=headers)
+    return self._parse_oidc_user_info(provider, resp)
+
+  def _oidc_user_info_request(self, provider, auth_info):
+    """Returns (url, headers) of a userinfo endpoint request"""
+    doc = self._oidc_discovery(provider, self._provider(provider).init_arg)
+    url = doc.get('userinfo_endpoint')
+    if not url:
+      raise AuthProviderResponseError(
+          'No userinfo_endpoint in discovery document', provider)
+    headers = {'Authorization': 'Bearer %s' % auth_info['access_token']}
+    return url, headers
+
+  def _parse_oidc_user_info(self, provider, resp):
+    if resp.status_code != 200:
+      raise AuthProviderResponseError(
+          'Userinfo request failed (status: %d)' % resp.status_code, provider)
+    data = json.loads(resp.content)
+    if 'id' not in data and 'sub' in data:
+      data['id'] = data['sub']
+    return data
+
   def _get_google_user_info(self, auth_info, key=None, secret=None):
     """Returns a dict of currenly logging in user.
     Google API endpoint:
     https://www.googleapis.com/userinfo/v2/me
     """
-    resp = self._oauth2_request(
-        'https://www.googleapis.com/userinfo/v2/me?{0}',
-        auth_info['access_token'])
+    url = self._user_info_url(
+        'https://www.googleapis.com/userinfo/v2/me?{0}', 'google')
+    resp = self._oauth2_request(url, auth_info['access_token'])
     data = json.loads(resp)
     if 'id' not in data and 'sub' in data:
       data['id'] = data['sub']
@@ -439,9 +1106,9 @@ class SimpleAuthHandler(object):
     logging.warn('Google+ API endpoint is deprecated. '
                  'Use Google API (google provider): '
                  'https://developers.google.com/+/api-shutdown')
-    resp = self._oauth2_request(
-        'https://www.googleapis.com/plus/v1/people/me?{0}',
-        auth_info['access_token'])
+    url = self._user_info_url(
+        'https://www.googleapis.com/plus/v1/people/me?{0}', 'googleplus')
+    resp = self._oauth2_request(url, auth_info['access_token'])
     return json.loads(resp)
 
   def _get_windows_live_user_info(self, auth_info, key=None, secret=None):
@@ -462,8 +1129,8 @@ class SimpleAuthHandler(object):
     """Facebook Graph API endpoint.
     https://graph.facebook.com/me
     """
-    resp = self._oauth2_request('https://graph.facebook.com/me?{0}',
-                                auth_info['access_token'])
+    url = self._user_info_url('https://graph.facebook.com/me?{0}', 'facebook')
+    resp = self._oauth2_request(url, auth_info['access_token'])
     return json.loads(resp)
 
   def _get_foursquare_user_info(self, auth_info, key=None, secret=None):
@@ -497,12 +1164,14 @@ class SimpleAuthHandler(object):
                  'https://developer.linkedin.com/documents/authentication')
     token = oauth1.Token(key=auth_info['oauth_token'],
                          secret=auth_info['oauth_token_secret'])
-    client = self._oauth1_client(token, key, secret)
+    client = self._oauth1_client(consumer_key=key, consumer_secret=secret)
 
-    fields = 'id,first-name,last-name,picture-url,public-profile-url,headline'
-    url = 'http://api.linkedin.com/v1/people/~:(%s)' % fields
-    resp, content = client.request(url)
-    return self._parse_xml_user_info(content)
+    fields = self._user_info_fields('linkedin', LINKEDIN_FIELDS)
+    url = 'http://api.linkedin.com/v1/people/~:(%s)' % ','.join(fields)
+    resp, content = self._send(
+        lambda **kwargs: client.request(url, token=token, **kwargs),
+        retries=self.USER_INFO_RETRIES)
+    return self._parse_xml_user_info(content, fields)
 
   def _get_linkedin2_user_info(self, auth_info, key=None, secret=None):
     """Returns a dict of currently logging in linkedin user.
@@ -514,23 +1183,61 @@ class SimpleAuthHandler(object):
     where <fields> is something like
     (id,first-name,last-name,picture-url,public-profile-url,headline)
     """
-    fields = 'id,first-name,last-name,picture-url,public-profile-url,headline'
-    url = 'https://api.linkedin.com/v1/people/~:(%s)?{0}' % fields
+    fields = self._user_info_fields('linkedin2', LINKEDIN_FIELDS)
+    url = 'https://api.linkedin.com/v1/people/~:(%s)?{0}' % ','.join(fields)
     resp = self._oauth2_request(url, auth_info['access_token'],
                                 token_param='oauth2_access_token')
-    return self._parse_xml_user_info(resp)
+    return self._parse_xml_user_info(resp, fields)
 
-  def _parse_xml_user_info(self, content):
-    try:
-      # lxml is one of the third party libs available on App Engine out of the
-      # box. See example/app.yaml for more info.
-      from lxml import etree
-    except ImportError:
-      import xml.etree.ElementTree as etree
-    person = etree.fromstring(content)
+  def _user_info_fields(self, provider, default=None):
+    """Returns a tuple of USER_INFO_FIELDS of provider, 'id' first,
+    or default if there are none.
+    """
+    fields = self.USER_INFO_FIELDS.get(provider)
+    if not fields:
+      return default
+    return ('id',) + tuple(f for f in fields if f != 'id')
+
+  def _user_info_url(self, url, provider):
+    """Adds fields= query param of USER_INFO_FIELDS of provider to url,
+    if there are any. url must already have a query, e.g. '{0}'.
+    """
+    fields = self._user_info_fields(provider)
+    if fields is None:
+      return url
+    return '%s&%s' % (url, urlencode({'fields': ','.join(fields)}))
+
+  def _parse_xml_user_info(self, content, fields=None):
+    """Returns a dict of {tag: text} of the root element children.
+
+    If fields is a list of tags, other children are left out. Large
+    documents are then parsed incrementally, until all of the fields
+    are found.
+    """
+    if fields is None or len(content) < XML_STREAM_MIN_SIZE:
+      uinfo = {}
+      for e in etree.fromstring(content):
+        if fields is None or e.tag in fields:
+          uinfo.setdefault(e.tag, e.text)
+      return uinfo
+
+    wanted = frozenset(fields)
     uinfo = {}
-    for e in person:
-      uinfo.setdefault(e.tag, e.text)
+    depth = 0
+    for event, elem in etree.iterparse(StringIO(content),
+                                       events=('start', 'end')):
+      if event == 'start':
+        depth += 1
+        continue
+      depth -= 1
+      if depth != 1:
+        continue
+      # a child of the root element is complete
+      if elem.tag in wanted:
+        uinfo.setdefault(elem.tag, elem.text)
+        if len(uinfo) == len(wanted):
+          break
+      elem.clear()
     return uinfo
 
   def _get_twitter_user_info(self, auth_info, key=None, secret=None):
@@ -539,10 +1246,12 @@ class SimpleAuthHandler(object):
     """
     token = oauth1.Token(key=auth_info['oauth_token'],
                          secret=auth_info['oauth_token_secret'])
-    client = self._oauth1_client(token, key, secret)
+    client = self._oauth1_client(consumer_key=key, consumer_secret=secret)
 
-    resp, content = client.request(
-        'https://api.twitter.com/1.1/account/verify_credentials.json')
+    url = 'https://api.twitter.com/1.1/account/verify_credentials.json'
+    resp, content = self._send(
+        lambda **kwargs: client.request(url, token=token, **kwargs),
+        retries=self.USER_INFO_RETRIES)
     uinfo = json.loads(content)
     uinfo.setdefault('link', 'http://twitter.com/%s' % uinfo['screen_name'])
     return uinfo
@@ -553,19 +1262,191 @@ class SimpleAuthHandler(object):
 
   def _oauth1_client(self, token=None, consumer_key=None,
                      consumer_secret=None):
-    """Returns OAuth 1.0 client that is capable of signing requests."""
-    args = [oauth1.Consumer(key=consumer_key, secret=consumer_secret)]
-    if token:
-      args.append(token)
+    """Returns OAuth 1.0 client that is capable of signing requests.
 
-    return oauth1.Client(*args)
+    Requests are sent using self.TRANSPORT. Clients without a token are
+    created once per consumer and transport and shared by all requests,
+    so pass user tokens to client.request() rather than here.
+    """
+    if token is not None:
+      consumer = oauth1.Consumer(key=consumer_key, secret=consumer_secret)
+      return OAuth1Client(consumer, token, transport=self.TRANSPORT)
+
+    cache_key = (consumer_key, consumer_secret, self.TRANSPORT)
+    client = _OAUTH1_CLIENTS.get(cache_key)
+    if client is None:
+      consumer = oauth1.Consumer(key=consumer_key, secret=consumer_secret)
+      client = OAuth1Client(consumer, transport=self.TRANSPORT)
+      # a concurrent request may have just made one too, which is harmless
+      _OAUTH1_CLIENTS[cache_key] = client
+    return client
 
   def _oauth2_request(self, url, token, token_param='access_token'):
-    """Makes an HTTP request with OAuth 2.0 access token using App Engine
-    URLfetch API.
+    """Makes an HTTP request with OAuth 2.0 access token using
+    self.TRANSPORT. App Engine URLfetch API by default.
+
+    Retried up to USER_INFO_RETRIES times.
     """
     target_url = url.format(urlencode({token_param:token}))
-    return urlfetch.fetch(target_url).content
+    return self._send(self.TRANSPORT.fetch, retries=self.USER_INFO_RETRIES,
+                      url=target_url).content
+
+  def _oauth2_request_async(self, url, token, token_param='access_token'):
+    """Same as _oauth2_request() but returns immediately, and is not
+    retried.
+
+    Call get_result() on the returned object to get a transport.Response.
+    """
+    target_url = url.format(urlencode({token_param:token}))
+    deadline = self._time_left()
+    if deadline is None:
+      return self.TRANSPORT.fetch_async(target_url)
+    return self.TRANSPORT.fetch_async(target_url, deadline=deadline)
+
+  def _send(self, send, retries=0, **kwargs):
+    """Calls send(**kwargs), e.g. self.TRANSPORT.fetch, and returns
+    its result: a Response, or a (response, content) tuple of
+    OAuth1Client.request().
+
+    During a callback with a deadline, send() also gets deadline kwarg of
+    the seconds left. Errors and 5xx responses are retried up to retries
+    times, so only pass it for idempotent requests.
+
+    Raises AuthProviderResponseError once the deadline is exceeded, or if
+    the last attempt failed with TransportError.
+    """
+    attempt = 0
+    while True:
+      deadline = self._time_left()
+      if deadline is not None:
+        kwargs['deadline'] = deadline
+      start = time.time()
+      try:
+        with self.TRACER.span(self._active_provider, 'fetch') as span:
+          result = send(**kwargs)
+          self._trace_response(span, result)
+      except Exception as e:
+        self._record_request(start, failed=True)
+        # e.g. the transport gave up on the deadline
+        self._time_left()
+        if attempt >= retries:
+          if isinstance(e, TransportError):
+            raise AuthProviderResponseError(str(e), self._active_provider)
+          raise
+        logging.warning('Provider request failed, retrying', exc_info=True)
+      else:
+        resp = result[0] if isinstance(result, tuple) else result
+        self._record_request(start, failed=resp.status >= 500)
+        if resp.status < 500 or attempt >= retries:
+          return result
+        logging.warning('Provider request failed (status: %d), retrying',
+                        resp.status)
+      attempt += 1
+      time.sleep(self._retry_delay(attempt))
+
+  def _trace_response(self, span, result):
+    """Reports status and body sizes of a _send() result to a fetch span."""
+    resp = result[0] if isinstance(result, tuple) else result
+    span.status = resp.status
+    content = result[1] if isinstance(result, tuple) else resp.content
+    content_bytes = len(content or '')
+    span.content_bytes = content_bytes
+    # httplib2 responses of OAuth 1.0 mocks don't know it
+    span.wire_bytes = getattr(resp, 'wire_size', content_bytes)
+
+  def _check_circuit(self, provider, step):
+    """Raises ProviderUnavailableError if provider's circuit is open.
+
+    Called before the init and callback steps. New logins are refused
+    while the circuit is open; callbacks are also let through one at a time
+    while it's half-open, to probe the provider. Override to e.g. log or
+    render a page suggesting other providers instead.
+    """
+    if self.CIRCUIT_BREAKER is None:
+      return
+    if step == 'init':
+      available = not self.CIRCUIT_BREAKER.is_open(provider)
+    else:
+      available = self.CIRCUIT_BREAKER.allow(provider)
+    if not available:
+      raise ProviderUnavailableError('Circuit is open', provider)
+
+  def _record_request(self, start, failed=False):
+    """Reports a request of the step being handled to CIRCUIT_BREAKER."""
+    if self.CIRCUIT_BREAKER is None or self._active_provider is None:
+      return
+    self.CIRCUIT_BREAKER.record(self._active_provider, time.time() - start,
+                                failed=failed)
+
+  def _callback_deadline(self, provider):
+    """Returns (provider, expiry timestamp) of provider's callback
+    deadline, or None if CALLBACK_DEADLINES has none.
+    """
+    seconds = self.CALLBACK_DEADLINES.get(provider,
+                                          self.CALLBACK_DEADLINES.get('*'))
+    if seconds is None:
+      return None
+    return (provider, time.time() + seconds)
+
+  def _time_left(self):
+    """Returns seconds left until the callback deadline, or None if
+    there's no deadline.
+
+    Raises AuthProviderResponseError if it has passed.
+    """
+    if self._deadline is None:
+      return None
+    provider, expires = self._deadline
+    left = expires - time.time()
+    if left <= 0:
+      raise AuthProviderResponseError('Callback deadline exceeded', provider)
+    return left
+
+  def _retry_delay(self, attempt):
+    """Returns seconds to wait before retry number attempt.
+
+    Raises AuthProviderResponseError if the wait would go past the callback
+    deadline.
+    """
+    backoff = self.RETRY_DELAY * 2 ** (attempt - 1)
+    delay = random.uniform(backoff / 2.0, backoff)
+    left = self._time_left()
+    if left is not None and delay >= left:
+      raise AuthProviderResponseError('Callback deadline exceeded',
+                                      self._deadline[0])
+    return delay
+
+  def _oauth2_prefetch(self, provider, auth_info):
+    """Starts secondary user info lookups defined in OAUTH2_USER_INFO_EXTRAS.
+
+    Returns a dict of {user_data_key: future}.
+    """
+    extras = self.OAUTH2_USER_INFO_EXTRAS.get(provider)
+    if not extras or 'access_token' not in auth_info:
+      return {}
+
+    pending = {}
+    for name, url in extras.items():
+      token_param = 'access_token'
+      if isinstance(url, tuple):
+        url, token_param = url
+      pending[name] = self._oauth2_request_async(
+          url, auth_info['access_token'], token_param=token_param)
+    return pending
+
+  def _merge_prefetched(self, provider, user_data, pending):
+    """Waits for lookups started by _oauth2_prefetch() and stores their
+    results in user_data.
+    """
+    for name, future in pending.items():
+      try:
+        resp = future.get_result()
+        if resp.status_code != 200:
+          raise AuthProviderResponseError(
+              '%s (status: %d)' % (resp.content, resp.status_code), provider)
+        user_data[name] = json.loads(resp.content)
+      except Exception as e:
+        logging.warn('Failed to fetch %s for %s: %s', name, provider, e)
 
   def _query_string_parser(self, body):
     """Parses response body of an access token request query and returns
@@ -584,20 +1465,77 @@ class SimpleAuthHandler(object):
 
     Token would normally be stored in a user session and passed as 'state'
     parameter during OAuth 2.0 authorization step.
+
+    If OAUTH2_CSRF_SECRET is set, the token is signed instead and bound
+    to the browser's OAUTH2_CSRF_COOKIE, which is set if missing.
     """
     now = str(_time or long(time.time()))
+    if self.OAUTH2_CSRF_SECRET:
+      binding = self._csrf_binding(create=True)
+      nonce = security.generate_random_string(16, pool=security.ALPHANUMERIC)
+      return self._signed_csrf_token(binding, nonce, now)
+
     secret = security.generate_random_string(30, pool=security.ASCII_PRINTABLE)
     token = self.OAUTH2_CSRF_DELIMITER.join([secret, now])
     return base64.urlsafe_b64encode(token)
 
+  def _signed_csrf_token(self, binding, nonce, timestamp):
+    """Returns a stateless CSRF token: nonce.signature:timestamp, base64-ed.
+
+    The signature is HMAC-SHA256 of the nonce, timestamp and a hash of
+    the binding cookie value, keyed with OAUTH2_CSRF_SECRET.
+    """
+    delim = self.OAUTH2_CSRF_DELIMITER
+    binding_hash = hashlib.sha256(binding).hexdigest()
+    msg = delim.join([nonce, timestamp, binding_hash])
+    sig = hmac.new(self.OAUTH2_CSRF_SECRET, msg, hashlib.sha256).hexdigest()
+    token = delim.join(['%s.%s' % (nonce, sig), timestamp])
+    return base64.urlsafe_b64encode(token)
+
+  def _expected_signed_csrf_token(self, actual):
+    """Re-creates the signed token the browser should have presented,
+    using nonce and timestamp of the actual one.
+
+    Returns '' if there's no binding cookie or the actual token is malformed.
+    """
+    binding = self._csrf_binding()
+    if not binding or not actual:
+      return ''
+    try:
+      decoded = base64.urlsafe_b64decode(actual.encode('ascii'))
+      token_key, token_time = decoded.rsplit(self.OAUTH2_CSRF_DELIMITER, 1)
+      nonce = token_key.split('.', 1)[0]
+    except (TypeError, ValueError, UnicodeDecodeError):
+      return ''
+    return self._signed_csrf_token(binding, nonce, token_time)
+
+  def _csrf_binding(self, create=False):
+    """Returns OAUTH2_CSRF_COOKIE value, setting a new random one
+    if create is True and the browser doesn't have it yet.
+    """
+    value = self.request.cookies.get(self.OAUTH2_CSRF_COOKIE)
+    if value:
+      return value.encode('ascii', 'ignore')
+    if not create:
+      return None
+
+    value = security.generate_random_string(32, pool=security.ALPHANUMERIC)
+    self.response.set_cookie(self.OAUTH2_CSRF_COOKIE, value, path='/',
+                             secure=self.request.scheme == 'https',
+                             httponly=True)
+    return value
+
   def _validate_csrf_token(self, expected, actual):
     """Validates expected token against the actual.
 
+    Tokens are compared in constant time.
+
     Args:
-      expected: String, existing token. Normally stored in a user session.
+      expected: String, existing token. Normally stored in a user session,
+                or re-created from the actual one if OAUTH2_CSRF_SECRET is set.
       actual: String, token provided via 'state' param.
     """
-    if expected != actual:
+    if not security.compare_hashes(expected, actual):
       return False
 
     try:
@@ -0,0 +1,275 @@
+# -*- coding: utf-8 -*-
+"""Local verification of OpenID Connect ID tokens.
+
+ID tokens are JWTs signed by the provider. decode() checks the signature
+with the provider's public key and the standard claims (exp, iat, aud,
+iss), so that user info can be read from the token instead of being
+fetched from a user info endpoint.
+
+Supported signatures are RSA (RS256, RS384, RS512), which is what Google
+and most other providers use, and ECDSA on P-256 curve (ES256).
+Verification is done in pure Python. RSA is a single modular
+exponentiation with a small public exponent; ECDSA is slower, a few
+milliseconds, but still much faster than a request to a user info endpoint.
+"""
+import base64
+import hashlib
+import json
+import time
+
+__all__ = ['InvalidTokenError',
+           'RSAPublicKey',
+           'ECPublicKey',
+           'decode']
+
+
+class InvalidTokenError(ValueError):
+  """Raised when a token is malformed, its signature doesn't verify or
+  one of its claims is not acceptable.
+  """
+  pass
+
+
+# ASN.1 DER DigestInfo prefixes of EMSA-PKCS1-v1_5, RFC 3447 section 9.2
+_DIGEST_INFO = {
+  'RS256': (hashlib.sha256,
+            '3031300d060960864801650304020105000420'.decode('hex')),
+  'RS384': (hashlib.sha384,
+            '3041300d060960864801650304020205000430'.decode('hex')),
+  'RS512': (hashlib.sha512,
+            '3051300d060960864801650304020305000440'.decode('hex')),
+}
+
+
+class RSAPublicKey(object):
+  """RSA public key which verifies PKCS#1 v1.5 signatures."""
+
+  def __init__(self, n, e):
+    """
+    Args:
+      n: long, modulus.
+      e: long, public exponent.
+    """
+    self.n = n
+    self.e = e
+    self.size = (n.bit_length() + 7) // 8
+
+  @classmethod
+  def from_jwk(cls, jwk):
+    """Returns a key of a JWK dict, e.g. an entry of JWKS 'keys' list."""
+    if jwk.get('kty') != 'RSA':
+      raise InvalidTokenError('Not an RSA key: %s' % jwk.get('kty'))
+    return cls(_b64decode_long(jwk['n']), _b64decode_long(jwk['e']))
+
+  def verify(self, message, signature, alg='RS256'):
+    """Returns True if signature of message is valid."""
+    if alg not in _DIGEST_INFO or len(signature) != self.size:
+      return False
+    hash_func, digest_info = _DIGEST_INFO[alg]
+    digest = digest_info + hash_func(message).digest()
+    padding = '\xff' * (self.size - len(digest) - 3)
+    expected = '\x00\x01' + padding + '\x00' + digest
+
+    s = long(signature.encode('hex'), 16)
+    if s >= self.n:
+      return False
+    m = pow(s, self.e, self.n)
+    return _long_to_bytes(m, self.size) == expected
+
+
+# NIST P-256 curve, FIPS 186-4 D.1.2.3. Curve's a is -3.
+_P256_P = 0xffffffff00000001000000000000000000000000ffffffffffffffffffffffffL
+_P256_B = 0x5ac635d8aa3a93e7b3ebbd55769886bc651d06b0cc53b0f63bce3c3e27d2604bL
+_P256_N = 0xffffffff00000000ffffffffffffffffbce6faada7179e84f3b9cac2fc632551L
+_P256_G = (0x6b17d1f2e12c4247f8bce6e563a440f277037d812deb33a0f4a13945d898c296L,
+           0x4fe342e2fe1a7f9b8ee7eb4a7c0f9e162bce33576b315ececbb6406837bf51f5L)
+
+
+class ECPublicKey(object):
+  """P-256 public key which verifies ES256 signatures."""
+
+  def __init__(self, x, y):
+    """
+    Args:
+      x, y: long, coordinates of the public point.
+
+    Raises InvalidTokenError if the point is not on the curve.
+    """
+    p = _P256_P
+    if not (0 <= x < p and 0 <= y < p and
+            (y * y - x * x * x + 3 * x - _P256_B) % p == 0):
+      raise InvalidTokenError('Point is not on P-256 curve')
+    self.x = x
+    self.y = y
+    # Q and G + Q, used by every verification
+    self._q = (x, y, 1)
+    self._gq = _jacobian_add((_P256_G[0], _P256_G[1], 1), self._q)
+
+  @classmethod
+  def from_jwk(cls, jwk):
+    """Returns a key of a JWK dict, e.g. an entry of JWKS 'keys' list."""
+    if jwk.get('kty') != 'EC' or jwk.get('crv') != 'P-256':
+      raise InvalidTokenError('Not a P-256 key: %s %s' % (
+          jwk.get('kty'), jwk.get('crv')))
+    return cls(_b64decode_long(jwk['x']), _b64decode_long(jwk['y']))
+
+  def verify(self, message, signature, alg='ES256'):
+    """Returns True if signature of message is valid.
+
+    signature is R || S, 32 bytes each, as in JWS.
+    """
+    if alg != 'ES256' or len(signature) != 64:
+      return False
+    n = _P256_N
+    r = long(signature[:32].encode('hex'), 16)
+    s = long(signature[32:].encode('hex'), 16)
+    if not (0 < r < n and 0 < s < n):
+      return False
+
+    e = long(hashlib.sha256(message).hexdigest(), 16)
+    w = pow(s, n - 2, n)
+    u1, u2 = e * w % n, r * w % n
+
+    # u1 * G + u2 * Q, Shamir's trick
+    g = (_P256_G[0], _P256_G[1], 1)
+    point = (0, 1, 0)
+    for i in xrange(max(u1.bit_length(), u2.bit_length()) - 1, -1, -1):
+      point = _jacobian_double(point)
+      b1, b2 = (u1 >> i) & 1, (u2 >> i) & 1
+      if b1 and b2:
+        point = _jacobian_add(point, self._gq)
+      elif b1:
+        point = _jacobian_add(point, g)
+      elif b2:
+        point = _jacobian_add(point, self._q)
+
+    x, _, z = point
+    if z == 0:
+      return False
+    p = _P256_P
+    x = x * pow(z * z % p, p - 2, p) % p
+    return x % n == r
+
+
+def _jacobian_double(point):
+  x1, y1, z1 = point
+  if z1 == 0 or y1 == 0:
+    return (0, 1, 0)
+  p = _P256_P
+  delta = z1 * z1 % p
+  gamma = y1 * y1 % p
+  beta = x1 * gamma % p
+  alpha = 3 * (x1 - delta) * (x1 + delta) % p
+  x3 = (alpha * alpha - 8 * beta) % p
+  z3 = ((y1 + z1) * (y1 + z1) - gamma - delta) % p
+  y3 = (alpha * (4 * beta - x3) - 8 * gamma * gamma) % p
+  return (x3, y3, z3)
+
+
+def _jacobian_add(p1, p2):
+  if p1[2] == 0:
+    return p2
+  if p2[2] == 0:
+    return p1
+  p = _P256_P
+  x1, y1, z1 = p1
+  x2, y2, z2 = p2
+  z1z1 = z1 * z1 % p
+  z2z2 = z2 * z2 % p
+  u1 = x1 * z2z2 % p
+  u2 = x2 * z1z1 % p
+  s1 = y1 * z2 * z2z2 % p
+  s2 = y2 * z1 * z1z1 % p
+  if u1 == u2:
+    if s1 != s2:
+      return (0, 1, 0)
+    return _jacobian_double(p1)
+  h = (u2 - u1) % p
+  r = (s2 - s1) % p
+  h2 = h * h % p
+  h3 = h * h2 % p
+  u1h2 = u1 * h2 % p
+  x3 = (r * r - h3 - 2 * u1h2) % p
+  y3 = (r * (u1h2 - x3) - s1 * h3) % p
+  z3 = h * z1 * z2 % p
+  return (x3, y3, z3)
+
+
+# JWS algorithms decode() accepts
+ALGORITHMS = frozenset(list(_DIGEST_INFO) + ['ES256'])
+
+
+def decode(token, get_key, audience=None, issuers=None, leeway=60, now=None,
+           verify_audience=True):
+  """Verifies an ID token and returns its claims.
+
+  Args:
+    token: string, a JWT in compact serialization.
+    get_key: callable which takes 'kid' header value (or None) and returns
+             a key with verify(message, signature, alg) method, or None
+             if there's no such key.
+    audience: string, expected 'aud' claim, i.e. OAuth 2.0 client ID.
+              Required unless verify_audience is False.
+    issuers: list of acceptable 'iss' claims.
+    leeway: int, seconds of allowed clock skew.
+    now: int, current timestamp. Defaults to time.time().
+    verify_audience: bool, False skips the 'aud' check. A token issued to
+                     any client then verifies.
+
+  Raises InvalidTokenError, or ValueError if there's no audience to verify.
+  """
+  if verify_audience and not audience:
+    raise ValueError('No audience to verify the token against')
+  try:
+    signing_input, signature = str(token).rsplit('.', 1)
+    header, payload = signing_input.split('.')
+    header = json.loads(_b64decode(header))
+    claims = json.loads(_b64decode(payload))
+    signature = _b64decode(signature)
+  except (ValueError, TypeError):
+    raise InvalidTokenError('Malformed token')
+  if not isinstance(header, dict) or not isinstance(claims, dict):
+    raise InvalidTokenError('Malformed token')
+
+  alg = header.get('alg')
+  if alg not in ALGORITHMS:
+    raise InvalidTokenError('Unsupported algorithm: %s' % alg)
+  key = get_key(header.get('kid'))
+  if key is None:
+    raise InvalidTokenError('Unknown key: %s' % header.get('kid'))
+  if not key.verify(signing_input, signature, alg):
+    raise InvalidTokenError('Invalid signature')
+
+  if now is None:
+    now = time.time()
+  exp = claims.get('exp')
+  if not isinstance(exp, (int, long, float)) or exp + leeway < now:
+    raise InvalidTokenError('Token expired')
+  iat = claims.get('iat')
+  if isinstance(iat, (int, long, float)) and iat - leeway > now:
+    raise InvalidTokenError('Token issued in the future')
+
+  if verify_audience:
+    aud = claims.get('aud')
+    if not isinstance(aud, list):
+      aud = [aud]
+    if audience not in aud:
+      raise InvalidTokenError('Invalid audience: %s' % claims.get('aud'))
+  if issuers is not None and claims.get('iss') not in issuers:
+    raise InvalidTokenError('Invalid issuer: %s' % claims.get('iss'))
+
+  return claims
+
+
+def _b64decode(data):
+  data = str(data)
+  return base64.urlsafe_b64decode(data + '=' * (-len(data) % 4))
+
+
+def _b64decode_long(data):
+  return long(_b64decode(data).encode('hex') or '0', 16)
+
+
+def _long_to_bytes(n, size):
+  data = '%x' % n
+  return ('0' * (size * 2 - len(data)) + data).decode('hex')
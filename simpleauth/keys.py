@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*-
+"""Provider public keys used to verify ID tokens locally.
+
+KeyManager fetches JWKS documents, e.g.
+https://www.googleapis.com/oauth2/v3/certs, parses the keys once and keeps
+them in memory, so that verifying a token doesn't make any requests.
+"""
+import collections
+import json
+import logging
+import re
+import threading
+import time
+
+from idtoken import RSAPublicKey, ECPublicKey, InvalidTokenError
+from singleflight import SingleFlight
+
+__all__ = ['KeyManager']
+
+
+# Parsed keys of a JWKS document. keys is a dict of {kid: key}.
+KeySet = collections.namedtuple('KeySet', ['keys', 'fetched', 'expires'])
+
+_MAX_AGE_RE = re.compile(r'(?:^|,)\s*max-age\s*=\s*"?(\d+)"?', re.I)
+_NO_CACHE_RE = re.compile(r'(?:^|,)\s*no-(?:cache|store)\b', re.I)
+
+# JWK key type: key class
+KEY_TYPES = {
+  'RSA': RSAPublicKey,
+  'EC': ECPublicKey,
+}
+
+
+class KeyManager(object):
+  """Caches parsed public keys of JWKS documents.
+
+  Documents are kept for as long as their Cache-Control max-age says,
+  within [min_ttl, max_ttl], or ttl if there's no max-age. When a document
+  is about to expire, it is fetched again right away, once for concurrent
+  callers. If that fails, the cached keys are used until they expire.
+
+  With background=True the cached keys are used at once and the document
+  is fetched in a background thread meanwhile. Threads started by
+  a request can't outlive it on App Engine standard, and have no memcache
+  or urlfetch, so there it needs an instance class with
+  google.appengine.api.background_thread.
+
+  If a token has a kid which is not in the cached document, e.g. after
+  a key rotation, the document is fetched again right away, but at most
+  once per refetch_interval, so that made up kids can't be used to flood
+  the provider with requests.
+
+  A single instance is meant to be shared by the whole process, e.g.
+  SimpleAuthHandler.KEY_MANAGER. It is thread-safe.
+  """
+
+  def __init__(self, ttl=3600, min_ttl=60, max_ttl=86400, refresh_ahead=300,
+               refetch_interval=60, background=False):
+    """
+    Args:
+      ttl: int, seconds a document is kept if response has no max-age.
+      min_ttl: int, lower bound of max-age.
+      max_ttl: int, upper bound of max-age.
+      refresh_ahead: int, a document is refreshed when it has less than
+                     this many seconds left to live. 0 turns it off.
+      refetch_interval: int, min seconds between fetches due to unknown kid.
+      background: bool, refresh documents which are still valid in
+                  a background thread, see class docs.
+    """
+    self.ttl = ttl
+    self.min_ttl = min_ttl
+    self.max_ttl = max_ttl
+    self.refresh_ahead = refresh_ahead
+    self.refetch_interval = refetch_interval
+    self.background = background
+    # jwks_uri: KeySet
+    self._keysets = {}
+    self._refreshes = SingleFlight(ttl=0)
+    # jwks_uri: background refresh thread
+    self._refreshing = {}
+    self._lock = threading.Lock()
+
+  def get_key(self, jwks_uri, kid, transport):
+    """Returns a parsed key or None if JWKS document has no such key.
+
+    The document is fetched with transport if it isn't cached yet, has
+    expired or doesn't have the key.
+    """
+    now = time.time()
+    keyset = self._keysets.get(jwks_uri)
+    if keyset is not None and now < keyset.expires:
+      if kid in keyset.keys:
+        if keyset.expires - now >= self.refresh_ahead:
+          return keyset.keys[kid]
+        if self.background:
+          self._refresh_in_background(jwks_uri, transport)
+          return keyset.keys[kid]
+        return self._refresh_ahead(jwks_uri, transport, keyset).keys.get(kid)
+      if now - keyset.fetched < self.refetch_interval:
+        logging.debug('Unknown kid %s, %s was fetched recently', kid, jwks_uri)
+        return None
+
+    try:
+      keyset = self.refresh(jwks_uri, transport)
+    except InvalidTokenError:
+      # rather use stale keys than fail all logins while provider is down
+      if keyset is None or kid not in keyset.keys:
+        raise
+      logging.warning('Using stale keys of %s', jwks_uri, exc_info=True)
+    return keyset.keys.get(kid)
+
+  def refresh(self, jwks_uri, transport):
+    """Fetches and parses a JWKS document. Returns a KeySet."""
+    try:
+      resp = transport.fetch(jwks_uri)
+    except Exception as e:
+      raise InvalidTokenError('Could not fetch %s: %s' % (jwks_uri, e))
+    if resp.status_code != 200:
+      raise InvalidTokenError('Could not fetch %s (status: %d)' % (
+          jwks_uri, resp.status_code))
+    try:
+      keys = parse_jwks(resp.content)
+    except (ValueError, AttributeError) as e:
+      raise InvalidTokenError('Invalid JWKS document %s: %s' % (jwks_uri, e))
+
+    now = time.time()
+    ttl = self._ttl(resp.headers)
+    keyset = KeySet(keys, now, now + ttl)
+    with self._lock:
+      self._keysets[jwks_uri] = keyset
+    logging.debug('Fetched %d keys of %s, ttl %ds', len(keys), jwks_uri, ttl)
+    return keyset
+
+  def clear(self):
+    with self._lock:
+      self._keysets.clear()
+
+  def _ttl(self, headers):
+    """Returns seconds to keep a document given its response headers."""
+    cache_control = headers.get('cache-control', '')
+    if _NO_CACHE_RE.search(cache_control):
+      return self.min_ttl
+    match = _MAX_AGE_RE.search(cache_control)
+    if match is None:
+      return self.ttl
+    ttl = int(match.group(1))
+    try:
+      # time the response has spent in HTTP caches
+      ttl -= int(headers.get('age', 0))
+    except ValueError:
+      pass
+    return max(self.min_ttl, min(ttl, self.max_ttl))
+
+  def _refresh_ahead(self, jwks_uri, transport, keyset):
+    """Refreshes a document which is about to expire. Returns the new
+    KeySet, or keyset if the refresh failed.
+    """
+    try:
+      self._refreshes.do(jwks_uri,
+                         lambda: self._refresh_if_due(jwks_uri, transport))
+    except InvalidTokenError:
+      logging.warning('Could not refresh %s, using cached keys', jwks_uri,
+                      exc_info=True)
+      return keyset
+    return self._keysets.get(jwks_uri, keyset)
+
+  def _refresh_if_due(self, jwks_uri, transport):
+    keyset = self._keysets.get(jwks_uri)
+    if keyset is not None and (
+        keyset.expires - time.time() >= self.refresh_ahead):
+      # a concurrent refresh has just finished
+      return
+    self.refresh(jwks_uri, transport)
+
+  def _refresh_in_background(self, jwks_uri, transport):
+    with self._lock:
+      if jwks_uri in self._refreshing:
+        return
+      thread = threading.Thread(target=self._background_refresh,
+                                args=(jwks_uri, transport))
+      thread.daemon = True
+      self._refreshing[jwks_uri] = thread
+    thread.start()
+
+  def _background_refresh(self, jwks_uri, transport):
+    try:
+      self.refresh(jwks_uri, transport)
+    except Exception:
+      logging.warning('Background refresh of %s failed', jwks_uri,
+                      exc_info=True)
+    finally:
+      with self._lock:
+        self._refreshing.pop(jwks_uri, None)
+
+
+def parse_jwks(content):
+  """Returns a dict of {kid: key} of a JWKS document.
+
+  Keys of unsupported types are skipped.
+  """
+  keys = {}
+  for jwk in json.loads(content).get('keys', []):
+    key_class = KEY_TYPES.get(jwk.get('kty'))
+    if key_class is None:
+      logging.debug('Skipping JWK %s of type %s', jwk.get('kid'),
+                    jwk.get('kty'))
+      continue
+    try:
+      keys[jwk.get('kid')] = key_class.from_jwk(jwk)
+    except (InvalidTokenError, KeyError, ValueError, TypeError) as e:
+      logging.debug('Skipping JWK %s: %s', jwk.get('kid'), e)
+  return keys
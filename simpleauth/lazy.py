@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+"""Modules imported on first use.
+
+Importing simpleauth shouldn't pull in libraries which only some logins
+need, e.g. oauth2 and httplib2 for OAuth 1.0 or users API for OpenID: on
+App Engine, instance cold starts pay for every module imported.
+See bench/import_bench.py.
+"""
+import importlib
+
+
+class LazyModule(object):
+  """Stands in for a module which is imported on first attribute access.
+
+    etree = LazyModule('lxml.etree', 'xml.etree.cElementTree')
+
+  If there are several names, the first one which can be imported is used.
+  """
+
+  def __init__(self, name, *fallbacks):
+    self._names = (name,) + fallbacks
+    self._module = None
+
+  def __getattr__(self, attr):
+    module = self._module
+    if module is None:
+      module = self._module = self._import()
+    return getattr(module, attr)
+
+  def _import(self):
+    for name in self._names[:-1]:
+      try:
+        return importlib.import_module(name)
+      except ImportError:
+        pass
+    return importlib.import_module(self._names[-1])
+
+  def __repr__(self):
+    if self._module is None:
+      return '<lazy module %s>' % self._names[0]
+    return repr(self._module)
@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+"""Coalescing of concurrent duplicate calls.
+
+Users double-click and browsers retry, so the same OAuth 2.0 callback,
+with the same authorization code, may arrive two or three times within
+milliseconds. Only the first token request with a code succeeds at the
+provider. With SingleFlight the duplicates wait for the first exchange and
+get its result instead of making their own requests.
+
+Results, i.e. tokens and user info, stay in memory of the process which
+made the call. A shared store only tells other app instances that a call
+is in flight or done.
+"""
+import collections
+import copy
+import logging
+import sys
+import threading
+import time
+
+__all__ = ['SingleFlight', 'DuplicateCallError']
+
+
+# Stored in SingleFlight.store while a call is in flight, and once it's done
+_PENDING = 'pending'
+_DONE = 'done'
+
+
+class DuplicateCallError(Exception):
+  """Raised in duplicates of a call which another app instance has made.
+  Its result isn't shared across instances.
+  """
+
+
+class Flight(object):
+  """A call in flight, shared by the caller making it, i.e. the leader,
+  and the callers waiting for its result.
+  """
+
+  def __init__(self, group, key):
+    self.group = group
+    self.key = key
+    self._done = threading.Event()
+    self._result = None
+    self._exc_info = None
+
+  def finish(self, result):
+    """Called by the leader with the call's result."""
+    # the leader's copy is its own to modify
+    self._resolve(copy.deepcopy(result), None)
+    self.group._finished(self)
+
+  def fail(self, exc_info):
+    """Called by the leader with sys.exc_info() if the call raised."""
+    self._resolve(None, exc_info)
+    self.group._failed(self)
+
+  def _resolve(self, result, exc_info):
+    self._result = result
+    self._exc_info = exc_info
+    self._done.set()
+
+  def wait(self, timeout=None):
+    """Waits for the leader. Returns True if it is done."""
+    return self._done.wait(timeout)
+
+  def get_result(self):
+    """Returns a copy of the leader's result or re-raises its exception.
+    Call after wait() has returned True.
+    """
+    if self._exc_info is not None:
+      raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+    return copy.deepcopy(self._result)
+
+
+class SingleFlight(object):
+  """Makes one call per key at a time. Concurrent calls with the same key
+  wait for it and share its result.
+
+  Results are kept for ttl seconds after the call, so that a duplicate
+  which arrives right after it is over gets the result too. The default
+  of 0 keeps them only while the call is in flight. Failed calls aren't
+  kept. Callers wait for at most wait seconds and then make the call
+  themselves.
+
+  If store is set, e.g. cache.MemcacheCache(), duplicates on other app
+  instances wait as well, polling the store every poll_interval seconds.
+  Once the call is done they raise DuplicateCallError rather than making
+  it again. If it fails, one of them makes it. Only markers are stored,
+  never results.
+
+  A single instance is meant to be shared by the whole process, e.g.
+  SimpleAuthHandler.CALLBACK_SINGLEFLIGHT. It is thread-safe.
+  """
+
+  def __init__(self, ttl=0, wait=30, store=None, poll_interval=0.1):
+    """
+    Args:
+      ttl: int, seconds results are kept for late duplicates.
+      wait: float, max seconds a duplicate waits for the call. Also how
+            long the store keeps a done marker.
+      store: cache.Cache backend shared by app instances, or None.
+      poll_interval: float, seconds between store reads while waiting
+                     for a call on another instance.
+    """
+    self.ttl = ttl
+    self.wait = wait
+    self.store = store
+    self.poll_interval = poll_interval
+    # key: Flight, in flight or finished within ttl
+    self._flights = {}
+    # (expires, Flight) of finished flights, oldest first
+    self._finished_flights = collections.deque()
+    self._lock = threading.Lock()
+
+  def do(self, key, func):
+    """Returns func() result, or a copy of the result of a concurrent or
+    recent call with the same key. The call's exception is re-raised
+    in all callers.
+    """
+    flight, leader = self.begin(key)
+    if not leader:
+      if flight.wait(self.wait):
+        return flight.get_result()
+      logging.warning('Timed out waiting for call %s, making it again', key)
+      return func()
+    try:
+      result = func()
+    except Exception:
+      flight.fail(sys.exc_info())
+      raise
+    flight.finish(result)
+    return result
+
+  def begin(self, key):
+    """Returns a (flight, leader) tuple.
+
+    The leader makes the call and then must call flight.finish() or
+    flight.fail(). Others wait() for it and get_result(). If the call is in
+    flight on another instance, this blocks until it's over, and the
+    returned flight raises DuplicateCallError if it succeeded.
+    """
+    with self._lock:
+      self._expire(time.time())
+      flight = self._flights.get(key)
+      if flight is not None:
+        return flight, False
+      flight = self._flights[key] = Flight(self, key)
+
+    if self.store is not None and not self._wait_for_store(key):
+      try:
+        raise DuplicateCallError('Call %s was made by another instance' % key)
+      except DuplicateCallError:
+        # local duplicates get the same error, nothing is written back
+        flight._resolve(None, sys.exc_info())
+      self._forget(flight)
+      return flight, False
+    return flight, True
+
+  def clear(self):
+    with self._lock:
+      self._flights.clear()
+      self._finished_flights.clear()
+
+  def _wait_for_store(self, key):
+    """Adds a pending marker for key to the store, or if another instance
+    has, waits for the call there.
+
+    Returns True if this instance is to make the call, or False if another
+    instance has made it.
+    """
+    store_key = self._store_key(key)
+    deadline = time.time() + self.wait
+    while not self.store.add(store_key, _PENDING, ttl=self.wait):
+      value = self.store.get(store_key)
+      if value == _DONE:
+        return False
+      if time.time() >= deadline:
+        logging.warning('Timed out waiting for call %s on another instance',
+                        key)
+        return True
+      if value is None:
+        # the other instance's call failed, try to take over
+        continue
+      time.sleep(self.poll_interval)
+    return True
+
+  def _finished(self, flight):
+    if self.ttl:
+      with self._lock:
+        self._finished_flights.append((time.time() + self.ttl, flight))
+    else:
+      self._forget(flight)
+    if self.store is not None:
+      self.store.set(self._store_key(flight.key), _DONE, ttl=self.wait)
+
+  def _failed(self, flight):
+    self._forget(flight)
+    if self.store is not None:
+      self.store.delete(self._store_key(flight.key))
+
+  def _forget(self, flight):
+    with self._lock:
+      if self._flights.get(flight.key) is flight:
+        del self._flights[flight.key]
+
+  def _expire(self, now):
+    """Forgets finished flights older than ttl. Called with the lock held."""
+    while self._finished_flights and self._finished_flights[0][0] <= now:
+      flight = self._finished_flights.popleft()[1]
+      if self._flights.get(flight.key) is flight:
+        del self._flights[flight.key]
+
+  def _store_key(self, key):
+    return 'singleflight:%s' % key
@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+"""Compact encoding of the OAuth 2.0 'state' parameter.
+
+By default SimpleAuthHandler puts plain JSON in the state, which is
+URL-encoded into the authorization redirect and can get long with large
+'extra' params. StateCodec compresses it into a short URL-safe string,
+optionally encrypts it and, if the result is still over a size budget,
+keeps the whole state server-side and sends only a reference to it.
+
+Encoded states are prefixed with a version char:
+
+  'j' - compact JSON, urlsafe base64
+  'z' - deflate-compressed JSON, urlsafe base64
+  'e' - 'j' or 'z' payload, AES encrypted and HMAC-SHA256 signed
+  'r' - random reference to a state kept in a cache store
+
+Compression is skipped for short states where it doesn't pay off.
+
+Unless states are encrypted, anything starting with '{' is decoded as
+plain JSON, so that redirects issued before the codec was enabled still
+work.
+"""
+import base64
+import hashlib
+import hmac
+import json
+import logging
+import os
+import zlib
+
+from lazy import LazyModule
+
+security = LazyModule('webapp2_extras.security')
+
+# PyCrypto is optional and only needed for encrypted states.
+# On App Engine add it to the libraries section of app.yaml.
+try:
+  from Crypto.Cipher import AES
+except ImportError:
+  AES = None
+
+__all__ = ['StateCodec']
+
+
+class StateCodec(object):
+  """Encodes a state dict into a short string and back."""
+
+  JSON = 'j'
+  COMPRESSED = 'z'
+  ENCRYPTED = 'e'
+  REFERENCE = 'r'
+
+  # bytes of HMAC-SHA256 kept in encrypted states
+  MAC_SIZE = 16
+
+  # max bytes a compressed state may inflate to
+  MAX_DECOMPRESSED_SIZE = 64 * 1024
+
+  def __init__(self, max_size=512, store=None, secret=None, encrypt=False,
+               ttl=3600):
+    """
+    Args:
+      max_size: int, max length of an encoded state. Larger states are
+                moved to the store, if there is one.
+      store: a cache backend, e.g. cache.MemcacheCache(), where oversized
+             states are kept. Use a store shared by all app instances.
+      secret: string, encryption and signing key. Required if encrypt
+              is True.
+      encrypt: bool, whether to encrypt states. Requires PyCrypto.
+      ttl: int, how long oversized states are kept in the store, in seconds.
+    """
+    if encrypt and not secret:
+      raise ValueError('Encrypted state requires a secret')
+    if encrypt and AES is None:
+      raise ValueError('Encrypted state requires PyCrypto')
+
+    self.max_size = max_size
+    self.store = store
+    self.encrypt = encrypt
+    self.ttl = ttl
+    if secret:
+      self._enc_key = hashlib.sha256('enc:' + secret).digest()
+      self._mac_key = hashlib.sha256('mac:' + secret).digest()
+
+  def encode(self, state):
+    """Returns an encoded string of a JSON-serializable state dict."""
+    data = self._pack(state)
+    if self.encrypt:
+      encoded = self.ENCRYPTED + _b64encode(self._seal(data))
+    else:
+      encoded = data[0] + _b64encode(data[1:])
+
+    if len(encoded) <= self.max_size:
+      return encoded
+    if self.store is None:
+      logging.warning('Encoded state is %d chars long, over %d budget',
+                      len(encoded), self.max_size)
+      return encoded
+
+    ref = _b64encode(os.urandom(18))
+    self.store.set(self._store_key(ref), encoded, ttl=self.ttl)
+    return self.REFERENCE + ref
+
+  def decode(self, encoded):
+    """Returns state dict of an encoded string.
+
+    Raises ValueError if the string can't be decoded, was tampered with
+    or refers to a state which is no longer in the store.
+    """
+    if not encoded:
+      raise ValueError('Empty state')
+    try:
+      encoded = str(encoded)
+    except UnicodeEncodeError:
+      raise ValueError('Invalid state encoding')
+    version, data = encoded[0], encoded[1:]
+
+    if version == '{':
+      if self.encrypt:
+        # plain states are not accepted once encryption is on
+        raise ValueError('Unencrypted state')
+      return json.loads(encoded)
+
+    if version == self.REFERENCE:
+      if self.store is None:
+        raise ValueError('No store to look up state reference')
+      key = self._store_key(data)
+      stored = self.store.get(key)
+      if stored is None:
+        raise ValueError('Unknown or expired state reference')
+      # each state is good for a single callback
+      self.store.delete(key)
+      return self.decode(stored)
+
+    try:
+      data = _b64decode(data)
+    except TypeError:
+      raise ValueError('Invalid state encoding')
+
+    if version == self.ENCRYPTED:
+      return self._unpack(self._open(data))
+    if self.encrypt:
+      # plain states are not accepted once encryption is on
+      raise ValueError('Unencrypted state')
+    return self._unpack(version + data)
+
+  def _pack(self, state):
+    """Returns serialized state prefixed with JSON or COMPRESSED marker."""
+    data = json.dumps(state, separators=(',', ':'))
+    deflate = zlib.compressobj(9, zlib.DEFLATED, -zlib.MAX_WBITS)
+    compressed = deflate.compress(data) + deflate.flush()
+    if len(compressed) < len(data):
+      return self.COMPRESSED + compressed
+    return self.JSON + data
+
+  def _unpack(self, data):
+    version, data = data[:1], data[1:]
+    try:
+      if version == self.COMPRESSED:
+        inflate = zlib.decompressobj(-zlib.MAX_WBITS)
+        data = inflate.decompress(data, self.MAX_DECOMPRESSED_SIZE)
+        if inflate.unconsumed_tail:
+          raise ValueError('State too large')
+      elif version != self.JSON:
+        raise ValueError('Unsupported state version: %s' % version)
+      return json.loads(data)
+    except zlib.error:
+      raise ValueError('Invalid state data')
+
+  def _seal(self, data):
+    iv = os.urandom(AES.block_size)
+    ciphertext = iv + AES.new(self._enc_key, AES.MODE_CFB, iv).encrypt(data)
+    return ciphertext + self._mac(ciphertext)
+
+  def _open(self, data):
+    if not self.encrypt:
+      raise ValueError('Encrypted state but no secret configured')
+    ciphertext, mac = data[:-self.MAC_SIZE], data[-self.MAC_SIZE:]
+    if len(ciphertext) < AES.block_size or not security.compare_hashes(
+        mac, self._mac(ciphertext)):
+      raise ValueError('Invalid state signature')
+    iv, ciphertext = ciphertext[:AES.block_size], ciphertext[AES.block_size:]
+    return AES.new(self._enc_key, AES.MODE_CFB, iv).decrypt(ciphertext)
+
+  def _mac(self, data):
+    return hmac.new(self._mac_key, data, hashlib.sha256).digest()[
+        :self.MAC_SIZE]
+
+  def _store_key(self, ref):
+    return 'oauth2_state:%s' % ref
+
+
+def _b64encode(data):
+  return base64.urlsafe_b64encode(data).rstrip('=')
+
+
+def _b64decode(data):
+  return base64.urlsafe_b64decode(data + '=' * (-len(data) % 4))
+
@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+"""OAuth 2.0 access tokens of signed in users, kept fresh.
+
+Token responses of providers like Google and Windows Live include
+a refresh_token and expires_in. TokenManager keeps tokens per (user,
+provider) and renews them with the refresh token before they expire, so
+that the app can call provider APIs on behalf of a user without sending
+them through the login again.
+"""
+import logging
+import threading
+import time
+
+from cache import LRUCache
+from singleflight import SingleFlight
+
+__all__ = ['TokenManager']
+
+
+class TokenManager(object):
+  """Stores access tokens per (user_id, provider) and refreshes them.
+
+  get() returns a token from memory. A token which expires within
+  refresh_ahead seconds, or has expired, is refreshed right away. If the
+  refresh of a token which is still valid fails, it is returned anyway.
+  Concurrent refreshes of the same token are made once.
+
+  With background=True a token which is still valid is returned at once
+  and refreshed in a background thread meanwhile. Threads started by
+  a request can't outlive it on App Engine standard, and have no memcache
+  or urlfetch, so there it needs an instance class with
+  google.appengine.api.background_thread. Otherwise call refresh_due()
+  from a cron or task queue handler instead.
+
+  Tokens are kept in memory, at most max_size of them, and in store, e.g.
+  cache.DatastoreCache(), so that they survive instance restarts and are
+  shared with other app instances.
+
+  refresh is a function of (provider, refresh_token) which returns a token
+  response dict, e.g. SimpleAuthHandler._oauth2_refresh().
+
+  A single instance is meant to be shared by the whole process, e.g.
+  SimpleAuthHandler.TOKEN_MANAGER. It is thread-safe.
+  """
+
+  def __init__(self, store=None, refresh_ahead=300, max_size=10000,
+               background=False):
+    """
+    Args:
+      store: cache.Cache backend shared by app instances, or None.
+      refresh_ahead: int, tokens are refreshed when they have less than
+                     this many seconds left to live.
+      max_size: int, max number of tokens kept in memory.
+      background: bool, refresh tokens which are still valid in
+                  a background thread, see class docs.
+    """
+    self.store = store
+    self.refresh_ahead = refresh_ahead
+    self.background = background
+    self._memory = LRUCache(max_size=max_size)
+    self._refreshes = SingleFlight(ttl=0)
+    # key: background refresh thread
+    self._refreshing = {}
+    self._lock = threading.Lock()
+
+  def put(self, user_id, provider, auth_info):
+    """Stores tokens of a token response. Returns the stored token dict.
+
+    If auth_info has no refresh_token, the one already stored is kept.
+    """
+    token = {
+      'access_token': auth_info['access_token'],
+      'refresh_token': auth_info.get('refresh_token'),
+      'expires': None,
+    }
+    expires_in = auth_info.get('expires_in') or auth_info.get('expires')
+    if expires_in:
+      token['expires'] = time.time() + int(expires_in)
+    if not token['refresh_token']:
+      old = self._load(self._key(user_id, provider))
+      if old is not None:
+        token['refresh_token'] = old['refresh_token']
+    self._save(self._key(user_id, provider), token)
+    return token
+
+  def get(self, user_id, provider, refresh):
+    """Returns a valid access token or None if there is none.
+
+    Args:
+      user_id: string, user ID, e.g. provider's user ID.
+      provider: string, provider name.
+      refresh: function of (provider, refresh_token), see class docs.
+    """
+    key = self._key(user_id, provider)
+    token = self._load(key)
+    if token is None:
+      return None
+    expires = token['expires']
+    if expires is None:
+      return token['access_token']
+
+    left = expires - time.time()
+    if left > self.refresh_ahead:
+      return token['access_token']
+    if left > 0 and self.background:
+      self._refresh_in_background(key, refresh)
+      return token['access_token']
+
+    try:
+      self._refreshes.do(key, lambda: self._refresh(key, refresh, True))
+    except Exception:
+      logging.warning('Could not refresh %s token of %s', provider, user_id,
+                      exc_info=True)
+    # the old token if the refresh failed
+    token = self._load(key)
+    if token is None or (token['expires'] is not None and
+                         token['expires'] <= time.time()):
+      return None
+    return token['access_token']
+
+  def refresh(self, user_id, provider, refresh):
+    """Refreshes a token now. Returns the new token dict, or None if
+    there's no refresh token.
+    """
+    key = self._key(user_id, provider)
+    return self._refreshes.do(key, lambda: self._refresh(key, refresh))
+
+  def refresh_due(self, refresh, keys=None):
+    """Refreshes tokens which expire within refresh_ahead seconds, e.g.
+    from a cron or task queue handler.
+
+    Args:
+      refresh: function of (provider, refresh_token), see class docs.
+      keys: list of (user_id, provider) to check. Defaults to the tokens
+            in memory.
+
+    Returns number of tokens refreshed. Failures are logged.
+    """
+    if keys is None:
+      keys = self._memory.keys()
+    else:
+      keys = [self._key(user_id, provider) for user_id, provider in keys]
+
+    refreshed = 0
+    for key in keys:
+      token = self._load(key)
+      if token is None or not self._due(token):
+        continue
+      try:
+        if self._refreshes.do(key, lambda: self._refresh(key, refresh, True)):
+          refreshed += 1
+      except Exception:
+        logging.warning('Could not refresh token %s', key, exc_info=True)
+    return refreshed
+
+  def delete(self, user_id, provider):
+    key = self._key(user_id, provider)
+    self._memory.delete(key)
+    if self.store is not None:
+      self.store.delete(self._store_key(key))
+
+  def _refresh(self, key, refresh, if_due=False):
+    """Returns the new token dict, or None if the token wasn't refreshed."""
+    token = self._load(key)
+    if token is None or not token['refresh_token']:
+      return None
+    if if_due and not self._due(token):
+      # a concurrent refresh has just finished
+      return None
+    user_id, provider = key
+    auth_info = refresh(provider, token['refresh_token'])
+    logging.debug('Refreshed %s token of %s', provider, user_id)
+    return self.put(user_id, provider, auth_info)
+
+  def _refresh_in_background(self, key, refresh):
+    with self._lock:
+      if key in self._refreshing:
+        return
+      thread = threading.Thread(target=self._background_refresh,
+                                args=(key, refresh))
+      thread.daemon = True
+      self._refreshing[key] = thread
+    thread.start()
+
+  def _background_refresh(self, key, refresh):
+    try:
+      self._refreshes.do(key, lambda: self._refresh(key, refresh, True))
+    except Exception:
+      logging.warning('Background refresh of token %s failed', key,
+                      exc_info=True)
+    finally:
+      with self._lock:
+        self._refreshing.pop(key, None)
+
+  def _due(self, token):
+    expires = token['expires']
+    return expires is not None and expires <= time.time() + self.refresh_ahead
+
+  def _load(self, key):
+    token = self._memory.get(key)
+    if token is None and self.store is not None:
+      token = self.store.get(self._store_key(key))
+      if token is not None:
+        self._memory.set(key, token)
+    return token
+
+  def _save(self, key, token):
+    self._memory.set(key, token)
+    if self.store is not None:
+      self.store.set(self._store_key(key), token)
+
+  def _key(self, user_id, provider):
+    return (unicode(user_id), provider)
+
+  def _store_key(self, key):
+    return 'token:%s:%s' % (key[1], key[0])
@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+"""Per-phase timing hooks of the auth flow.
+
+SimpleAuthHandler wraps each phase of a login in TRACER.span(provider,
+phase). Phases are:
+
+  init           whole init step, e.g. _oauth2_init()
+  request_token  OAuth 1.0a request token fetch
+  callback       whole callback step, e.g. _oauth2_callback()
+  csrf           OAuth 2.0 CSRF state token validation
+  token          access token exchange
+  fetch          each HTTP request to the provider, retries included
+  parse          token response parsing
+  user_info      _get_<provider>_user_info() fetcher, cache hits excluded
+  id_token       OpenID Connect id_token verification, if enabled
+  signin         app's _on_signin()
+
+Phases nest: callback includes csrf, token, parse, id_token and user_info.
+request_token, token and user_info include a fetch per request.
+request_token, token and fetch spans carry provider HTTP response status.
+fetch spans also carry response body sizes, see Tracer.on_phase_bytes().
+
+The default NullTracer does nothing. To collect timings, subclass Tracer
+and implement on_phase_end(), or use LoggingTracer or StatsdTracer.
+"""
+import logging
+import time
+
+__all__ = ['Tracer',
+           'NullTracer',
+           'LoggingTracer',
+           'StatsdTracer']
+
+
+class Tracer(object):
+  """Base class for tracers. Subclasses override on_phase_start() and/or
+  on_phase_end(). Both are called synchronously so they should be fast.
+  """
+
+  def span(self, provider, phase):
+    """Returns a context manager which times the phase.
+
+    Set status attribute of the returned object to report HTTP status
+    of the phase, and wire_bytes and content_bytes to report response
+    body sizes.
+    """
+    return Span(self, provider, phase)
+
+  def on_phase_start(self, provider, phase):
+    pass
+
+  def on_phase_end(self, provider, phase, duration, status=None, error=None):
+    """Called when a phase is over.
+
+    Args:
+      provider: string, provider name, e.g. 'google'.
+      phase: string, one of the phases listed in module docs.
+      duration: float, seconds.
+      status: int, provider HTTP response status or None.
+      error: exception the phase failed with or None.
+    """
+    pass
+
+  def on_phase_bytes(self, provider, phase, wire_bytes, content_bytes):
+    """Called right before on_phase_end() of a phase which received
+    a response, i.e. fetch.
+
+    Args:
+      provider: string, provider name, or None outside of a login step.
+      phase: string, one of the phases listed in module docs.
+      wire_bytes: int, response body bytes received.
+      content_bytes: int, body bytes after decompression.
+    """
+    pass
+
+
+class Span(object):
+  __slots__ = ('tracer', 'provider', 'phase', 'status', 'wire_bytes',
+               'content_bytes', '_start')
+
+  def __init__(self, tracer, provider, phase):
+    self.tracer = tracer
+    self.provider = provider
+    self.phase = phase
+    self.status = None
+    self.wire_bytes = None
+    self.content_bytes = None
+
+  def __enter__(self):
+    self.tracer.on_phase_start(self.provider, self.phase)
+    self._start = time.time()
+    return self
+
+  def __exit__(self, exc_type, exc_value, tb):
+    duration = time.time() - self._start
+    if self.wire_bytes is not None:
+      self.tracer.on_phase_bytes(self.provider, self.phase, self.wire_bytes,
+                                 self.content_bytes)
+    self.tracer.on_phase_end(self.provider, self.phase, duration,
+                             status=self.status, error=exc_value)
+    return False
+
+
+class _NullSpan(object):
+  """Shared by all phases of NullTracer. Attributes are discarded."""
+  __slots__ = ()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, tb):
+    return False
+
+  def __setattr__(self, name, value):
+    pass
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class NullTracer(Tracer):
+  """Does nothing. Used by default."""
+
+  def span(self, provider, phase):
+    return _NULL_SPAN
+
+
+class LoggingTracer(Tracer):
+  """Logs a line per phase, e.g.
+
+  simpleauth google token 152.3ms status=200
+
+  and a line of response sizes per fetch, e.g.
+
+  simpleauth google fetch wire=312B content=1024B
+  """
+
+  def __init__(self, level=logging.INFO, logger=None):
+    self.level = level
+    self.logger = logger or logging.getLogger()
+
+  def on_phase_end(self, provider, phase, duration, status=None, error=None):
+    msg = 'simpleauth %s %s %.1fms' % (provider, phase, duration * 1000)
+    if status is not None:
+      msg += ' status=%d' % status
+    if error is not None:
+      msg += ' error=%s' % error.__class__.__name__
+    self.logger.log(self.level, msg)
+
+  def on_phase_bytes(self, provider, phase, wire_bytes, content_bytes):
+    self.logger.log(self.level, 'simpleauth %s %s wire=%dB content=%dB',
+                    provider, phase, wire_bytes, content_bytes)
+
+
+class StatsdTracer(Tracer):
+  """Sends phase timings and counters to a StatsD client.
+
+  The client needs timing(stat, ms) and incr(stat, count=1) methods, e.g.
+  statsd.StatsClient. For each phase it sends:
+
+    <prefix>.<provider>.<phase>                timing, ms
+    <prefix>.<provider>.<phase>.status.<N>     counter, if status is known
+    <prefix>.<provider>.<phase>.error          counter, on errors
+    <prefix>.<provider>.<phase>.wire_bytes     counter, of fetch phases
+    <prefix>.<provider>.<phase>.content_bytes  counter, of fetch phases
+  """
+
+  def __init__(self, client, prefix='simpleauth'):
+    self.client = client
+    self.prefix = prefix
+
+  def on_phase_end(self, provider, phase, duration, status=None, error=None):
+    stat = '%s.%s.%s' % (self.prefix, provider, phase)
+    self.client.timing(stat, duration * 1000)
+    if status is not None:
+      self.client.incr('%s.status.%d' % (stat, status))
+    if error is not None:
+      self.client.incr(stat + '.error')
+
+  def on_phase_bytes(self, provider, phase, wire_bytes, content_bytes):
+    stat = '%s.%s.%s' % (self.prefix, provider, phase)
+    self.client.incr(stat + '.wire_bytes', wire_bytes)
+    self.client.incr(stat + '.content_bytes', content_bytes)
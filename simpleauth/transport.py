@@ -0,0 +1,530 @@
+# -*- coding: utf-8 -*-
+"""HTTP transports SimpleAuthHandler uses to talk to auth providers.
+
+A transport has a fetch() method which returns a Response, and fetch_async()
+which returns an object with get_result() method.
+URLFetchTransport is the default and goes through App Engine URLfetch API.
+PooledTransport keeps keep-alive connections to provider hosts and reuses them
+across requests, so that a login doesn't pay for a new TLS handshake to
+the token and profile endpoints every time.
+
+Both ask providers for gzip or deflate compressed responses and decompress
+them, so Response.content is always the plain body. Both raise TransportError
+if a request fails without a response.
+"""
+import errno
+import logging
+import select
+import socket
+import sys
+import threading
+import time
+import urlparse
+import zlib
+
+from lazy import LazyModule
+
+# imported on first use: httplib pulls in ssl, oauth2 pulls in httplib2
+httplib = LazyModule('httplib')
+# it's a OAuth 1.0 spec even though the lib is called oauth2
+oauth1 = LazyModule('oauth2')
+urlfetch = LazyModule('google.appengine.api.urlfetch')
+
+__all__ = ['Response',
+           'TransportError',
+           'Transport',
+           'URLFetchTransport',
+           'PooledTransport',
+           'OAuth1Client']
+
+
+FORM_CONTENT_TYPE = 'application/x-www-form-urlencoded'
+
+# Sent by transports unless a request has its own Accept-Encoding
+ACCEPT_ENCODING = 'gzip, deflate'
+
+# Bytes PooledTransport reads off a socket at a time
+READ_CHUNK_SIZE = 16 * 1024
+
+# Shared by all OAuth1Client instances, see _signature_method().
+_SIGNATURE_METHOD = None
+
+
+class Response(object):
+  """HTTP response returned by a transport.
+
+  Header names are lower-cased. status is an alias of status_code so that
+  the response can be used where httplib2.Response was expected.
+  content is decompressed; wire_size is the number of body bytes received,
+  which is less than len(content) if the response was compressed.
+  """
+
+  def __init__(self, status_code, content, headers=None, wire_size=None):
+    self.status_code = status_code
+    self.content = content
+    self.headers = dict((k.lower(), v) for k, v in (headers or {}).items())
+    if wire_size is None:
+      wire_size = len(content or '')
+    self.wire_size = wire_size
+
+  @property
+  def status(self):
+    return self.status_code
+
+
+class TransportError(IOError):
+  """A request failed without a response, e.g. the connection was refused,
+  reset or timed out.
+  """
+  pass
+
+
+class Transport(object):
+  """Base class for transports. Subclasses must implement fetch().
+
+  Built-in transports send accept_encoding as Accept-Encoding header;
+  set it to None to ask for uncompressed responses. They also count
+  received bytes, see stats().
+  """
+
+  accept_encoding = ACCEPT_ENCODING
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._responses = 0
+    self._wire_bytes = 0
+    self._content_bytes = 0
+
+  def fetch(self, url, payload=None, method='GET', headers=None,
+            deadline=None):
+    """Makes an HTTP request and returns a Response.
+
+    Args:
+      url: string, full URL including query string.
+      payload: string, request body or None.
+      method: string, HTTP method, e.g. 'GET' or 'POST'.
+      headers: dict of request headers or None.
+      deadline: float, seconds to wait for the response or None for
+                the transport's default. SimpleAuthHandler only passes it
+                if CALLBACK_DEADLINES is set.
+    """
+    raise NotImplementedError
+
+  def fetch_async(self, url, payload=None, method='GET', headers=None,
+                  deadline=None):
+    """Starts an HTTP request and returns immediately.
+
+    Takes the same args as fetch(). Returned object's get_result() blocks
+    until the request is complete and returns a Response.
+
+    Default implementation runs fetch() in a separate thread.
+    """
+    kwargs = {}
+    if deadline is not None:
+      kwargs['deadline'] = deadline
+    return ThreadFuture(self.fetch, url, payload=payload, method=method,
+                        headers=headers, **kwargs)
+
+  def stats(self):
+    """Returns a dict of responses count, wire_bytes received and
+    content_bytes they decompressed to.
+    """
+    with self._lock:
+      return {'responses': self._responses,
+              'wire_bytes': self._wire_bytes,
+              'content_bytes': self._content_bytes}
+
+  def _request_headers(self, headers):
+    """Returns a copy of headers with Accept-Encoding added."""
+    req_headers = dict(headers or {})
+    if self.accept_encoding and not any(
+        k.lower() == 'accept-encoding' for k in req_headers):
+      req_headers['Accept-Encoding'] = self.accept_encoding
+    return req_headers
+
+  def _record(self, resp):
+    with self._lock:
+      self._responses += 1
+      self._wire_bytes += resp.wire_size
+      self._content_bytes += len(resp.content or '')
+    return resp
+
+
+class ThreadFuture(object):
+  """Runs a function in a new thread. get_result() waits for it to finish
+  and returns its result or re-raises its exception.
+  """
+
+  def __init__(self, func, *args, **kwargs):
+    self._result = None
+    self._exc_info = None
+    self._thread = threading.Thread(target=self._run,
+                                    args=(func, args, kwargs))
+    self._thread.daemon = True
+    self._thread.start()
+
+  def _run(self, func, args, kwargs):
+    try:
+      self._result = func(*args, **kwargs)
+    except Exception:
+      self._exc_info = sys.exc_info()
+
+  def get_result(self):
+    self._thread.join()
+    if self._exc_info is not None:
+      raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+    return self._result
+
+
+class URLFetchFuture(object):
+  """Wraps URLfetch RPC so that get_result() returns a Response."""
+
+  def __init__(self, rpc, transport):
+    self.rpc = rpc
+    self.transport = transport
+
+  def get_result(self):
+    try:
+      result = self.rpc.get_result()
+    except urlfetch.Error as e:
+      raise TransportError, 'URLfetch failed: %s' % e, sys.exc_info()[2]
+    return self.transport._response(result)
+
+
+class URLFetchTransport(Transport):
+  """Makes requests using App Engine URLfetch API.
+  fetch_async() uses URLfetch asynchronous RPCs.
+  """
+
+  def fetch(self, url, payload=None, method='GET', headers=None,
+            deadline=None):
+    try:
+      resp = urlfetch.fetch(url=url, payload=payload, method=method,
+                            headers=self._request_headers(headers),
+                            deadline=deadline)
+    except urlfetch.Error as e:
+      raise TransportError, 'URLfetch failed: %s' % e, sys.exc_info()[2]
+    return self._response(resp)
+
+  def fetch_async(self, url, payload=None, method='GET', headers=None,
+                  deadline=None):
+    rpc = urlfetch.create_rpc(deadline=deadline)
+    urlfetch.make_fetch_call(rpc, url, payload=payload, method=method,
+                             headers=self._request_headers(headers))
+    return URLFetchFuture(rpc, self)
+
+  def _response(self, result):
+    """Returns a Response of URLfetch result."""
+    resp = Response(result.status_code, result.content, result.headers)
+    decoder = _decoder(resp.headers.get('content-encoding'), resp.content)
+    if decoder is not None:
+      resp.content = decoder.decompress(resp.content) + decoder.flush()
+    return self._record(resp)
+
+
+class PooledTransport(Transport):
+  """Reuses keep-alive connections per provider host across requests.
+
+  A single instance is meant to be shared by the whole process, e.g.
+  set it as SimpleAuthHandler.TRANSPORT. It is thread-safe: a connection
+  is owned by one request at a time and goes back to the pool once
+  the response has been read.
+
+  Servers close keep-alive connections which have been idle for a while.
+  An idle connection is dropped rather than reused once it is older than
+  max_idle_time, or if the server has already closed it. Requests which
+  still hit a connection the server closed meanwhile are resent if their
+  method is in resend_methods.
+
+  Requires outbound sockets. On App Engine this means the sockets API
+  has to be enabled for the app.
+  """
+
+  def __init__(self, max_idle_per_host=4, timeout=None,
+               resend_methods=('GET', 'HEAD'), max_idle_time=30):
+    """
+    Args:
+      max_idle_per_host: int, how many idle connections to keep around
+                         for every (scheme, host) pair.
+      timeout: float, socket timeout in seconds passed to httplib.
+               A request deadline, if shorter, takes precedence.
+      resend_methods: HTTP methods of requests which are sent again on
+                      a fresh connection if the server has dropped the
+                      reused one. Only add methods which are safe to send
+                      twice: the server may have got the first request.
+      max_idle_time: float, seconds an idle connection is reused for.
+                     Keep it below keep-alive timeouts of the providers.
+    """
+    super(PooledTransport, self).__init__()
+    self.max_idle_per_host = max_idle_per_host
+    self.timeout = timeout
+    self.resend_methods = resend_methods
+    self.max_idle_time = max_idle_time
+    self._pool = {}
+    self._lock = threading.Lock()
+
+  def fetch(self, url, payload=None, method='GET', headers=None,
+            deadline=None):
+    scheme, netloc, path, query, _ = urlparse.urlsplit(url)
+    if query:
+      path = '%s?%s' % (path, query)
+    key = (scheme, netloc)
+
+    req_headers = self._request_headers(headers)
+    req_headers.setdefault('Connection', 'keep-alive')
+
+    timeout = self.timeout
+    expires = None
+    if deadline is not None:
+      expires = time.time() + deadline
+      if timeout is None or deadline < timeout:
+        timeout = deadline
+
+    while True:
+      conn, reused = self._acquire(key)
+      # applies to connect and each socket read, not the whole request
+      conn.timeout = timeout
+      if conn.sock is not None:
+        conn.sock.settimeout(timeout)
+      try:
+        conn.request(method, path or '/', payload, req_headers)
+        resp = conn.getresponse()
+      except (httplib.HTTPException, socket.error) as e:
+        conn.close()
+        if reused and method in self.resend_methods and _dropped(e):
+          # The server has dropped an idle keep-alive connection before
+          # responding. Try again with the next one or a fresh connection.
+          logging.debug('Stale connection to %s, resending', netloc)
+          if expires is not None:
+            # the resend gets what's left of the deadline
+            left = expires - time.time()
+            if left <= 0:
+              _reraise(netloc, e)
+            timeout = min(timeout, left)
+          continue
+        _reraise(netloc, e)
+      try:
+        content, wire_size = _read(resp)
+      except (httplib.HTTPException, socket.error, zlib.error) as e:
+        # the response has started, so the request is never resent
+        conn.close()
+        _reraise(netloc, e)
+      except Exception:
+        conn.close()
+        raise
+      break
+
+    if resp.will_close:
+      conn.close()
+    else:
+      self._release(key, conn)
+
+    return self._record(Response(resp.status, content, dict(resp.getheaders()),
+                                 wire_size=wire_size))
+
+  def clear(self):
+    """Closes all idle connections."""
+    with self._lock:
+      pool, self._pool = self._pool, {}
+    for idle in pool.values():
+      for conn, _ in idle:
+        conn.close()
+
+  def _acquire(self, key):
+    """Returns a (connection, reused) tuple for the (scheme, netloc) key.
+
+    Idle connections older than max_idle_time or closed by the server
+    are dropped.
+    """
+    while True:
+      with self._lock:
+        idle = self._pool.get(key)
+        if not idle:
+          break
+        conn, idle_since = idle.pop()
+      if time.time() - idle_since <= self.max_idle_time and not _closed(conn):
+        return conn, True
+      logging.debug('Dropping idle connection to %s', key[1])
+      conn.close()
+
+    scheme, netloc = key
+    if scheme == 'https':
+      conn_class = httplib.HTTPSConnection
+    else:
+      conn_class = httplib.HTTPConnection
+    return conn_class(netloc, timeout=self.timeout), False
+
+  def _release(self, key, conn):
+    with self._lock:
+      idle = self._pool.setdefault(key, [])
+      if len(idle) < self.max_idle_per_host:
+        # (connection, idle since), most recently used last
+        idle.append((conn, time.time()))
+        return
+    conn.close()
+
+
+class OAuth1Client(object):
+  """Signs requests with OAuth 1.0a and sends them over a transport.
+
+  This is a drop-in for oauth2.Client: request() returns a (response, content)
+  tuple and response.status is available. Unlike oauth2.Client it isn't
+  an httplib2.Http, so no HTTP client is created per request.
+
+  A client without a token holds no per-user state and can be shared by
+  all requests of the same consumer: pass the token to request() instead.
+  """
+
+  def __init__(self, consumer, token=None, transport=None):
+    self.consumer = consumer
+    self.token = token
+    self.transport = transport or URLFetchTransport()
+    self.method = _signature_method()
+
+  def request(self, uri, method='GET', body='', headers=None, token=None,
+              deadline=None):
+    """Sends a signed request. token overrides the client's token.
+
+    deadline is passed to the transport, see Transport.fetch().
+    """
+    args = self._sign(uri, method, body, headers, token or self.token)
+    if deadline is None:
+      resp = self.transport.fetch(*args)
+    else:
+      resp = self.transport.fetch(*args, deadline=deadline)
+    return resp, resp.content
+
+  def request_async(self, uri, method='GET', body='', headers=None,
+                    token=None, deadline=None):
+    """Same as request() but returns immediately.
+
+    See Transport.fetch_async(). get_result() returns a Response.
+    """
+    args = self._sign(uri, method, body, headers, token or self.token)
+    if deadline is None:
+      return self.transport.fetch_async(*args)
+    return self.transport.fetch_async(*args, deadline=deadline)
+
+  def _sign(self, uri, method, body, headers, token):
+    """Signs a request. Returns (url, payload, method, headers) tuple
+    suitable for Transport.fetch().
+    """
+    headers = dict(headers or {})
+    if method == 'POST':
+      headers.setdefault('Content-Type', FORM_CONTENT_TYPE)
+
+    is_form_encoded = headers.get('Content-Type') == FORM_CONTENT_TYPE
+    parameters = None
+    if is_form_encoded and body:
+      parameters = urlparse.parse_qs(body)
+
+    req = oauth1.Request.from_consumer_and_token(
+        self.consumer, token=token, http_method=method, http_url=uri,
+        parameters=parameters, body=body or '', is_form_encoded=is_form_encoded)
+    req.sign_request(self.method, self.consumer, token)
+
+    if is_form_encoded:
+      body = req.to_postdata()
+    elif method == 'GET':
+      uri = req.to_url()
+    else:
+      scheme, netloc = urlparse.urlsplit(uri)[:2]
+      realm = '%s://%s' % (scheme, netloc)
+      headers.update(req.to_header(realm=realm))
+
+    return uri, body or None, method, headers
+
+
+def _signature_method():
+  """Returns the HMAC-SHA1 signer shared by all OAuth1Client instances.
+
+  The oauth2 lib bundled in example/lib has a faster signer which caches
+  keyed HMAC objects; the one on PyPI doesn't.
+  """
+  global _SIGNATURE_METHOD
+  if _SIGNATURE_METHOD is None:
+    try:
+      _SIGNATURE_METHOD = oauth1.FastSignatureMethod_HMAC_SHA1()
+    except AttributeError:
+      _SIGNATURE_METHOD = oauth1.SignatureMethod_HMAC_SHA1()
+  return _SIGNATURE_METHOD
+
+
+def _dropped(error):
+  """Returns True if a request error means that the server closed
+  the connection without responding, as opposed to e.g. a timeout.
+  """
+  if isinstance(error, socket.timeout):
+    return False
+  if isinstance(error, httplib.BadStatusLine):
+    # EOF before any response bytes. Older Python 2.7 releases report
+    # an empty line, newer ones a message.
+    return not error.line or error.line.startswith('No status line')
+  return isinstance(error, socket.error) and error.errno in (
+      errno.ECONNRESET, errno.EPIPE, errno.ECONNABORTED)
+
+
+def _closed(conn):
+  """Returns True if the server has closed an idle connection.
+
+  Nothing is expected from the server before a request has been sent,
+  so a readable socket means EOF, or garbage, either way unusable.
+  """
+  if conn.sock is None:
+    return False
+  try:
+    return bool(select.select([conn.sock], [], [], 0)[0])
+  except (select.error, socket.error, ValueError):
+    return True
+
+
+def _reraise(netloc, error):
+  """Re-raises an httplib or socket error being handled as TransportError,
+  with the original traceback.
+  """
+  message = 'Request to %s failed: %s' % (
+      netloc, str(error) or error.__class__.__name__)
+  raise TransportError, message, sys.exc_info()[2]
+
+
+def _decoder(encoding, head):
+  """Returns a zlib decompress object for Content-Encoding, or None if
+  the body isn't compressed.
+
+  head is the beginning of the body: some servers send deflate bodies
+  without the zlib header.
+  """
+  encoding = (encoding or '').strip().lower()
+  if encoding in ('gzip', 'x-gzip'):
+    return zlib.decompressobj(16 + zlib.MAX_WBITS)
+  if encoding == 'deflate':
+    if len(head) >= 2 and (ord(head[0]) & 0x0f) == 8 and (
+        (ord(head[0]) << 8) + ord(head[1])) % 31 == 0:
+      return zlib.decompressobj()
+    return zlib.decompressobj(-zlib.MAX_WBITS)
+  return None
+
+
+def _read(resp):
+  """Reads an httplib response body, decompressing it as it arrives.
+
+  Returns (content, wire_size) tuple.
+  """
+  encoding = resp.getheader('content-encoding')
+  if not encoding or encoding.strip().lower() == 'identity':
+    content = resp.read()
+    return content, len(content)
+
+  chunk = resp.read(READ_CHUNK_SIZE)
+  decoder = _decoder(encoding, chunk)
+  if decoder is None:
+    content = chunk + resp.read()
+    return content, len(content)
+  parts = []
+  wire_size = 0
+  while chunk:
+    wire_size += len(chunk)
+    parts.append(decoder.decompress(chunk))
+    chunk = resp.read(READ_CHUNK_SIZE)
+  parts.append(decoder.flush())
+  return ''.join(parts), wire_size
@@ -3,6 +3,9 @@ SimpleAuth testing
 """
 import os
 import sys
+import json
+import base64
+import hashlib
 import logging
 
 from dev_appserver import fix_sys_path
@@ -165,3 +168,45 @@ class TestMixin(object):
 
   def isDefaultLogging(self):
     return self._old_log_level == logging.WARNING
+
+
+# RSA key for signing test ID tokens. Don't use it anywhere else.
+TEST_RSA_N = long(
+  'da621c2d3cda683a52ad6eafff226cebe9086a7ce2da98fec4031d052484cfdb'
+  '388f4a904eff7d683a542d48267e55b894ea25bc7a49af8828b08d47ba9cf843'
+  '6e44b386028dc788335e787208efc0100d36a8e66be25229e553d1dc55e54e9b'
+  'c29b542ab5f16d82ccff71874e2a3c0e37df751c87c35b02b82a02e1458a6343', 16)
+TEST_RSA_D = long(
+  '634eeb464d1e7af84ec1ac8c9f469de697d5aa6b395433efe2de1193d59c09d3'
+  'c48030e5b7eeea2dfc1c6c6d1b8826de25e5e69c33b60f7b2919c45d8288c042'
+  '3e4a410813dbfe9baa209f544fd0454609318368b9783eea3ae1de5a5abcb2d0'
+  '8844a9e3ef7a35fe46574e5009d2ad9594a3afc5a953f4a83008267ad234a8ed', 16)
+TEST_RSA_E = 65537L
+
+def _b64(data):
+  return base64.urlsafe_b64encode(data).rstrip('=')
+
+def _b64long(n):
+  data = '%x' % n
+  return _b64(('0' * (len(data) % 2) + data).decode('hex'))
+
+def make_jwks(kid='test-key'):
+  """Returns JWKS document with the public part of test RSA key"""
+  return json.dumps({'keys': [{
+    'kty': 'RSA', 'alg': 'RS256', 'use': 'sig', 'kid': kid,
+    'n': _b64long(TEST_RSA_N), 'e': _b64long(TEST_RSA_E)
+  }]})
+
+def sign_jwt(claims, kid='test-key', alg='RS256'):
+  """Returns a JWT of claims signed with test RSA key, RS256"""
+  header = {'alg': alg, 'typ': 'JWT', 'kid': kid}
+  signing_input = '%s.%s' % (_b64(json.dumps(header)),
+                             _b64(json.dumps(claims)))
+  size = (TEST_RSA_N.bit_length() + 7) // 8
+  digest = ('3031300d060960864801650304020105000420'.decode('hex') +
+            hashlib.sha256(signing_input).digest())
+  em = '\x00\x01' + '\xff' * (size - len(digest) - 3) + '\x00' + digest
+  s = pow(long(em.encode('hex'), 16), TEST_RSA_D, TEST_RSA_N)
+  sig = '%x' % s
+  sig = ('0' * (size * 2 - len(sig)) + sig).decode('hex')
+  return '%s.%s' % (signing_input, _b64(sig))
@@ -0,0 +1,251 @@
+# -*- coding: utf-8 -*-
+import unittest
+from tests import TestMixin
+
+from urllib import urlencode, quote_plus
+
+try:
+  import json
+except ImportError:
+  import simplejson as json
+
+from webapp2 import WSGIApplication, Route, RequestHandler
+from google.appengine.ext import ndb
+
+import simpleauth as sa
+from simpleauth import AsyncSimpleAuthHandler, SimpleAuthHandler
+from simpleauth.transport import Response
+
+
+#
+# test subjects
+#
+
+class ScriptedTransport(sa.Transport):
+  """Returns responses in order."""
+  def __init__(self, *responses):
+    self.responses = list(responses)
+    self.deadlines = []
+
+  def fetch(self, url, payload=None, method='GET', headers=None,
+            deadline=None):
+    self.deadlines.append(deadline)
+    return self.responses.pop(0)
+
+
+class OAuth1FutureMock(object):
+  def __init__(self, resp):
+    self._resp = resp
+
+  def get_result(self):
+    return self._resp
+
+
+class OAuth1ClientMock(object):
+  def __init__(self, content=''):
+    self._content = content
+
+  def request_async(self, url, method='GET', body=None, token=None):
+    return OAuth1FutureMock(Response(200, self._content))
+
+
+class DummyAsyncAuthHandler(RequestHandler, AsyncSimpleAuthHandler):
+  PROVIDERS = dict(SimpleAuthHandler.PROVIDERS, **{
+    'dummy_oauth1': ('oauth1', {
+      'request': 'https://dummy/oauth1_rtoken',
+      'auth'  : 'https://dummy/oauth1_auth?{0}'
+    }, 'https://dummy/oauth1_atoken'),
+    'dummy_oauth2': ('oauth2', 'https://dummy/oauth2?{0}',
+                               'https://dummy/oauth2_token'),
+    'dummy_oidc': ('oidc', 'https://dummy'),
+  })
+
+  TOKEN_RESPONSE_PARSERS = dict(SimpleAuthHandler.TOKEN_RESPONSE_PARSERS,
+                                dummy_oauth1='_json_parser',
+                                dummy_oauth2='_json_parser')
+
+  SESSION_MOCK = {}
+
+  def __init__(self, *args, **kwargs):
+    super(DummyAsyncAuthHandler, self).__init__(*args, **kwargs)
+    self.session = self.SESSION_MOCK.copy()
+
+  def _on_signin(self, user_data, auth_info, provider, extra):
+    self.redirect('/logged_in?provider=%s&user=%s&extra=%s' % (
+      provider, quote_plus(json.dumps(user_data)),
+      quote_plus(json.dumps(extra))))
+
+  def _callback_uri_for(self, provider):
+    return '/auth/%s/callback' % provider
+
+  def _get_consumer_info_for(self, provider):
+    return {
+      'dummy_oauth1': ('cons_key', 'cons_secret'),
+      'dummy_oauth2': ('cl_id', 'cl_secret', 'a_scope'),
+      'dummy_oidc': ('cl_id', 'cl_secret', 'openid'),
+    }.get(provider, (None, None))
+
+  def _oauth1_client(self, token=None,
+                           consumer_key=None, consumer_secret=None):
+    return OAuth1ClientMock(
+      content='{"oauth_token": "some oauth1 request token"}')
+
+  @ndb.tasklet
+  def _get_dummy_oauth1_user_info_async(self, auth_info, key=None,
+                                        secret=None):
+    raise ndb.Return('an oauth1 user info')
+
+  @ndb.tasklet
+  def _get_dummy_oauth2_user_info_async(self, auth_info, key=None,
+                                        secret=None):
+    resp = yield self._oauth2_request_tasklet('https://dummy/me?{0}',
+                                              auth_info['access_token'])
+    raise ndb.Return(json.loads(resp))
+
+
+#
+# test suite
+#
+
+class AsyncSimpleAuthHandlerTestCase(TestMixin, unittest.TestCase):
+  def setUp(self):
+    super(AsyncSimpleAuthHandlerTestCase, self).setUp()
+    DummyAsyncAuthHandler.SESSION_MOCK = {
+      'req_token': {
+        'oauth_token':'oauth1 token',
+        'oauth_token_secret':'a secret'
+      }
+    }
+    routes = [
+      Route('/auth/<provider>', handler=DummyAsyncAuthHandler,
+        handler_method='_simple_auth'),
+      Route('/auth/<provider>/callback', handler=DummyAsyncAuthHandler,
+        handler_method='_auth_callback') ]
+    self.app = WSGIApplication(routes, debug=True)
+
+  def test_not_supported_provider(self):
+    self.expectErrors()
+    resp = self.app.get_response('/auth/xxx')
+    self.assertEqual(resp.status_int, 500)
+    self.assertRegexpMatches(resp.body, 'UnknownAuthMethodError')
+
+  def test_oauth2_init(self):
+    resp = self.app.get_response('/auth/dummy_oauth2')
+    self.assertEqual(resp.status_int, 302)
+    self.assertTrue(resp.headers['Location'].startswith('https://dummy/oauth2?'))
+
+  def test_oauth2_callback(self):
+    self.set_urlfetch_response('https://dummy/oauth2_token',
+                               content='{"access_token": "a-token"}')
+    self.set_urlfetch_response('https://dummy/me?access_token=a-token',
+                               content='{"id": "123"}')
+
+    query = urlencode({'code': 'auth-code', 'state': json.dumps({})})
+    resp = self.app.get_response('/auth/dummy_oauth2/callback?' + query)
+
+    self.assertEqual(resp.status_int, 302)
+    self.assertEqual(resp.headers['Location'],
+      'http://localhost/logged_in?provider=dummy_oauth2&'
+      'user=%7B%22id%22%3A+%22123%22%7D&extra=null')
+
+  def test_callback_deadline_and_retries(self):
+    self.expectErrors()
+    transport = ScriptedTransport(Response(200, '{"access_token": "a-token"}'),
+                                  Response(503, 'unavailable'),
+                                  Response(200, '{"id": "123"}'))
+    DummyAsyncAuthHandler.TRANSPORT = transport
+    DummyAsyncAuthHandler.CALLBACK_DEADLINES = {'dummy_oauth2': 10}
+    DummyAsyncAuthHandler.USER_INFO_RETRIES = 1
+    DummyAsyncAuthHandler.RETRY_DELAY = 0
+    try:
+      query = urlencode({'code': 'auth-code', 'state': json.dumps({})})
+      resp = self.app.get_response('/auth/dummy_oauth2/callback?' + query)
+    finally:
+      del DummyAsyncAuthHandler.TRANSPORT
+      del DummyAsyncAuthHandler.CALLBACK_DEADLINES
+      del DummyAsyncAuthHandler.USER_INFO_RETRIES
+      del DummyAsyncAuthHandler.RETRY_DELAY
+
+    self.assertEqual(resp.status_int, 302)
+    self.assertIn('user=%7B%22id%22%3A+%22123%22%7D', resp.headers['Location'])
+    self.assertEqual(len(transport.deadlines), 3)
+    for deadline in transport.deadlines:
+      self.assertTrue(9 < deadline <= 10)
+
+  def test_callback_singleflight(self):
+    transport = ScriptedTransport(Response(200, '{"access_token": "a-token"}'),
+                                  Response(200, '{"id": "123"}'))
+    DummyAsyncAuthHandler.TRANSPORT = transport
+    DummyAsyncAuthHandler.CALLBACK_SINGLEFLIGHT = sa.SingleFlight(ttl=5)
+    query = urlencode({'code': 'auth-code', 'state': json.dumps({})})
+    try:
+      for i in range(2):
+        resp = self.app.get_response('/auth/dummy_oauth2/callback?' + query)
+        self.assertEqual(resp.status_int, 302)
+        self.assertIn('user=%7B%22id%22%3A+%22123%22%7D',
+                      resp.headers['Location'])
+    finally:
+      del DummyAsyncAuthHandler.TRANSPORT
+      del DummyAsyncAuthHandler.CALLBACK_SINGLEFLIGHT
+    self.assertEqual(len(transport.deadlines), 2)
+
+  def test_oidc_callback(self):
+    DummyAsyncAuthHandler.OIDC_DISCOVERY = sa.DiscoveryCache()
+    self.set_urlfetch_response(
+      'https://dummy/.well-known/openid-configuration',
+      content=json.dumps({
+        'issuer': 'https://dummy',
+        'authorization_endpoint': 'https://dummy/oidc_auth',
+        'token_endpoint': 'https://dummy/oidc_token',
+        'userinfo_endpoint': 'https://dummy/userinfo',
+        'jwks_uri': 'https://dummy/certs'
+      }))
+    # no id_token: user info is fetched from userinfo endpoint
+    self.set_urlfetch_response('https://dummy/oidc_token',
+                               content='{"access_token": "a-token"}')
+    self.set_urlfetch_response('https://dummy/userinfo',
+                               content='{"sub": "123"}')
+
+    query = urlencode({'code': 'auth-code', 'state': json.dumps({})})
+    resp = self.app.get_response('/auth/dummy_oidc/callback?' + query)
+
+    self.assertEqual(resp.status_int, 302)
+    self.assertEqual(resp.headers['Location'],
+      'http://localhost/logged_in?provider=dummy_oidc&'
+      'user=%7B%22sub%22%3A+%22123%22%2C+%22id%22%3A+%22123%22%7D&extra=null')
+
+  def test_user_info_fields(self):
+    handler = DummyAsyncAuthHandler()
+    handler.USER_INFO_FIELDS = {'facebook': ('name',)}
+    self.set_urlfetch_response(
+      'https://graph.facebook.com/me?access_token=a-token&fields=id%2Cname',
+      content='{"id": "123", "name": "Dummy User"}')
+    user_data = handler._get_facebook_user_info_async(
+      {'access_token': 'a-token'}).get_result()
+    self.assertEqual(user_data, {'id': '123', 'name': 'Dummy User'})
+
+  def test_oauth1_init(self):
+    resp = self.app.get_response('/auth/dummy_oauth1')
+    self.assertEqual(resp.status_int, 302)
+    self.assertEqual(resp.headers['Location'],
+      'https://dummy/oauth1_auth?'
+      'oauth_token=some+oauth1+request+token&'
+      'oauth_callback=%2Fauth%2Fdummy_oauth1%2Fcallback')
+
+  def test_oauth1_callback(self):
+    url = '/auth/dummy_oauth1/callback?oauth_verifier=a-verifier-token'
+    resp = self.app.get_response(url)
+    self.assertEqual(resp.status_int, 302)
+    self.assertEqual(resp.headers['Location'],
+      'http://localhost/logged_in?provider=dummy_oauth1&'
+      'user=%22an+oauth1+user+info%22&extra=null')
+
+  def test_oauth1_callback_failure(self):
+    self.expectErrors()
+    resp = self.app.get_response('/auth/dummy_oauth1/callback')
+    self.assertEqual(resp.status_int, 500)
+    self.assertRegexpMatches(resp.body, 'No OAuth verifier was provided')
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+import unittest
+from tests import TestMixin
+
+from simpleauth import breaker
+
+
+class CircuitBreakerTestCase(TestMixin, unittest.TestCase):
+  def setUp(self):
+    super(CircuitBreakerTestCase, self).setUp()
+    self.expectErrors()
+    self.breaker = breaker.CircuitBreaker(failure_rate=0.5, min_requests=4,
+                                          slow_call=1.0, open_for=30)
+
+  def test_closed(self):
+    for failed in (True, False, True):
+      self.breaker.record('facebook', 0.1, failed=failed)
+    # not enough requests yet
+    self.assertEqual(self.breaker.state('facebook'), 'closed')
+    self.assertTrue(self.breaker.allow('facebook'))
+    self.assertFalse(self.breaker.is_open('facebook'))
+    self.assertEqual(self.breaker.state('google'), 'closed')
+
+  def test_opens_on_failure_rate(self):
+    for failed in (True, False, True, False):
+      self.breaker.record('facebook', 0.1, failed=failed)
+    self.assertEqual(self.breaker.state('facebook'), 'open')
+    self.assertFalse(self.breaker.allow('facebook'))
+    self.assertTrue(self.breaker.is_open('facebook'))
+    # other providers are not affected
+    self.assertTrue(self.breaker.allow('google'))
+
+  def test_slow_requests_fail(self):
+    for i in range(4):
+      self.breaker.record('facebook', 2.0)
+    self.assertEqual(self.breaker.state('facebook'), 'open')
+
+  def test_old_requests_expire(self):
+    for i in range(3):
+      self.breaker.record('facebook', 0.1, failed=True)
+    c = self.breaker._circuits['facebook']
+    c.events = type(c.events)((t - 120, f) for t, f in c.events)
+    self.breaker.record('facebook', 0.1, failed=True)
+    self.assertEqual(self.breaker.state('facebook'), 'closed')
+    self.assertEqual(c.failures, 1)
+
+  def test_half_open(self):
+    for i in range(4):
+      self.breaker.record('facebook', 0.1, failed=True)
+    c = self.breaker._circuits['facebook']
+    c.opened -= 31
+    self.assertFalse(self.breaker.is_open('facebook'))
+
+    # one probe at a time
+    self.assertTrue(self.breaker.allow('facebook'))
+    self.assertEqual(self.breaker.state('facebook'), 'half_open')
+    self.assertFalse(self.breaker.allow('facebook'))
+
+    # failed probe opens it again
+    self.breaker.record('facebook', 0.1, failed=True)
+    self.assertEqual(self.breaker.state('facebook'), 'open')
+    self.assertFalse(self.breaker.allow('facebook'))
+
+    c.opened -= 31
+    self.assertTrue(self.breaker.allow('facebook'))
+    self.breaker.record('facebook', 0.1)
+    self.assertEqual(self.breaker.state('facebook'), 'closed')
+    self.assertTrue(self.breaker.allow('facebook'))
+
+  def test_stuck_probe(self):
+    for i in range(4):
+      self.breaker.record('facebook', 0.1, failed=True)
+    c = self.breaker._circuits['facebook']
+    c.opened -= 31
+    self.assertTrue(self.breaker.allow('facebook'))
+    # the probe never made a request
+    c.probe -= 31
+    self.assertTrue(self.breaker.allow('facebook'))
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+import unittest
+from tests import TestMixin
+
+import json
+import threading
+import time
+import urlparse
+
+import simpleauth as sa
+from simpleauth import SimpleAuthHandler
+from simpleauth import bulk
+
+
+class FakeTransport(sa.Transport):
+  """Serves Facebook batches and Google user info of 'token-N' tokens."""
+  def __init__(self):
+    super(FakeTransport, self).__init__()
+    self.requests = []
+    self.lock = threading.Lock()
+
+  def fetch(self, url, payload=None, method='GET', headers=None,
+            deadline=None):
+    with self.lock:
+      self.requests.append((url, payload))
+    if url == 'https://graph.facebook.com/':
+      params = dict(urlparse.parse_qsl(payload))
+      items = []
+      for req in json.loads(params['batch']):
+        query = urlparse.parse_qs(urlparse.urlsplit(req['relative_url']).query)
+        token = query['access_token'][0]
+        if token == 'bad':
+          items.append({'code': 400, 'body': '{"error": {}}'})
+        else:
+          items.append({'code': 200, 'body': json.dumps({'id': token})})
+      return sa.Response(200, json.dumps(items))
+
+    token = urlparse.parse_qs(urlparse.urlsplit(url).query)['access_token'][0]
+    if token == 'bad':
+      raise IOError('connection reset')
+    return sa.Response(200, json.dumps({'id': token}))
+
+
+class BulkAuthHandler(SimpleAuthHandler):
+  USER_INFO_FIELDS = {'facebook': ('name',)}
+
+  def _get_consumer_info_for(self, provider):
+    return ('app_id', 'app_secret', None)
+
+
+class ProfileRefresherTestCase(TestMixin, unittest.TestCase):
+  def setUp(self):
+    super(ProfileRefresherTestCase, self).setUp()
+    self.transport = FakeTransport()
+    self.handler = BulkAuthHandler()
+    self.handler.TRANSPORT = self.transport
+
+  def pairs(self, provider, count):
+    for i in range(count):
+      yield provider, {'access_token': 'token-%d' % i}
+
+  def test_single_fetches(self):
+    refresher = bulk.ProfileRefresher(self.handler, concurrency=3)
+    results = list(refresher.refresh(self.pairs('google', 7)))
+
+    self.assertEqual(len(results), 7)
+    self.assertEqual(len(self.transport.requests), 7)
+    for r in results:
+      self.assertEqual(r.provider, 'google')
+      self.assertIsNone(r.error)
+      self.assertEqual(r.user_data['id'], r.auth_info['access_token'])
+
+  def test_facebook_batches(self):
+    refresher = bulk.ProfileRefresher(self.handler, batch_size=3)
+    results = list(refresher.refresh(self.pairs('facebook', 7)))
+
+    self.assertEqual(sorted(r.user_data['id'] for r in results),
+                     sorted('token-%d' % i for i in range(7)))
+    # 3 + 3 + 1
+    self.assertEqual(len(self.transport.requests), 3)
+    params = dict(urlparse.parse_qsl(self.transport.requests[0][1]))
+    self.assertEqual(params['access_token'], 'app_id|app_secret')
+    requests = json.loads(params['batch'])
+    self.assertEqual(len(requests), 3)
+    self.assertIn('fields=id%2Cname', requests[0]['relative_url'])
+
+  def test_errors(self):
+    self.expectWarnings()
+    pairs = [('facebook', {'access_token': 'bad'}),
+             ('facebook', {'access_token': 'good'}),
+             ('google', {'access_token': 'bad'}),
+             ('openid', {})]
+    refresher = bulk.ProfileRefresher(self.handler)
+    results = dict(((r.provider, r.auth_info.get('access_token')), r)
+                   for r in refresher.refresh(pairs))
+
+    self.assertEqual(len(results), 4)
+    self.assertIsInstance(results['facebook', 'bad'].error,
+                          sa.AuthProviderResponseError)
+    self.assertEqual(results['facebook', 'good'].user_data, {'id': 'good'})
+    self.assertIsNotNone(results['google', 'bad'].error)
+    self.assertIsNotNone(results['openid', None].error)
+
+  def test_bounded_read_ahead(self):
+    read = []
+    def pairs():
+      for provider, auth_info in self.pairs('google', 20):
+        read.append(1)
+        yield provider, auth_info
+
+    refresher = bulk.ProfileRefresher(self.handler, concurrency=2)
+    results = refresher.refresh(pairs())
+    next(results)
+    self.assertTrue(len(read) <= 3)
+    self.assertEqual(len(list(results)), 19)
+
+  def test_rate_limits(self):
+    refresher = bulk.ProfileRefresher(self.handler, concurrency=4,
+                                      rate_limits={'*': 50})
+    start = time.time()
+    results = list(refresher.refresh(self.pairs('google', 6)))
+    self.assertEqual(len(results), 6)
+    # the first request is made right away, then one every 20ms
+    self.assertTrue(time.time() - start >= 0.09)
+
+
+class RateLimiterTestCase(unittest.TestCase):
+  def test_burst(self):
+    limiter = bulk.RateLimiter(10, burst=3)
+    start = time.time()
+    for _ in range(3):
+      limiter.acquire()
+    self.assertTrue(time.time() - start < 0.05)
+    limiter.acquire()
+    self.assertTrue(time.time() - start >= 0.09)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+import unittest
+from tests import TestMixin
+
+import time
+
+from simpleauth import cache
+
+
+class LRUCacheTestCase(unittest.TestCase):
+  def test_get_set(self):
+    c = cache.LRUCache()
+    self.assertIsNone(c.get('key'))
+    c.set('key', {'id': 1})
+    self.assertEqual(c.get('key'), {'id': 1})
+    c.delete('key')
+    self.assertIsNone(c.get('key'))
+    self.assertEqual(c.stats(), {'hits': 1, 'misses': 2})
+
+  def test_lru_eviction(self):
+    c = cache.LRUCache(max_size=2)
+    c.set('a', 1)
+    c.set('b', 2)
+    # 'a' is now the most recently used
+    self.assertEqual(c.get('a'), 1)
+    c.set('c', 3)
+    self.assertEqual(len(c), 2)
+    self.assertIsNone(c.get('b'))
+    self.assertEqual(c.get('a'), 1)
+    self.assertEqual(c.get('c'), 3)
+
+  def test_add(self):
+    c = cache.LRUCache()
+    self.assertTrue(c.add('a', 1))
+    self.assertFalse(c.add('a', 2))
+    self.assertEqual(c.get('a'), 1)
+    # expired items are replaced
+    c._items['a'] = (time.time() - 1, 1)
+    self.assertTrue(c.add('a', 3))
+    self.assertEqual(c.get('a'), 3)
+
+  def test_ttl(self):
+    c = cache.LRUCache(ttl=60)
+    c.set('a', 1)
+    c.set('b', 2, ttl=-1)
+    self.assertEqual(c.get('a'), 1)
+    self.assertIsNone(c.get('b'))
+
+    c._items['a'] = (time.time() - 1, 1)
+    self.assertIsNone(c.get('a'))
+    self.assertEqual(len(c), 0)
+
+
+class MemcacheCacheTestCase(TestMixin, unittest.TestCase):
+  def test_get_set(self):
+    c = cache.MemcacheCache(namespace='test', ttl=60)
+    self.assertIsNone(c.get('key'))
+    c.set('key', {'id': 1})
+    self.assertEqual(c.get('key'), {'id': 1})
+    self.assertIsNone(cache.MemcacheCache(namespace='other').get('key'))
+    c.delete('key')
+    self.assertIsNone(c.get('key'))
+    self.assertEqual(c.stats(), {'hits': 1, 'misses': 2})
+
+  def test_add(self):
+    c = cache.MemcacheCache(namespace='test')
+    self.assertTrue(c.add('key', 1))
+    self.assertFalse(c.add('key', 2))
+    self.assertEqual(c.get('key'), 1)
+
+
+class DatastoreCacheTestCase(TestMixin, unittest.TestCase):
+  def test_get_set(self):
+    c = cache.DatastoreCache()
+    self.assertIsNone(c.get('key'))
+    c.set('key', {'id': 1})
+    self.assertEqual(c.get('key'), {'id': 1})
+    c.delete('key')
+    self.assertIsNone(c.get('key'))
+    self.assertEqual(c.stats(), {'hits': 1, 'misses': 2})
+
+  def test_expiry(self):
+    c = cache.DatastoreCache(ttl=60)
+    c.set('a', 1)
+    c.set('b', 2, ttl=-1)
+    c.set('c', 3, ttl=-1)
+    self.assertEqual(c.get('a'), 1)
+    self.assertIsNone(c.get('b'))
+    # 'b' is deleted on read, 'c' by purge
+    self.assertEqual(c.purge(), 1)
+    self.assertEqual(c.purge(), 0)
+    self.assertEqual(c.get('a'), 1)
+
+
+if __name__ == '__main__':
+  unittest.main()
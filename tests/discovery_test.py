@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+import unittest
+
+import json
+
+from simpleauth import discovery
+from simpleauth import LRUCache, Response
+
+
+ISSUER = 'https://example.org'
+DOCUMENT = {
+  'issuer': ISSUER,
+  'authorization_endpoint': 'https://example.org/auth',
+  'token_endpoint': 'https://example.org/token',
+  'userinfo_endpoint': 'https://example.org/userinfo',
+  'jwks_uri': 'https://example.org/certs',
+}
+
+
+class TransportMock(object):
+  def __init__(self, content, status_code=200):
+    self.content = content
+    self.status_code = status_code
+    self.calls = []
+
+  def fetch(self, url, payload=None, method='GET', headers=None):
+    self.calls.append(url)
+    return Response(self.status_code, self.content)
+
+
+class DiscoveryCacheTestCase(unittest.TestCase):
+  def test_get(self):
+    transport = TransportMock(json.dumps(DOCUMENT))
+    cache = discovery.DiscoveryCache()
+    for i in range(3):
+      self.assertEqual(cache.get(ISSUER, transport), DOCUMENT)
+    self.assertEqual(transport.calls,
+                     ['https://example.org/.well-known/openid-configuration'])
+
+  def test_expired(self):
+    transport = TransportMock(json.dumps(DOCUMENT))
+    cache = discovery.DiscoveryCache(ttl=-1)
+    cache.get(ISSUER, transport)
+    cache.get(ISSUER, transport)
+    self.assertEqual(len(transport.calls), 2)
+
+  def test_shared_store(self):
+    store = LRUCache()
+    transport = TransportMock(json.dumps(DOCUMENT))
+    discovery.DiscoveryCache(store=store).get(ISSUER, transport)
+    # another instance
+    cache = discovery.DiscoveryCache(store=store)
+    self.assertEqual(cache.get(ISSUER, transport), DOCUMENT)
+    self.assertEqual(len(transport.calls), 1)
+
+  def test_invalid_document(self):
+    cache = discovery.DiscoveryCache()
+    for content, status_code in [
+        (json.dumps(DOCUMENT), 500),
+        ('not json', 200),
+        ('[]', 200),
+        (json.dumps(dict(DOCUMENT, token_endpoint=None)), 200),
+        (json.dumps(dict(DOCUMENT, issuer='https://evil.example.org')), 200)]:
+      transport = TransportMock(content, status_code)
+      with self.assertRaises(discovery.DiscoveryError):
+        cache.get(ISSUER, transport)
+
+
+if __name__ == '__main__':
+  unittest.main()
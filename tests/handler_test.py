@@ -1,9 +1,11 @@
 # -*- coding: utf-8 -*-
 import unittest
-from tests import TestMixin
+from tests import TestMixin, sign_jwt, make_jwks
 
+import os
 import time
 import base64
+import urlparse
 
 from collections import OrderedDict
 from urllib import urlencode, quote_plus
@@ -14,7 +16,7 @@ try:
 except ImportError:
   import simplejson as json
 
-from webapp2 import WSGIApplication, Route, RequestHandler
+from webapp2 import WSGIApplication, Route, RequestHandler, Request
 from httplib2 import Response
 
 import simpleauth as sa
@@ -31,29 +33,29 @@ class OAuth1ClientMock(object):
     self._response_content = kwargs.pop('content', '')
     self._response_dict = kwargs
 
-  def request(self, url, method, body=None):
+  def request(self, url, method, body=None, token=None):
     return (Response(self._response_dict), self._response_content)
 
 
 class DummyAuthHandler(RequestHandler, SimpleAuthHandler):
+  PROVIDERS = dict(SimpleAuthHandler.PROVIDERS, **{
+    'dummy_oauth1': ('oauth1', {
+      'request': 'https://dummy/oauth1_rtoken',
+      'auth'  : 'https://dummy/oauth1_auth?{0}'
+    }, 'https://dummy/oauth1_atoken'),
+    'dummy_oauth2': ('oauth2', 'https://dummy/oauth2?{0}',
+                               'https://dummy/oauth2_token'),
+    'dummy_oidc': ('oidc', 'https://dummy'),
+  })
+
+  TOKEN_RESPONSE_PARSERS = dict(SimpleAuthHandler.TOKEN_RESPONSE_PARSERS,
+                                dummy_oauth1='_json_parser',
+                                dummy_oauth2='_json_parser')
+
   SESSION_MOCK = {}
 
   def __init__(self, *args, **kwargs):
     super(DummyAuthHandler, self).__init__(*args, **kwargs)
-    self.PROVIDERS.update({
-      'dummy_oauth1': ('oauth1', {
-        'request': 'https://dummy/oauth1_rtoken',
-        'auth'  : 'https://dummy/oauth1_auth?{0}'
-      }, 'https://dummy/oauth1_atoken'),
-      'dummy_oauth2': ('oauth2', 'https://dummy/oauth2?{0}',
-                                 'https://dummy/oauth2_token'),
-    })
-
-    self.TOKEN_RESPONSE_PARSERS.update({
-      'dummy_oauth1': '_json_parser',
-      'dummy_oauth2': '_json_parser'
-    })
-
     self.session = self.SESSION_MOCK.copy()
 
   def dispatch(self):
@@ -71,6 +73,7 @@ class DummyAuthHandler(RequestHandler, SimpleAuthHandler):
     return {
       'dummy_oauth1': ('cons_key', 'cons_secret'),
       'dummy_oauth2': ('cl_id', 'cl_secret', 'a_scope'),
+      'dummy_oidc': ('cl_id', 'cl_secret', 'openid email'),
     }.get(provider, (None, None))
 
   # Mocks
@@ -92,6 +95,43 @@ class DummyAuthHandler(RequestHandler, SimpleAuthHandler):
     return 'valid-csrf-token'
 
 
+class ScriptedTransport(sa.Transport):
+  """Returns responses in order. Exceptions in the list are raised."""
+  def __init__(self, *responses):
+    self.responses = list(responses)
+    self.deadlines = []
+    self.payloads = []
+
+  def fetch(self, url, payload=None, method='GET', headers=None,
+            deadline=None):
+    self.deadlines.append(deadline)
+    self.payloads.append(payload)
+    resp = self.responses.pop(0)
+    if isinstance(resp, Exception):
+      raise resp
+    return resp
+
+
+class RecordingTracer(sa.Tracer):
+  def __init__(self):
+    self.phases = []
+    self.sizes = []
+
+  def on_phase_end(self, provider, phase, duration, status=None, error=None):
+    self.phases.append((provider, phase, status))
+
+  def on_phase_bytes(self, provider, phase, wire_bytes, content_bytes):
+    self.sizes.append((provider, phase, wire_bytes, content_bytes))
+
+
+class SignedCSRFAuthHandler(DummyAuthHandler):
+  OAUTH2_CSRF_STATE = True
+  OAUTH2_CSRF_SECRET = 'a-very-secret-key'
+
+  # real token generation
+  _generate_csrf_token = SimpleAuthHandler.__dict__['_generate_csrf_token']
+
+
 #
 # test suite
 #
@@ -101,6 +141,10 @@ class SimpleAuthHandlerTestCase(TestMixin, unittest.TestCase):
     super(SimpleAuthHandlerTestCase, self).setUp()
     # set back to default value
     DummyAuthHandler.OAUTH2_CSRF_STATE = SimpleAuthHandler.OAUTH2_CSRF_STATE
+    DummyAuthHandler.OAUTH2_STATE_CODEC = SimpleAuthHandler.OAUTH2_STATE_CODEC
+    DummyAuthHandler.OAUTH1_REQUEST_TOKEN_STORE = \
+      SimpleAuthHandler.OAUTH1_REQUEST_TOKEN_STORE
+    DummyAuthHandler.OIDC_DISCOVERY = sa.DiscoveryCache()
     DummyAuthHandler.SESSION_MOCK = {
       'req_token': {
         'oauth_token':'oauth1 token',
@@ -131,6 +175,61 @@ class SimpleAuthHandlerTestCase(TestMixin, unittest.TestCase):
       self.assertIsNotNone(parser)
       self.assertTrue(hasattr(self.handler, parser))
 
+  def test_provider_registry(self):
+    p = self.handler._provider('dummy_oauth2')
+    self.assertEqual(p.auth_type, 'oauth2')
+    self.assertEqual(p.init_arg, 'https://dummy/oauth2?{0}')
+    self.assertEqual(p.callback_arg, 'https://dummy/oauth2_token')
+    self.assertEqual(p.parser, DummyAuthHandler._json_parser)
+    self.assertEqual(p.fetcher, DummyAuthHandler._get_dummy_oauth2_user_info)
+
+    p = self.handler._provider('openid')
+    self.assertEqual(p.init, DummyAuthHandler._openid_init)
+    self.assertIsNone(p.fetcher)
+
+    # dummy providers don't leak into the base class
+    self.assertNotIn('dummy_oauth2', SimpleAuthHandler._providers)
+
+  def test_misconfigured_provider(self):
+    with self.assertRaises(sa.UnknownAuthMethodError):
+      class NoUserInfoHandler(SimpleAuthHandler):
+        PROVIDERS = {'dummy': ('oauth2', 'https://dummy/?{0}', 'https://t')}
+        TOKEN_RESPONSE_PARSERS = {'dummy': '_json_parser'}
+
+    with self.assertRaises(sa.UnknownAuthMethodError):
+      class NoParserHandler(SimpleAuthHandler):
+        PROVIDERS = {'dummy': ('oauth2', 'https://dummy/?{0}', 'https://t')}
+        _get_dummy_user_info = lambda self, auth_info, key=None, secret=None: 1
+
+    with self.assertRaises(sa.UnknownAuthMethodError):
+      class UnknownAuthTypeHandler(SimpleAuthHandler):
+        PROVIDERS = {'dummy': ('oauth3', 'https://dummy/?{0}', 'https://t')}
+
+  def test_register_provider(self):
+    class RegisteredHandler(DummyAuthHandler):
+      def _get_dummy_oauth2_copy_user_info(self, auth_info, **kwargs):
+        return 'a copy'
+
+    RegisteredHandler.register_provider(
+      'dummy_oauth2_copy',
+      ('oauth2', 'https://dummy/copy?{0}', 'https://dummy/copy_token'),
+      parser='_json_parser')
+    p = RegisteredHandler()._provider('dummy_oauth2_copy')
+    self.assertEqual(p.callback_arg, 'https://dummy/copy_token')
+
+    # _get_dummy_no_user_info_user_info is missing
+    with self.assertRaises(sa.UnknownAuthMethodError):
+      RegisteredHandler.register_provider(
+        'dummy_no_user_info',
+        ('oauth2', 'https://dummy/copy?{0}', 'https://dummy/copy_token'),
+        parser='_json_parser')
+
+    self.assertNotIn('dummy_no_user_info', RegisteredHandler.PROVIDERS)
+    self.assertNotIn('dummy_no_user_info',
+                     RegisteredHandler.TOKEN_RESPONSE_PARSERS)
+    self.assertNotIn('dummy_oauth2_copy', DummyAuthHandler.PROVIDERS)
+    self.assertNotIn('dummy_oauth2_copy', DummyAuthHandler._providers)
+
   def test_not_supported_provider(self):
     self.expectErrors()
     with self.assertRaises(sa.UnknownAuthMethodError):
@@ -159,20 +258,488 @@ class SimpleAuthHandlerTestCase(TestMixin, unittest.TestCase):
     self.assertEqual(resp.headers['Location'],
       'http://localhost/logged_in?provider=dummy_oauth1&extra=null')
 
+  def test_tracer(self):
+    tracer = RecordingTracer()
+    self.set_urlfetch_response('https://dummy/oauth2_token',
+                               content='{"access_token": "a-token"}')
+    DummyAuthHandler.TRACER = tracer
+    try:
+      self.app.get_response('/auth/dummy_oauth2')
+      self.app.get_response('/auth/dummy_oauth1')
+      url = '/auth/dummy_oauth2/callback?code=auth-code&state={}'
+      self.app.get_response(url)
+    finally:
+      del DummyAuthHandler.TRACER
+
+    self.assertEqual(tracer.phases, [
+      ('dummy_oauth2', 'init', None),
+      ('dummy_oauth1', 'fetch', 200),
+      ('dummy_oauth1', 'request_token', 200),
+      ('dummy_oauth1', 'parse', None),
+      ('dummy_oauth1', 'init', None),
+      ('dummy_oauth2', 'fetch', 200),
+      ('dummy_oauth2', 'token', 200),
+      ('dummy_oauth2', 'parse', None),
+      ('dummy_oauth2', 'user_info', None),
+      ('dummy_oauth2', 'callback', None),
+      ('dummy_oauth2', 'signin', None)])
+    rtoken = len('{"oauth_token": "some oauth1 request token"}')
+    token = len('{"access_token": "a-token"}')
+    self.assertEqual(tracer.sizes, [
+      ('dummy_oauth1', 'fetch', rtoken, rtoken),
+      ('dummy_oauth2', 'fetch', token, token)])
+
+  def test_oauth1_request_token_store(self):
+    store = sa.LRUCache()
+    DummyAuthHandler.OAUTH1_REQUEST_TOKEN_STORE = store
+    DummyAuthHandler.SESSION_MOCK = {}
+
+    resp = self.app.get_response('/auth/dummy_oauth1')
+    self.assertEqual(resp.status_int, 302)
+    self.assertEqual(json.loads(resp.headers['SessionMock']), {})
+    cookie = resp.headers['Set-Cookie'].split(';')[0]
+    self.assertTrue(cookie.startswith('simpleauth_csrf='))
+    key = 'oauth1_req_token:dummy_oauth1:some oauth1 request token'
+    binding_hash, request_token = store.get(key)
+    self.assertNotIn(cookie.split('=', 1)[1], binding_hash)
+    self.assertEqual(request_token,
+                     {'oauth_token': 'some oauth1 request token'})
+
+    store.set('oauth1_req_token:dummy_oauth1:a-token',
+              (binding_hash,
+               {'oauth_token': 'a-token', 'oauth_token_secret': 'a secret'}))
+    url = ('/auth/dummy_oauth1/callback?'
+           'oauth_token=a-token&oauth_verifier=a-verifier-token')
+
+    # another browser can't use the callback URL
+    self.expectErrors()
+    for headers in ([], [('Cookie', 'simpleauth_csrf=other')]):
+      resp = self.app.get_response(url, headers=headers)
+      self.assertEqual(resp.status_int, 500)
+      self.assertRegexpMatches(resp.body, 'issued to another browser')
+
+    resp = self.app.get_response(url, headers=[('Cookie', cookie)])
+    self.assertEqual(resp.status_int, 302)
+    self.assertEqual(resp.headers['Location'],
+      'http://localhost/logged_in?provider=dummy_oauth1&extra=null')
+    self.assertIsNone(store.get('oauth1_req_token:dummy_oauth1:a-token'))
+
+    # request tokens are good for one callback only
+    resp = self.app.get_response(url, headers=[('Cookie', cookie)])
+    self.assertEqual(resp.status_int, 500)
+    self.assertRegexpMatches(resp.body, 'InvalidOAuthRequestToken')
+
   def test_oauth1_callback_failure(self):
     self.expectErrors()
     resp = self.app.get_response('/auth/dummy_oauth1/callback')
     self.assertEqual(resp.status_int, 500)
     self.assertRegexpMatches(resp.body, 'No OAuth verifier was provided')
 
+  def test_oauth1_client_memoized(self):
+    handler = SimpleAuthHandler()
+    client = handler._oauth1_client(consumer_key='k', consumer_secret='s')
+    self.assertIs(
+      handler._oauth1_client(consumer_key='k', consumer_secret='s'), client)
+    self.assertIsNot(
+      handler._oauth1_client(consumer_key='k2', consumer_secret='s'), client)
+    self.assertIsNone(client.token)
+
+  def test_parse_xml_user_info(self):
+    content = (
+      '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+      '<person>\n'
+      '  <id>AbC</id>\n'
+      '  <first-name>Dummy</first-name>\n'
+      '  <positions total="1"><position><id>p1</id></position></positions>\n'
+      '  <id>ignored</id>\n'
+      '  <headline>Tests things</headline>\n'
+      '</person>\n')
+
+    uinfo = self.handler._parse_xml_user_info(content)
+    self.assertEqual(set(uinfo), set(['id', 'first-name', 'positions',
+                                      'headline']))
+    self.assertEqual(uinfo['id'], 'AbC')
+
+    uinfo = self.handler._parse_xml_user_info(content, ['id', 'headline'])
+    self.assertEqual(uinfo, {'id': 'AbC', 'headline': 'Tests things'})
+
+  def test_parse_xml_user_info_stops_early(self):
+    padding = '<position><id>p</id></position>' * (
+      sa.handler.XML_STREAM_MIN_SIZE // 30)
+    # parsing stops before the unclosed element
+    content = (
+      '<person><id>AbC</id><first-name>Dummy</first-name>'
+      '<positions>%s</positions><broken>' % padding)
+    uinfo = self.handler._parse_xml_user_info(content, ['id', 'first-name'])
+    self.assertEqual(uinfo, {'id': 'AbC', 'first-name': 'Dummy'})
+
   def test_query_string_parser(self):
     parsed = self.handler._query_string_parser('param1=val1&param2=val2')
     self.assertEqual(parsed, {'param1':'val1', 'param2':'val2'})
 
+  def test_oauth2_user_info_extras(self):
+    self.expectWarnings()
+    self.handler.OAUTH2_USER_INFO_EXTRAS = {
+      'dummy_oauth2': {
+        'picture': 'https://dummy/picture?{0}',
+        'email': ('https://dummy/email?{0}', 'oauth_token'),
+        'broken': 'https://dummy/broken?{0}'
+      }
+    }
+    self.set_urlfetch_response('https://dummy/picture?access_token=a-token',
+                               content='{"url": "https://dummy/a.png"}')
+    self.set_urlfetch_response('https://dummy/email?oauth_token=a-token',
+                               content='"user@example.org"')
+    self.set_urlfetch_response('https://dummy/broken?access_token=a-token',
+                               content='not found', status_code=404)
+
+    pending = self.handler._oauth2_prefetch('dummy_oauth2',
+                                            {'access_token': 'a-token'})
+    self.assertEqual(set(pending), set(['picture', 'email', 'broken']))
+
+    user_data = {'id': '123'}
+    self.handler._merge_prefetched('dummy_oauth2', user_data, pending)
+    self.assertEqual(user_data, {
+      'id': '123',
+      'picture': {'url': 'https://dummy/a.png'},
+      'email': 'user@example.org'
+    })
+
+  def test_oauth2_id_token(self):
+    self.handler.OIDC_ID_TOKEN = {'dummy_oauth2': {
+      'jwks_uri': 'https://dummy/certs',
+      'issuers': ['https://dummy']
+    }}
+    self.handler.KEY_MANAGER = sa.KeyManager()
+    self.set_urlfetch_response('https://dummy/certs', content=make_jwks())
+    claims = {
+      'iss': 'https://dummy', 'aud': 'cl_id', 'sub': '123',
+      'email': 'user@example.org', 'email_verified': True,
+      'name': 'Dummy User', 'exp': int(time.time()) + 60
+    }
+    auth_info = {'access_token': 'a-token', 'id_token': sign_jwt(claims)}
+
+    user_data = self.handler._get_user_info('dummy_oauth2', auth_info,
+                                            key='cl_id')
+    self.assertEqual(user_data, {
+      'id': '123', 'sub': '123', 'name': 'Dummy User',
+      'email': 'user@example.org', 'email_verified': True,
+      'verified_email': True
+    })
+
+    # no id_token, e.g. 'openid' is not in the scope
+    user_data = self.handler._get_user_info('dummy_oauth2',
+                                            {'access_token': 'a-token'})
+    self.assertEqual(user_data, 'oauth2 mock user info')
+
+    auth_info['id_token'] = sign_jwt(dict(claims, aud='other'))
+    with self.assertRaises(sa.InvalidIdTokenError):
+      self.handler._get_user_info('dummy_oauth2', auth_info, key='cl_id')
+    # no client ID to check the audience against
+    with self.assertRaises(sa.InvalidIdTokenError):
+      self.handler._get_user_info('dummy_oauth2', auth_info)
+
+  def test_oidc_flow(self):
+    DummyAuthHandler.KEY_MANAGER = sa.KeyManager()
+    try:
+      self.set_urlfetch_response(
+        'https://dummy/.well-known/openid-configuration',
+        content=json.dumps({
+          'issuer': 'https://dummy',
+          'authorization_endpoint': 'https://dummy/oidc_auth?prompt=login',
+          'token_endpoint': 'https://dummy/oidc_token',
+          'userinfo_endpoint': 'https://dummy/userinfo',
+          'jwks_uri': 'https://dummy/certs'
+        }))
+      self.set_urlfetch_response('https://dummy/certs', content=make_jwks())
+      self.set_urlfetch_response(
+        'https://dummy/userinfo',
+        content='{"sub": "123", "name": "Dummy User"}')
+      claims = {'iss': 'https://dummy', 'aud': 'cl_id', 'sub': '123',
+                'exp': int(time.time()) + 60}
+      self.set_urlfetch_response(
+        'https://dummy/oidc_token', content=json.dumps(
+          {'access_token': 'a-token', 'id_token': sign_jwt(claims)}))
+
+      p = self.handler._provider('dummy_oidc')
+      self.assertEqual(p.auth_type, 'oidc')
+
+      resp = self.app.get_response('/auth/dummy_oidc')
+      self.assertEqual(resp.status_int, 302)
+      location = resp.headers['Location']
+      self.assertTrue(location.startswith(
+        'https://dummy/oidc_auth?prompt=login&'))
+      self.assertIn('scope=openid+email', location)
+
+      self.handler.request = Request.blank(
+        '/auth/dummy_oidc/callback?code=a-code&state=%7B%7D')
+      user_data, auth_info, extra = self.handler._oidc_callback(
+        'dummy_oidc', 'https://dummy')
+      self.assertEqual(user_data, {'id': '123', 'sub': '123'})
+      self.assertEqual(auth_info['access_token'], 'a-token')
+
+      # OIDC_USE_ID_TOKEN off: user info comes from userinfo endpoint
+      self.handler.OIDC_USE_ID_TOKEN = False
+      user_data = self.handler._get_user_info('dummy_oidc', auth_info)
+      self.assertEqual(user_data,
+                       {'id': '123', 'sub': '123', 'name': 'Dummy User'})
+    finally:
+      del DummyAuthHandler.KEY_MANAGER
+
+  def test_oidc_discovery_error(self):
+    self.set_urlfetch_response(
+      'https://dummy/.well-known/openid-configuration', status_code=404)
+    self.expectErrors()
+    resp = self.app.get_response('/auth/dummy_oidc')
+    self.assertEqual(resp.status_int, 500)
+    self.assertRegexpMatches(resp.body, 'AuthProviderResponseError')
+
+  def test_user_info_cache(self):
+    self.handler.USER_INFO_CACHE = sa.LRUCache()
+    auth_info = {'access_token': 'a-token'}
+
+    for i in range(2):
+      user_data = self.handler._get_user_info('dummy_oauth2', auth_info)
+      self.assertEqual(user_data, 'oauth2 mock user info')
+
+    self.assertEqual(self.handler.USER_INFO_CACHE.stats(),
+                     {'hits': 1, 'misses': 1})
+
+    key = self.handler._user_info_cache_key('dummy_oauth2', auth_info)
+    self.assertNotIn('a-token', key)
+
+  def test_user_info_cache_disabled(self):
+    self.assertIsNone(SimpleAuthHandler.USER_INFO_CACHE)
+    self.assertIsNone(self.handler._user_info_cache_key(
+      'dummy_oauth2', {'access_token': 'a-token'}))
+
+  def test_oauth2_user_info_extras_not_configured(self):
+    pending = self.handler._oauth2_prefetch('dummy_oauth2',
+                                            {'access_token': 'a-token'})
+    self.assertEqual(pending, {})
+
+  def test_user_info_fields(self):
+    self.handler.USER_INFO_FIELDS = {
+      'facebook': ('name', 'id', 'link'),
+      'linkedin2': ('first-name',)
+    }
+    self.set_urlfetch_response(
+      'https://graph.facebook.com/me?access_token=a-token'
+      '&fields=id%2Cname%2Clink',
+      content='{"id": "123", "name": "Dummy User"}')
+    user_data = self.handler._get_facebook_user_info(
+      {'access_token': 'a-token'})
+    self.assertEqual(user_data, {'id': '123', 'name': 'Dummy User'})
+
+    self.set_urlfetch_response(
+      'https://api.linkedin.com/v1/people/~:(id,first-name)'
+      '?oauth2_access_token=a-token',
+      content='<person><id>AbC</id><first-name>Dummy</first-name></person>')
+    user_data = self.handler._get_linkedin2_user_info(
+      {'access_token': 'a-token'})
+    self.assertEqual(user_data, {'id': 'AbC', 'first-name': 'Dummy'})
+
+  def test_user_info_fields_not_configured(self):
+    self.assertEqual(SimpleAuthHandler.USER_INFO_FIELDS, {})
+    url = 'https://graph.facebook.com/me?{0}'
+    self.assertEqual(self.handler._user_info_url(url, 'facebook'), url)
+    self.assertEqual(
+      self.handler._user_info_fields('linkedin', sa.handler.LINKEDIN_FIELDS),
+      sa.handler.LINKEDIN_FIELDS)
+
+  def test_user_info_retries(self):
+    self.expectErrors()
+    self.handler.TRANSPORT = ScriptedTransport(
+      sa.Response(503, 'unavailable'), IOError('reset'),
+      sa.Response(200, '{"id": "123"}'))
+    self.handler.USER_INFO_RETRIES = 2
+    self.handler.RETRY_DELAY = 0
+    user_data = self.handler._get_facebook_user_info(
+      {'access_token': 'a-token'})
+    self.assertEqual(user_data, {'id': '123'})
+    # no deadline configured
+    self.assertEqual(self.handler.TRANSPORT.deadlines, [None] * 3)
+
+    self.handler.TRANSPORT = ScriptedTransport(
+      sa.Response(503, 'unavailable'), sa.Response(502, 'bad gateway'),
+      sa.Response(500, 'error'))
+    resp = self.handler._send(self.handler.TRANSPORT.fetch, retries=1,
+                              url='https://dummy/me')
+    self.assertEqual(resp.status_code, 502)
+
+  def test_no_retries_by_default(self):
+    self.handler.TRANSPORT = ScriptedTransport(IOError('reset'))
+    with self.assertRaises(IOError):
+      self.handler._oauth2_request('https://dummy/me?{0}', 'a-token')
+
+  def test_transport_error(self):
+    self.handler.TRANSPORT = ScriptedTransport(sa.TransportError('reset'))
+    self.handler._active_provider = 'facebook'
+    with self.assertRaises(sa.AuthProviderResponseError) as cm:
+      self.handler._oauth2_request('https://dummy/me?{0}', 'a-token')
+    self.assertEqual(cm.exception.args, ('reset', 'facebook'))
+
+  def test_callback_deadline(self):
+    transport = ScriptedTransport(
+      sa.Response(200, '{"access_token": "a-token"}'))
+    DummyAuthHandler.TRANSPORT = transport
+    DummyAuthHandler.CALLBACK_DEADLINES = {'*': 10, 'dummy_oauth1': 1}
+    try:
+      query = urlencode({'code': 'a-code', 'state': json.dumps({})})
+      resp = self.app.get_response('/auth/dummy_oauth2/callback?' + query)
+    finally:
+      del DummyAuthHandler.TRANSPORT
+      del DummyAuthHandler.CALLBACK_DEADLINES
+    self.assertEqual(resp.status_int, 302)
+    self.assertEqual(len(transport.deadlines), 1)
+    self.assertTrue(9 < transport.deadlines[0] <= 10)
+    self.assertIsNone(self.handler._deadline)
+
+  def test_callback_deadline_exceeded(self):
+    self.expectErrors()
+    self.handler._deadline = ('dummy_oauth2', time.time() + 0.05)
+    self.handler.TRANSPORT = ScriptedTransport(
+      sa.Response(503, 'unavailable'), sa.Response(200, '{}'))
+    self.handler.USER_INFO_RETRIES = 1
+    self.handler.RETRY_DELAY = 10
+    # the retry wouldn't make it in time
+    with self.assertRaises(sa.AuthProviderResponseError):
+      self.handler._oauth2_request('https://dummy/me?{0}', 'a-token')
+
+    self.handler._deadline = ('dummy_oauth2', time.time() - 1)
+    with self.assertRaises(sa.AuthProviderResponseError):
+      self.handler._oauth2_request('https://dummy/me?{0}', 'a-token')
+
+  def test_circuit_breaker(self):
+    self.expectErrors()
+    circuit = sa.CircuitBreaker(min_requests=2, slow_call=None)
+    DummyAuthHandler.CIRCUIT_BREAKER = circuit
+    DummyAuthHandler.TRANSPORT = ScriptedTransport(
+      sa.Response(503, 'unavailable'), IOError('timed out'))
+    query = urlencode({'code': 'a-code', 'state': json.dumps({})})
+    try:
+      for i in range(2):
+        resp = self.app.get_response('/auth/dummy_oauth2/callback?' + query)
+        self.assertEqual(resp.status_int, 500)
+      self.assertEqual(circuit.state('dummy_oauth2'), 'open')
+
+      # fails fast
+      resp = self.app.get_response('/auth/dummy_oauth2/callback?' + query)
+      self.assertRegexpMatches(resp.body, 'ProviderUnavailableError')
+      resp = self.app.get_response('/auth/dummy_oauth2')
+      self.assertRegexpMatches(resp.body, 'ProviderUnavailableError')
+      # other providers don't
+      resp = self.app.get_response('/auth/dummy_oauth1')
+      self.assertEqual(resp.status_int, 302)
+    finally:
+      del DummyAuthHandler.CIRCUIT_BREAKER
+      del DummyAuthHandler.TRANSPORT
+
+  def test_callback_singleflight(self):
+    transport = ScriptedTransport(
+      sa.Response(200, '{"access_token": "a-token"}'))
+    DummyAuthHandler.TRANSPORT = transport
+    DummyAuthHandler.CALLBACK_SINGLEFLIGHT = sa.SingleFlight(ttl=5)
+    query = urlencode({'code': 'a-code', 'state': json.dumps({'extra': 1})})
+    try:
+      for i in range(2):
+        resp = self.app.get_response('/auth/dummy_oauth2/callback?' + query)
+        self.assertEqual(resp.status_int, 302)
+        self.assertEqual(resp.headers['Location'],
+          'http://localhost/logged_in?provider=dummy_oauth2&extra=1')
+    finally:
+      del DummyAuthHandler.TRANSPORT
+      del DummyAuthHandler.CALLBACK_SINGLEFLIGHT
+    # the code was exchanged once
+    self.assertEqual(len(transport.deadlines), 1)
+
+  def test_singleflight_key(self):
+    self.assertIsNone(self.handler._singleflight_key('dummy_oauth2', 'code'))
+    self.handler.CALLBACK_SINGLEFLIGHT = sa.SingleFlight()
+    def key(provider='dummy_oauth2', code='a-code', state='s', cookie='a=1'):
+      self.handler.request = Request.blank(
+          '/?' + urlencode({'state': state}), headers=[('Cookie', cookie)])
+      return self.handler._singleflight_key(provider, code)
+
+    self.assertNotIn('a-code', key())
+    self.assertEqual(key(), key())
+    self.assertNotEqual(key(), key(provider='google'))
+    self.assertNotEqual(key(), key(state='other'))
+    # a leaked code and state from another browser
+    self.assertNotEqual(key(), key(cookie='a=2'))
+    self.assertIsNone(key(code=''))
+
+    # only the binding cookie matters with signed CSRF tokens
+    self.handler.OAUTH2_CSRF_SECRET = 'secret'
+    self.assertEqual(key(cookie='simpleauth_csrf=b; a=1'),
+                     key(cookie='simpleauth_csrf=b; a=2'))
+    self.assertNotEqual(key(cookie='simpleauth_csrf=b'),
+                        key(cookie='simpleauth_csrf=c'))
+
+  def test_save_tokens(self):
+    self.expectWarnings()
+    self.handler.TOKEN_MANAGER = sa.TokenManager()
+    auth_info = {'access_token': 'a-token', 'refresh_token': 'r-token',
+                 'expires_in': 3600}
+    self.handler._save_tokens('dummy_oauth2', {'id': '123'}, auth_info)
+    self.assertEqual(self.handler._get_access_token('dummy_oauth2', '123'),
+                     'a-token')
+
+    # no user ID to store tokens by
+    self.handler._save_tokens('dummy_oauth2', 'user info', auth_info)
+    self.assertEqual(len(self.handler.TOKEN_MANAGER._memory), 1)
+
+  def test_oauth2_refresh(self):
+    transport = ScriptedTransport(
+      sa.Response(200, '{"access_token": "new-token", "expires_in": 3600}'),
+      sa.Response(400, '{"error": "invalid_grant"}'))
+    self.handler.TRANSPORT = transport
+
+    auth_info = self.handler._oauth2_refresh('dummy_oauth2', 'r-token')
+    self.assertEqual(auth_info['access_token'], 'new-token')
+    self.assertEqual(urlparse.parse_qs(transport.payloads[0]), {
+      'refresh_token': ['r-token'],
+      'client_id': ['cl_id'],
+      'client_secret': ['cl_secret'],
+      'grant_type': ['refresh_token'],
+    })
+
+    self.assertRaises(sa.AuthProviderResponseError,
+                      self.handler._oauth2_refresh, 'dummy_oauth2', 'r-token')
+    self.assertRaises(sa.UnknownAuthMethodError,
+                      self.handler._oauth2_refresh, 'dummy_oauth1', 'r-token')
+
   #
   # CSRF tests
   #
 
+  def test_oauth2_state_codec(self):
+    store = sa.LRUCache()
+    DummyAuthHandler.OAUTH2_STATE_CODEC = sa.StateCodec(max_size=64,
+                                                        store=store)
+    self.set_urlfetch_response('https://dummy/oauth2_token',
+                               content='{"access_token": "a-token"}')
+
+    # random data doesn't compress well
+    long_value = base64.urlsafe_b64encode(os.urandom(120))
+    for value, versions in (('short', 'jz'), (long_value, 'r')):
+      resp = self.app.get_response('/auth/dummy_oauth2?next=' + value)
+      self.assertEqual(resp.status_int, 302)
+      location = urlparse.urlsplit(resp.headers['Location'])
+      state = dict(urlparse.parse_qsl(location.query))['state']
+      self.assertIn(state[0], versions)
+      self.assertTrue(len(state) <= 64)
+
+      query = urlencode({'code': 'auth-code', 'state': state})
+      resp = self.app.get_response('/auth/dummy_oauth2/callback?' + query)
+      self.assertEqual(resp.status_int, 302)
+      extra = urlparse.parse_qs(
+        urlparse.urlsplit(resp.headers['Location']).query)['extra'][0]
+      self.assertEqual(json.loads(extra), [['next', value]])
+
+    # spilled state is good for one callback only
+    self.assertEqual(len(store), 0)
+
   def test_csrf_default(self):
     # Backward compatibility with older versions
     self.assertFalse(SimpleAuthHandler.OAUTH2_CSRF_STATE)
@@ -263,6 +830,73 @@ class SimpleAuthHandlerTestCase(TestMixin, unittest.TestCase):
     self.assertEqual(resp.status_int, 500)
     self.assertRegexpMatches(resp.body, 'InvalidCSRFTokenError')
 
+  def test_csrf_signed_oauth2_flow(self):
+    routes = [
+      Route('/auth/<provider>', handler=SignedCSRFAuthHandler,
+        handler_method='_simple_auth'),
+      Route('/auth/<provider>/callback', handler=SignedCSRFAuthHandler,
+        handler_method='_auth_callback') ]
+    app = WSGIApplication(routes, debug=True)
+
+    resp = app.get_response('/auth/dummy_oauth2')
+    self.assertEqual(resp.status_int, 302)
+    # no session round trip
+    self.assertEqual(json.loads(resp.headers['SessionMock']),
+                     DummyAuthHandler.SESSION_MOCK)
+
+    cookie = resp.headers['Set-Cookie'].split(';')[0]
+    self.assertTrue(cookie.startswith('simpleauth_csrf='))
+    self.assertIn('HttpOnly', resp.headers['Set-Cookie'])
+    location = urlparse.urlsplit(resp.headers['Location'])
+    state = dict(urlparse.parse_qsl(location.query))['state']
+    token = json.loads(state)[SimpleAuthHandler.OAUTH2_CSRF_STATE_PARAM]
+
+    self.set_urlfetch_response('https://dummy/oauth2_token',
+                               content='{"access_token": "a-token"}')
+    query = urlencode({'code': 'auth-code', 'state': state})
+    url = '/auth/dummy_oauth2/callback?' + query
+
+    resp = app.get_response(url, headers=[('Cookie', cookie)])
+    self.assertEqual(resp.status_int, 302)
+    self.assertEqual(resp.headers['Location'],
+      'http://localhost/logged_in?provider=dummy_oauth2&extra=%5B%5D')
+
+    self.expectErrors()
+    # different browser
+    resp = app.get_response(url, headers=[('Cookie', 'simpleauth_csrf=xyz')])
+    self.assertEqual(resp.status_int, 500)
+    self.assertRegexpMatches(resp.body, 'InvalidCSRFTokenError')
+
+    # no cookie
+    resp = app.get_response(url)
+    self.assertEqual(resp.status_int, 500)
+    self.assertRegexpMatches(resp.body, 'InvalidCSRFTokenError')
+
+    # tampered signature
+    decoded = base64.urlsafe_b64decode(str(token))
+    tampered = base64.urlsafe_b64encode(decoded.replace('.', '.0', 1))
+    state = json.dumps({SimpleAuthHandler.OAUTH2_CSRF_STATE_PARAM: tampered})
+    query = urlencode({'code': 'auth-code', 'state': state})
+    resp = app.get_response('/auth/dummy_oauth2/callback?' + query,
+                            headers=[('Cookie', cookie)])
+    self.assertEqual(resp.status_int, 500)
+    self.assertRegexpMatches(resp.body, 'InvalidCSRFTokenError')
+
+  def test_csrf_signed_token_timeout(self):
+    self.expectErrors()
+    h = SignedCSRFAuthHandler()
+    h.request = Request.blank('/', headers=[('Cookie', 'simpleauth_csrf=b')])
+
+    token = h._generate_csrf_token()
+    self.assertTrue(h._validate_csrf_token(
+      h._expected_signed_csrf_token(token), token))
+
+    timeout = long(time.time()) - h.OAUTH2_CSRF_TOKEN_TIMEOUT - 1
+    token = h._generate_csrf_token(_time=timeout)
+    self.assertFalse(h._validate_csrf_token(
+      h._expected_signed_csrf_token(token), token))
+    self.assertEqual(h._expected_signed_csrf_token('invalid b64'), '')
+
   def test_csrf_token_generation(self):
     h = SimpleAuthHandler()
     token = h._generate_csrf_token()
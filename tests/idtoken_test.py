@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+import unittest
+from tests import sign_jwt, make_jwks, TEST_RSA_N, TEST_RSA_E
+
+import time
+
+from simpleauth import idtoken
+from simpleauth.keys import parse_jwks
+
+
+class DecodeTestCase(unittest.TestCase):
+  def setUp(self):
+    self.keys = parse_jwks(make_jwks())
+    self.claims = {
+      'iss': 'https://accounts.google.com',
+      'aud': 'client-id',
+      'sub': '1234567890',
+      'email': 'user@example.org',
+      'iat': int(time.time()),
+      'exp': int(time.time()) + 3600
+    }
+
+  def decode(self, token, get_key=None, **kwargs):
+    kwargs.setdefault('audience', 'client-id')
+    kwargs.setdefault('issuers', ['https://accounts.google.com'])
+    return idtoken.decode(token, get_key or self.keys.get, **kwargs)
+
+  def test_valid(self):
+    self.assertEqual(self.decode(sign_jwt(self.claims)), self.claims)
+
+  def test_rsa_key(self):
+    key = self.keys['test-key']
+    self.assertEqual((key.n, key.e), (TEST_RSA_N, TEST_RSA_E))
+    self.assertFalse(key.verify('message', 'x' * key.size))
+    self.assertFalse(key.verify('message', 'short'))
+    self.assertFalse(key.verify('message', '\xff' * key.size))
+
+  def test_invalid_signature(self):
+    head, payload, sig = sign_jwt(self.claims).split('.')
+    other = sign_jwt(dict(self.claims, sub='0')).split('.')[1]
+    for token in ('%s.%s.%s' % (head, other, sig),
+                  '%s.%s.%s' % (head, payload, sig[:-4] + 'AAAA'),
+                  '%s.%s.' % (head, payload)):
+      self.assertRaises(idtoken.InvalidTokenError, self.decode, token)
+
+  def test_malformed(self):
+    for token in ('', 'abc', 'a.b', 'a.b.c', 'a.b.c.d', 'e30.W10.e30'):
+      self.assertRaises(idtoken.InvalidTokenError, self.decode, token)
+
+  def test_es256(self):
+    # RFC 7515 A.3
+    key = idtoken.ECPublicKey.from_jwk({
+      'kty': 'EC', 'crv': 'P-256',
+      'x': 'f83OJ3D2xF1Bg8vub9tLe1gHMzV76e8Tus9uPHvRVEU',
+      'y': 'x_FEzRu9m36HLN_tue659LNpXW6pCyStikYjKIWI5a0'})
+    token = ('eyJhbGciOiJFUzI1NiJ9.'
+             'eyJpc3MiOiJqb2UiLA0KICJleHAiOjEzMDA4MTkzODAsDQogImh0dHA6Ly9leGF'
+             'tcGxlLmNvbS9pc19yb290Ijp0cnVlfQ.'
+             'DtEhU3ljbEg8L38VWAfUAqOyKAM6-Xx-F4GawxaepmXFCgfTjDxw5djxLa8ISlS'
+             'ApmWQxfKTUJqPP3-Kg6NU1Q')
+    claims = idtoken.decode(token, lambda kid: key, now=1300819380,
+                            verify_audience=False)
+    self.assertEqual(claims['iss'], 'joe')
+
+    tampered = token[:-4] + 'AAAA'
+    self.assertRaises(idtoken.InvalidTokenError, idtoken.decode, tampered,
+                      lambda kid: key, now=1300819380, verify_audience=False)
+    # RSA key can't verify ES256 and vice versa
+    self.assertRaises(idtoken.InvalidTokenError, idtoken.decode, token,
+                      lambda kid: self.keys['test-key'], now=1300819380,
+                      verify_audience=False)
+    self.assertRaises(idtoken.InvalidTokenError, self.decode,
+                      sign_jwt(self.claims), get_key=lambda kid: key)
+
+  def test_unsupported_alg(self):
+    for alg in ('none', 'HS256', 'ES384'):
+      token = sign_jwt(self.claims, alg=alg)
+      self.assertRaises(idtoken.InvalidTokenError, self.decode, token)
+
+  def test_unknown_key(self):
+    token = sign_jwt(self.claims, kid='other-key')
+    self.assertRaises(idtoken.InvalidTokenError, self.decode, token)
+
+  def test_claims(self):
+    now = int(time.time())
+    invalid = [
+      dict(self.claims, exp=now - 3600),
+      dict(self.claims, iat=now + 3600),
+      dict(self.claims, aud='other-client-id'),
+      dict(self.claims, aud=['other-client-id']),
+      dict(self.claims, iss='https://evil.example.org'),
+    ]
+    invalid.append(dict(self.claims))
+    del invalid[-1]['exp']
+    for claims in invalid:
+      self.assertRaises(idtoken.InvalidTokenError, self.decode,
+                        sign_jwt(claims))
+
+    # within leeway
+    claims = dict(self.claims, exp=now - 30, aud=['x', 'client-id'])
+    self.assertEqual(self.decode(sign_jwt(claims)), claims)
+    # no audience or issuer check
+    claims = dict(self.claims, aud='x', iss='y')
+    self.assertEqual(self.decode(sign_jwt(claims), audience=None,
+                                 issuers=None, verify_audience=False), claims)
+    # the audience check is never skipped by accident
+    self.assertRaises(ValueError, self.decode, sign_jwt(claims),
+                      audience=None)
+
+
+if __name__ == '__main__':
+  unittest.main()
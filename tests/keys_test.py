@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+import unittest
+from tests import make_jwks
+
+import json
+
+from simpleauth import keys
+from simpleauth import Response
+
+
+# RFC 7515 A.3 key
+EC_JWK = {'kty': 'EC', 'crv': 'P-256', 'kid': 'ec-key',
+          'x': 'f83OJ3D2xF1Bg8vub9tLe1gHMzV76e8Tus9uPHvRVEU',
+          'y': 'x_FEzRu9m36HLN_tue659LNpXW6pCyStikYjKIWI5a0'}
+
+
+class TransportMock(object):
+  def __init__(self, content, status_code=200, headers=None):
+    self.content = content
+    self.status_code = status_code
+    self.headers = headers
+    self.calls = []
+
+  def fetch(self, url, payload=None, method='GET', headers=None):
+    self.calls.append(url)
+    return Response(self.status_code, self.content, self.headers)
+
+
+class KeyManagerTestCase(unittest.TestCase):
+  URI = 'https://example.org/certs'
+
+  def test_get_key(self):
+    transport = TransportMock(make_jwks())
+    manager = keys.KeyManager()
+    key = manager.get_key(self.URI, 'test-key', transport)
+    self.assertIsNotNone(key)
+    self.assertIs(manager.get_key(self.URI, 'test-key', transport), key)
+    self.assertEqual(transport.calls, [self.URI])
+
+  def test_unknown_kid_refetch(self):
+    transport = TransportMock(make_jwks())
+    manager = keys.KeyManager(refetch_interval=0)
+    manager.get_key(self.URI, 'test-key', transport)
+    # keys rotated
+    transport.content = make_jwks(kid='new-key')
+    self.assertIsNotNone(manager.get_key(self.URI, 'new-key', transport))
+    self.assertEqual(len(transport.calls), 2)
+
+  def test_unknown_kid_rate_limit(self):
+    transport = TransportMock(make_jwks())
+    manager = keys.KeyManager()
+    manager.get_key(self.URI, 'test-key', transport)
+    for i in range(10):
+      self.assertIsNone(manager.get_key(self.URI, 'kid-%d' % i, transport))
+    self.assertEqual(len(transport.calls), 1)
+
+  def test_cache_control(self):
+    manager = keys.KeyManager(ttl=100, min_ttl=10, max_ttl=1000)
+    self.assertEqual(manager._ttl({}), 100)
+    self.assertEqual(manager._ttl({
+      'cache-control': 'public, max-age=500, must-revalidate'}), 500)
+    self.assertEqual(manager._ttl({
+      'cache-control': 'max-age=500', 'age': '200'}), 300)
+    self.assertEqual(manager._ttl({'cache-control': 'max-age=5'}), 10)
+    self.assertEqual(manager._ttl({'cache-control': 'max-age=5000'}), 1000)
+    self.assertEqual(manager._ttl({'cache-control': 'no-cache'}), 10)
+
+    transport = TransportMock(make_jwks(),
+                              headers={'Cache-Control': 'max-age=500'})
+    keyset = manager.refresh(self.URI, transport)
+    self.assertAlmostEqual(keyset.expires - keyset.fetched, 500)
+
+  def test_refresh_ahead(self):
+    transport = TransportMock(make_jwks(),
+                              headers={'Cache-Control': 'max-age=60'})
+    manager = keys.KeyManager(min_ttl=0, refresh_ahead=120)
+    key = manager.get_key(self.URI, 'test-key', transport)
+    self.assertEqual(len(transport.calls), 1)
+
+    # refreshed in the calling thread by default
+    self.assertIsNot(manager.get_key(self.URI, 'test-key', transport), key)
+    self.assertEqual(len(transport.calls), 2)
+    self.assertEqual(manager._refreshing, {})
+
+    # cached keys are used if the refresh fails
+    key = manager.get_key(self.URI, 'test-key', transport)
+    transport.status_code = 503
+    self.assertIs(manager.get_key(self.URI, 'test-key', transport), key)
+
+  def test_background_refresh(self):
+    transport = TransportMock(make_jwks(),
+                              headers={'Cache-Control': 'max-age=60'})
+    manager = keys.KeyManager(min_ttl=0, refresh_ahead=120, background=True)
+    key = manager.get_key(self.URI, 'test-key', transport)
+    self.assertEqual(len(transport.calls), 1)
+
+    # served from cache, refreshed in background
+    self.assertIs(manager.get_key(self.URI, 'test-key', transport), key)
+    thread = manager._refreshing.get(self.URI)
+    if thread is not None:
+      thread.join()
+    self.assertEqual(len(transport.calls), 2)
+    self.assertIsNot(manager.get_key(self.URI, 'test-key', transport), key)
+
+  def test_expiry(self):
+    transport = TransportMock(make_jwks())
+    manager = keys.KeyManager(ttl=-1)
+    manager.get_key(self.URI, 'test-key', transport)
+    manager.get_key(self.URI, 'test-key', transport)
+    self.assertEqual(len(transport.calls), 2)
+
+  def test_stale_keys(self):
+    transport = TransportMock(make_jwks())
+    manager = keys.KeyManager(ttl=-1)
+    key = manager.get_key(self.URI, 'test-key', transport)
+    transport.status_code = 503
+    self.assertIs(manager.get_key(self.URI, 'test-key', transport), key)
+    self.assertRaises(keys.InvalidTokenError, manager.get_key,
+                      self.URI, 'other-key', transport)
+
+  def test_fetch_error(self):
+    manager = keys.KeyManager()
+    self.assertRaises(keys.InvalidTokenError, manager.get_key,
+                      self.URI, 'test-key', TransportMock('', 500))
+    self.assertRaises(keys.InvalidTokenError, manager.get_key,
+                      self.URI, 'test-key', TransportMock('not json'))
+
+  def test_parse_jwks(self):
+    content = json.dumps({'keys': [
+      EC_JWK,
+      {'kty': 'EC', 'crv': 'P-384', 'kid': 'p384'},
+      {'kty': 'EC', 'crv': 'P-256', 'kid': 'bad-point', 'x': 'AQ', 'y': 'AQ'},
+      {'kty': 'RSA', 'kid': 'broken'},
+      {'kty': 'oct', 'kid': 'secret', 'k': 'AQ'},
+    ]})
+    parsed = keys.parse_jwks(content)
+    self.assertEqual(parsed.keys(), ['ec-key'])
+    self.assertIsInstance(parsed['ec-key'], keys.ECPublicKey)
+
+
+if __name__ == '__main__':
+  unittest.main()
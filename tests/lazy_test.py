@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+import unittest
+
+import sys
+
+from simpleauth.lazy import LazyModule
+
+
+class LazyModuleTestCase(unittest.TestCase):
+  def setUp(self):
+    sys.modules.pop('colorsys', None)
+
+  def test_imports_on_first_use(self):
+    colorsys = LazyModule('colorsys')
+    self.assertNotIn('colorsys', sys.modules)
+    self.assertEqual(colorsys.rgb_to_hsv(0, 0, 0), (0, 0, 0))
+    self.assertIn('colorsys', sys.modules)
+    self.assertIs(colorsys._module, sys.modules['colorsys'])
+
+  def test_fallbacks(self):
+    colorsys = LazyModule('no_such_module_at_all', 'colorsys')
+    self.assertEqual(colorsys.__name__, 'colorsys')
+
+  def test_import_error(self):
+    missing = LazyModule('no_such_module_at_all', 'nor_this_one')
+    self.assertRaises(ImportError, getattr, missing, 'anything')
+
+  def test_missing_attribute(self):
+    colorsys = LazyModule('colorsys')
+    self.assertRaises(AttributeError, getattr, colorsys, 'no_such_function')
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+import unittest
+
+import time
+
+import oauth2 as oauth1
+
+
+class BackendMock(object):
+  """memcache.Client-like add() and add_multi()"""
+  def __init__(self):
+    self.keys = set()
+    self.calls = 0
+
+  def add(self, key, value, time=0):
+    self.calls += 1
+    if key in self.keys:
+      return False
+    self.keys.add(key)
+    return True
+
+  def add_multi(self, mapping, time=0):
+    self.calls += 1
+    not_added = [k for k in mapping if k in self.keys]
+    self.keys.update(mapping)
+    return not_added
+
+
+CONSUMERS = {'cons_key': oauth1.Consumer('cons_key', 'cons_secret')}
+TOKENS = {'token_key': oauth1.Token('token_key', 'token_secret')}
+
+
+def signed_request(nonce, timestamp=None, token=TOKENS['token_key'],
+                   consumer=CONSUMERS['cons_key']):
+  req = oauth1.Request.from_consumer_and_token(
+    consumer, token=token, http_url='https://example.org/api?a=1',
+    parameters={'oauth_nonce': nonce, 'b': '2',
+                'oauth_timestamp': str(timestamp or int(time.time()))})
+  req.sign_request(oauth1.SignatureMethod_HMAC_SHA1(), consumer, token)
+  return req
+
+
+class ServerTestCase(unittest.TestCase):
+  def setUp(self):
+    self.lookups = []
+    self.store = oauth1.MemoryNonceStore()
+    self.server = oauth1.Server(nonce_store=self.store,
+                                consumer_lookup=self.lookup_consumer,
+                                token_lookup=self.lookup_token)
+    self.server.add_signature_method(oauth1.FastSignatureMethod_HMAC_SHA1())
+
+  def lookup_consumer(self, key):
+    self.lookups.append(key)
+    return CONSUMERS.get(key)
+
+  def lookup_token(self, consumer, key):
+    self.lookups.append(key)
+    return TOKENS.get(key)
+
+  def test_verify(self):
+    for nonce in ('n1', 'n2'):
+      params = self.server.verify(signed_request(nonce))
+      self.assertEqual(params, {'b': '2'})
+    # cached lookups
+    self.assertEqual(self.lookups, ['cons_key', 'token_key'])
+
+  def test_replay(self):
+    req = signed_request('n1')
+    self.server.verify(req)
+    self.assertRaisesRegexp(oauth1.Error, 'Nonce already used',
+                            self.server.verify, req)
+    # same nonce with another timestamp is a different nonce
+    self.server.verify(signed_request('n1', int(time.time()) - 1))
+
+  def test_verify_request_without_lookups(self):
+    server = oauth1.Server(nonce_store=oauth1.MemoryNonceStore())
+    server.add_signature_method(oauth1.SignatureMethod_HMAC_SHA1())
+    req = signed_request('n1')
+    server.verify_request(req, CONSUMERS['cons_key'], TOKENS['token_key'])
+    self.assertRaises(oauth1.Error, server.verify_request, req,
+                      CONSUMERS['cons_key'], TOKENS['token_key'])
+    self.assertRaisesRegexp(oauth1.Error, 'No consumer lookup',
+                            server.verify, signed_request('n2'))
+
+  def test_invalid(self):
+    now = int(time.time())
+    unknown = oauth1.Consumer('unknown', 'cons_secret')
+    bad_secret = oauth1.Consumer('cons_key', 'wrong')
+    for req, error in [
+        (signed_request('n1', now - 3600), 'Expired timestamp'),
+        (signed_request('n2', now + 3600), 'Timestamp in the future'),
+        (signed_request('n3', consumer=unknown), 'Invalid consumer'),
+        (signed_request('n4', consumer=bad_secret), 'Invalid signature'),
+        (signed_request('n5', token=oauth1.Token('x', 'y')), 'Invalid token')]:
+      self.assertRaisesRegexp(oauth1.Error, error, self.server.verify, req)
+    # invalid requests don't use up nonces
+    self.server.verify(signed_request('n4'))
+
+  def test_verify_requests(self):
+    backend = BackendMock()
+    self.store.backend = backend
+    reqs = [signed_request('n%d' % i) for i in range(5)]
+    reqs.append(reqs[0])
+    reqs.append(signed_request('n9', consumer=oauth1.Consumer('x', 'y')))
+
+    results = self.server.verify_requests(reqs)
+    self.assertEqual(results[:5], [{'b': '2'}] * 5)
+    self.assertIsInstance(results[5], oauth1.Error)
+    self.assertIsInstance(results[6], oauth1.Error)
+    self.assertEqual(backend.calls, 1)
+    self.assertEqual(len(backend.keys), 5)
+
+  def test_shared_backend(self):
+    backend = BackendMock()
+    req = signed_request('n1')
+    self.store.backend = backend
+    self.server.verify(req)
+
+    # another worker, with its own ring
+    other = oauth1.Server(
+      nonce_store=oauth1.MemoryNonceStore(backend=backend),
+      consumer_lookup=CONSUMERS.get, token_lookup=self.lookup_token)
+    other.add_signature_method(oauth1.SignatureMethod_HMAC_SHA1())
+    self.assertRaisesRegexp(oauth1.Error, 'Nonce already used',
+                            other.verify, req)
+
+
+class MemoryNonceStoreTestCase(unittest.TestCase):
+  def test_add(self):
+    store = oauth1.MemoryNonceStore()
+    self.assertTrue(store.add('a', 100, 60))
+    self.assertFalse(store.add('a', 100, 60))
+    self.assertTrue(store.seen('a', 100))
+    self.assertEqual(store.add_multi([('b', 100), ('b', 100), ('a', 100)], 60),
+                     [True, False, False])
+
+  def test_expired(self):
+    store = oauth1.MemoryNonceStore()
+    store.add('a', 100, -1)
+    self.assertFalse(store.seen('a', 100))
+    self.assertTrue(store.add('a', 100, 60))
+    self.assertEqual(len(store._ring), 1)
+
+  def test_bounded(self):
+    store = oauth1.MemoryNonceStore(max_size=3)
+    for i in range(5):
+      store.add(str(i), 100 + i, 60)
+    self.assertEqual(len(store._ring), 3)
+    self.assertEqual(len(store._expires), 3)
+    # evicted nonces can't be replayed
+    self.assertEqual(store.floor, 101)
+    self.assertFalse(store.add('0', 100, 60))
+    self.assertFalse(store.add('1', 101, 60))
+    self.assertTrue(store.add('5', 105, 60))
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+import unittest
+
+import oauth2 as oauth1
+
+
+class FastSignatureMethodTestCase(unittest.TestCase):
+  def setUp(self):
+    self.consumer = oauth1.Consumer('cons_key', u'cons secret~+/é')
+    self.token = oauth1.Token('token_key', 'token&secret')
+    self.slow = oauth1.SignatureMethod_HMAC_SHA1()
+    self.fast = oauth1.FastSignatureMethod_HMAC_SHA1()
+
+  def make_request(self, url, method='GET', parameters=None,
+                   is_form_encoded=False):
+    params = {
+      'oauth_nonce': '12345678',
+      'oauth_timestamp': '1300000000',
+      'oauth_version': '1.0',
+    }
+    params.update(parameters or {})
+    return oauth1.Request(method=method, url=url, parameters=params,
+                          is_form_encoded=is_form_encoded)
+
+  def assertSameSignature(self, req, token=None):
+    self.assertEqual(self.fast.signing_base(req, self.consumer, token),
+                     self.slow.signing_base(req, self.consumer, token))
+    self.assertEqual(self.fast.sign(req, self.consumer, token),
+                     self.slow.sign(req, self.consumer, token))
+
+  def test_same_as_hmac_sha1(self):
+    requests = [
+      self.make_request('https://api.twitter.com/oauth/request_token',
+                        'POST', {'oauth_callback': 'http://localhost/cb'},
+                        is_form_encoded=True),
+      self.make_request('https://api.twitter.com:443/1.1/users/show.json'
+                        '?screen_name=a+b&x=%7E~&empty=&q=%25%2B'),
+      self.make_request('http://api.linkedin.com/v1/people/~:(id,headline)'),
+      self.make_request(u'https://example.org/päth', 'POST', {
+        'status': u'café & crème +1 100% ~ok',
+        'multi': ['b', 'a', 'a b'],
+        'count': 5,
+        'oauth_signature': 'ignored',
+      }, is_form_encoded=True),
+    ]
+    for req in requests:
+      self.assertSameSignature(req)
+      self.assertSameSignature(req, self.token)
+
+  def test_cached_keys(self):
+    req = self.make_request('https://example.org/')
+    other = oauth1.Token('token_key', 'other secret')
+    for i in range(2):
+      self.assertEqual(self.fast.sign(req, self.consumer, self.token),
+                       self.slow.sign(req, self.consumer, self.token))
+      self.assertEqual(self.fast.sign(req, self.consumer, other),
+                       self.slow.sign(req, self.consumer, other))
+    self.assertEqual(len(self.fast._hmacs), 2)
+
+    self.fast.max_keys = 2
+    self.fast.sign(req, self.consumer, None)
+    self.assertEqual(len(self.fast._hmacs), 1)
+
+  def test_invalid_utf8(self):
+    req = self.make_request('https://example.org/')
+    req['bad'] = '\xff'
+    self.assertRaises(TypeError, self.fast.sign, req, self.consumer, None)
+
+
+if __name__ == '__main__':
+  unittest.main()
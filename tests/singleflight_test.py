@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+import unittest
+from tests import TestMixin
+
+import sys
+import threading
+
+from simpleauth import cache
+from simpleauth import singleflight
+
+
+class SingleFlightTestCase(TestMixin, unittest.TestCase):
+  def setUp(self):
+    super(SingleFlightTestCase, self).setUp()
+    self.group = singleflight.SingleFlight(wait=5)
+    self.calls = []
+    self.release = threading.Event()
+
+  def slow_call(self):
+    self.calls.append(1)
+    self.release.wait(5)
+    return {'id': '123'}
+
+  def test_concurrent_calls(self):
+    results = []
+    def run():
+      results.append(self.group.do('code', self.slow_call))
+    threads = [threading.Thread(target=run) for _ in range(3)]
+    for t in threads:
+      t.start()
+    self.release.set()
+    for t in threads:
+      t.join()
+
+    self.assertEqual(len(self.calls), 1)
+    self.assertEqual(results, [{'id': '123'}] * 3)
+    # each caller has its own copy
+    self.assertEqual(len(set(id(r) for r in results)), 3)
+
+  def test_recent_result(self):
+    self.release.set()
+    # results are only kept while the call is in flight by default
+    self.group.do('code', self.slow_call)
+    self.group.do('code', self.slow_call)
+    self.assertEqual(len(self.calls), 2)
+
+    group = singleflight.SingleFlight(ttl=5)
+    group.do('code', self.slow_call)
+    self.assertEqual(group.do('code', self.slow_call), {'id': '123'})
+    self.assertEqual(len(self.calls), 3)
+    group.do('other', self.slow_call)
+    self.assertEqual(len(self.calls), 4)
+
+  def test_failure(self):
+    flight, leader = self.group.begin('code')
+    self.assertTrue(leader)
+    waiter, leader = self.group.begin('code')
+    self.assertFalse(leader)
+    self.assertIs(waiter, flight)
+    try:
+      raise ValueError('invalid_grant')
+    except ValueError:
+      flight.fail(sys.exc_info())
+
+    self.assertTrue(waiter.wait(0))
+    self.assertRaises(ValueError, waiter.get_result)
+    # failures aren't kept
+    self.assertEqual(self.group.do('code', lambda: 'ok'), 'ok')
+
+  def test_store(self):
+    store = cache.LRUCache()
+    other = singleflight.SingleFlight(store=store, poll_interval=0.01)
+    self.group.store = store
+
+    flight, leader = other.begin('code')
+    self.assertTrue(leader)
+
+    errors = []
+    def run():
+      try:
+        self.group.do('code', self.slow_call)
+      except singleflight.DuplicateCallError as e:
+        errors.append(e)
+    thread = threading.Thread(target=run)
+    thread.start()
+    flight.finish({'access_token': 'a-token'})
+    thread.join()
+
+    self.assertEqual(len(errors), 1)
+    self.assertEqual(self.calls, [])
+    # the result isn't shared through the store
+    self.assertEqual(store.get('singleflight:code'), 'done')
+
+  def test_store_failure(self):
+    store = cache.LRUCache()
+    other = singleflight.SingleFlight(store=store)
+    self.group.store = store
+
+    flight, _ = other.begin('code')
+    try:
+      raise ValueError('invalid_grant')
+    except ValueError:
+      flight.fail(sys.exc_info())
+    self.release.set()
+    self.assertEqual(self.group.do('code', self.slow_call), {'id': '123'})
+    self.assertEqual(len(self.calls), 1)
+
+
+if __name__ == '__main__':
+  unittest.main()
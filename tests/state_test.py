@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+import unittest
+
+import json
+import zlib
+
+from simpleauth import cache
+from simpleauth import state
+
+
+class StateCodecTestCase(unittest.TestCase):
+  STATE = {'csrf': 'a-token', 'extra': [['next', '/profile']]}
+
+  def test_roundtrip(self):
+    codec = state.StateCodec()
+    encoded = codec.encode(self.STATE)
+    self.assertEqual(codec.decode(encoded), self.STATE)
+    # not worth compressing
+    self.assertEqual(codec.encode({'csrf': 'x'}), 'jeyJjc3JmIjoieCJ9')
+
+  def test_compact(self):
+    big = {'csrf': 'a-token', 'extra': [['ids', ','.join(['1234'] * 100)]]}
+    codec = state.StateCodec(max_size=4096)
+    encoded = codec.encode(big)
+    self.assertTrue(encoded.startswith('z'))
+    self.assertTrue(len(encoded) < len(json.dumps(big)) / 4)
+    self.assertEqual(codec.decode(encoded), big)
+
+  def test_plain_json(self):
+    codec = state.StateCodec()
+    self.assertEqual(codec.decode(json.dumps(self.STATE)), self.STATE)
+
+  def test_invalid(self):
+    codec = state.StateCodec()
+    for encoded in ('', 'x123', 'z!!!', 'zaGVsbG8', 'jaGVsbG8', 'rsome-ref',
+                    u'j\xe9t\xe9'):
+      self.assertRaises(ValueError, codec.decode, encoded)
+
+  def test_decompression_limit(self):
+    codec = state.StateCodec()
+    deflate = zlib.compressobj(9, zlib.DEFLATED, -zlib.MAX_WBITS)
+    data = '{"extra":"%s"}' % ('x' * codec.MAX_DECOMPRESSED_SIZE)
+    bomb = 'z' + state._b64encode(deflate.compress(data) + deflate.flush())
+    self.assertTrue(len(bomb) < 512)
+    self.assertRaises(ValueError, codec.decode, bomb)
+
+  def test_spill_to_store(self):
+    store = cache.LRUCache()
+    codec = state.StateCodec(max_size=32, store=store)
+    big = {'extra': [['next', 'x' * 200]]}
+    encoded = codec.encode(big)
+    self.assertTrue(encoded.startswith('r'))
+    self.assertTrue(len(encoded) <= 32)
+    self.assertEqual(len(store), 1)
+
+    self.assertEqual(codec.decode(encoded), big)
+    # used up
+    self.assertRaises(ValueError, codec.decode, encoded)
+
+  def test_over_budget_without_store(self):
+    big = {'extra': [['next', 'x' * 200]]}
+    codec = state.StateCodec(max_size=32)
+    encoded = codec.encode(big)
+    self.assertTrue(len(encoded) > 32)
+    self.assertEqual(codec.decode(encoded), big)
+
+  @unittest.skipIf(state.AES is None, 'PyCrypto is not available')
+  def test_encrypted(self):
+    codec = state.StateCodec(secret='a-secret', encrypt=True)
+    encoded = codec.encode(self.STATE)
+    self.assertTrue(encoded.startswith('e'))
+    self.assertNotIn('a-token', encoded)
+    self.assertEqual(codec.decode(encoded), self.STATE)
+
+    # tampered
+    char = 'A' if encoded[5] != 'A' else 'B'
+    tampered = encoded[:5] + char + encoded[6:]
+    self.assertRaises(ValueError, codec.decode, tampered)
+    # wrong key
+    other = state.StateCodec(secret='other', encrypt=True)
+    self.assertRaises(ValueError, other.decode, encoded)
+    # unencrypted states are refused
+    plain = state.StateCodec().encode(self.STATE)
+    self.assertRaises(ValueError, codec.decode, plain)
+    self.assertRaises(ValueError, codec.decode, json.dumps(self.STATE))
+
+  def test_encrypt_requires_secret(self):
+    self.assertRaises(ValueError, state.StateCodec, encrypt=True)
+
+
+if __name__ == '__main__':
+  unittest.main()
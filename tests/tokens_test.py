@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+import unittest
+from tests import TestMixin
+
+import threading
+import time
+
+from simpleauth import cache
+from simpleauth import tokens
+
+
+class TokenManagerTestCase(TestMixin, unittest.TestCase):
+  def setUp(self):
+    super(TokenManagerTestCase, self).setUp()
+    self.manager = tokens.TokenManager(refresh_ahead=60)
+    self.refreshes = []
+
+  def refresh(self, provider, refresh_token):
+    self.refreshes.append((provider, refresh_token))
+    return {'access_token': 'new-token', 'expires_in': 3600}
+
+  def put_expiring(self, seconds):
+    self.manager.put('123', 'google', {
+      'access_token': 'old-token',
+      'refresh_token': 'a-refresh-token',
+      'expires_in': 3600,
+    })
+    token = self.manager._load(('123', 'google'))
+    token['expires'] = time.time() + seconds
+
+  def test_valid_token(self):
+    self.put_expiring(3600)
+    self.assertEqual(self.manager.get('123', 'google', self.refresh),
+                     'old-token')
+    self.assertEqual(self.manager.get(123, 'google', self.refresh),
+                     'old-token')
+    self.assertEqual(self.refreshes, [])
+
+  def test_unknown_token(self):
+    self.assertIsNone(self.manager.get('123', 'google', self.refresh))
+    self.assertIsNone(self.manager.refresh('123', 'google', self.refresh))
+
+  def test_no_expiry(self):
+    self.manager.put('123', 'facebook', {'access_token': 'a-token'})
+    self.assertEqual(self.manager.get('123', 'facebook', self.refresh),
+                     'a-token')
+
+  def test_expired_token(self):
+    self.put_expiring(-1)
+    self.assertEqual(self.manager.get('123', 'google', self.refresh),
+                     'new-token')
+    self.assertEqual(self.refreshes, [('google', 'a-refresh-token')])
+    # refresh token is kept if the response has none
+    token = self.manager._load(('123', 'google'))
+    self.assertEqual(token['refresh_token'], 'a-refresh-token')
+    self.assertTrue(token['expires'] > time.time() + 3500)
+
+  def test_expired_without_refresh_token(self):
+    self.manager.put('123', 'google', {'access_token': 'a-token',
+                                       'expires_in': -1})
+    self.assertIsNone(self.manager.get('123', 'google', self.refresh))
+    self.assertEqual(self.refreshes, [])
+
+  def test_refresh_failure(self):
+    self.expectWarnings()
+    self.put_expiring(-1)
+    def refresh(provider, refresh_token):
+      raise ValueError('invalid_grant')
+    self.assertIsNone(self.manager.get('123', 'google', refresh))
+
+  def test_refresh_ahead(self):
+    self.put_expiring(30)
+    # refreshed in the calling thread by default
+    self.assertEqual(self.manager.get('123', 'google', self.refresh),
+                     'new-token')
+    self.assertEqual(len(self.refreshes), 1)
+    self.assertEqual(self.manager._refreshing, {})
+
+  def test_refresh_ahead_failure(self):
+    self.expectWarnings()
+    self.put_expiring(30)
+    def refresh(provider, refresh_token):
+      raise ValueError('invalid_grant')
+    # the old token is still valid
+    self.assertEqual(self.manager.get('123', 'google', refresh), 'old-token')
+
+  def test_background_refresh(self):
+    self.manager = tokens.TokenManager(refresh_ahead=60, background=True)
+    self.put_expiring(30)
+    done = threading.Event()
+    def refresh(provider, refresh_token):
+      try:
+        return self.refresh(provider, refresh_token)
+      finally:
+        done.set()
+
+    # the old token is still valid and is returned right away
+    self.assertEqual(self.manager.get('123', 'google', refresh), 'old-token')
+    self.assertTrue(done.wait(5))
+    for _ in range(50):
+      if not self.manager._refreshing:
+        break
+      time.sleep(0.01)
+    self.assertEqual(self.manager.get('123', 'google', refresh), 'new-token')
+    self.assertEqual(len(self.refreshes), 1)
+
+  def test_concurrent_refreshes(self):
+    self.put_expiring(-1)
+    release = threading.Event()
+    def slow_refresh(provider, refresh_token):
+      release.wait(5)
+      return self.refresh(provider, refresh_token)
+
+    results = []
+    def run():
+      results.append(self.manager.get('123', 'google', slow_refresh))
+    threads = [threading.Thread(target=run) for _ in range(3)]
+    for t in threads:
+      t.start()
+    release.set()
+    for t in threads:
+      t.join()
+
+    self.assertEqual(results, ['new-token'] * 3)
+    self.assertEqual(len(self.refreshes), 1)
+
+  def test_refresh_due(self):
+    self.put_expiring(30)
+    self.manager.put('456', 'google', {'access_token': 'a-token',
+                                       'refresh_token': 'other',
+                                       'expires_in': 3600})
+    self.assertEqual(self.manager.refresh_due(self.refresh), 1)
+    self.assertEqual(self.refreshes, [('google', 'a-refresh-token')])
+
+    # due tokens are refreshed once
+    self.assertEqual(self.manager.refresh_due(self.refresh), 0)
+    self.assertEqual(
+      self.manager.refresh_due(self.refresh, keys=[('456', 'google')]), 0)
+
+  def test_store(self):
+    store = cache.LRUCache()
+    self.manager.store = store
+    self.manager.put('123', 'google', {'access_token': 'a-token',
+                                       'refresh_token': 'a-refresh-token',
+                                       'expires_in': 3600})
+    self.assertEqual(len(store), 1)
+
+    # another instance reads tokens from the store
+    other = tokens.TokenManager(store=store)
+    self.assertEqual(other.get('123', 'google', self.refresh), 'a-token')
+    self.assertEqual(
+      other.refresh_due(self.refresh, keys=[('123', 'google')]), 0)
+
+    other.delete('123', 'google')
+    self.assertEqual(len(store), 0)
+    self.assertIsNone(other.get('123', 'google', self.refresh))
+
+
+if __name__ == '__main__':
+  unittest.main()
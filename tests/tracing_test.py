@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+import unittest
+
+import logging
+
+from simpleauth import tracing
+
+
+class RecordingTracer(tracing.Tracer):
+  def __init__(self):
+    self.events = []
+
+  def on_phase_start(self, provider, phase):
+    self.events.append(('start', provider, phase))
+
+  def on_phase_end(self, provider, phase, duration, status=None, error=None):
+    self.events.append(('end', provider, phase, status, error))
+
+  def on_phase_bytes(self, provider, phase, wire_bytes, content_bytes):
+    self.events.append(('bytes', provider, phase, wire_bytes, content_bytes))
+
+
+class StatsdClientMock(object):
+  def __init__(self):
+    self.timings = []
+    self.counters = []
+
+  def timing(self, stat, ms):
+    self.timings.append(stat)
+
+  def incr(self, stat, count=1):
+    self.counters.append(stat if count == 1 else (stat, count))
+
+
+class LogHandlerMock(logging.Handler):
+  def __init__(self):
+    logging.Handler.__init__(self)
+    self.messages = []
+
+  def emit(self, record):
+    self.messages.append(record.getMessage())
+
+
+class TracerTestCase(unittest.TestCase):
+  def test_span(self):
+    tracer = RecordingTracer()
+    with tracer.span('google', 'token') as span:
+      span.status = 200
+    self.assertEqual(tracer.events, [
+      ('start', 'google', 'token'),
+      ('end', 'google', 'token', 200, None)])
+
+  def test_span_bytes(self):
+    tracer = RecordingTracer()
+    with tracer.span('google', 'fetch') as span:
+      span.status = 200
+      span.wire_bytes = 300
+      span.content_bytes = 1000
+    self.assertEqual(tracer.events[1:], [
+      ('bytes', 'google', 'fetch', 300, 1000),
+      ('end', 'google', 'fetch', 200, None)])
+
+  def test_span_error(self):
+    tracer = RecordingTracer()
+    error = ValueError('boom')
+    try:
+      with tracer.span('google', 'parse'):
+        raise error
+    except ValueError:
+      pass
+    self.assertEqual(tracer.events[-1], ('end', 'google', 'parse', None, error))
+
+  def test_null_tracer(self):
+    tracer = tracing.NullTracer()
+    with tracer.span('google', 'token') as span:
+      span.status = 200
+    self.assertIs(tracer.span('twitter', 'init'), span)
+
+  def test_logging_tracer(self):
+    logger = logging.getLogger('tracing_test')
+    handler = LogHandlerMock()
+    logger.addHandler(handler)
+    logger.setLevel(logging.INFO)
+
+    tracer = tracing.LoggingTracer(logger=logger)
+    tracer.on_phase_end('google', 'token', 0.1523, status=200)
+    tracer.on_phase_end('google', 'parse', 0.001, error=ValueError())
+    tracer.on_phase_bytes('google', 'fetch', 312, 1024)
+    self.assertEqual(handler.messages, [
+      'simpleauth google token 152.3ms status=200',
+      'simpleauth google parse 1.0ms error=ValueError',
+      'simpleauth google fetch wire=312B content=1024B'])
+
+  def test_statsd_tracer(self):
+    client = StatsdClientMock()
+    tracer = tracing.StatsdTracer(client, prefix='auth')
+    tracer.on_phase_end('google', 'token', 0.1, status=200)
+    tracer.on_phase_end('google', 'user_info', 0.1, error=ValueError())
+    tracer.on_phase_bytes('google', 'fetch', 312, 1024)
+    self.assertEqual(client.timings, ['auth.google.token',
+                                      'auth.google.user_info'])
+    self.assertEqual(client.counters, ['auth.google.token.status.200',
+                                       'auth.google.user_info.error',
+                                       ('auth.google.fetch.wire_bytes', 312),
+                                       ('auth.google.fetch.content_bytes',
+                                        1024)])
+
+
+if __name__ == '__main__':
+  unittest.main()
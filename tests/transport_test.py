@@ -0,0 +1,309 @@
+# -*- coding: utf-8 -*-
+import unittest
+from tests import TestMixin
+
+import gzip
+import threading
+import time
+import urlparse
+import zlib
+import BaseHTTPServer
+import SocketServer
+from cStringIO import StringIO
+
+import oauth2 as oauth1
+
+from simpleauth import transport
+
+
+#
+# test subjects
+#
+
+def gzipped(content):
+  out = StringIO()
+  f = gzip.GzipFile(fileobj=out, mode='wb')
+  f.write(content)
+  f.close()
+  return out.getvalue()
+
+
+class KeepAliveHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+  protocol_version = 'HTTP/1.1'
+  connections = []
+  posts = []
+
+  def setup(self):
+    BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+    self.connections.append(self.client_address)
+
+  def do_GET(self):
+    if self.path.startswith('/large'):
+      body = 'GET %s %s\n' % (self.path, self.headers.get('Accept-Encoding'))
+      self._respond(body * 10000, self.path == '/large/gzip')
+    else:
+      self._respond('GET ' + self.path)
+    if self.path == '/drop':
+      # like a server dropping an idle keep-alive connection
+      self.close_connection = 1
+
+  def do_POST(self):
+    length = int(self.headers['Content-Length'])
+    body = self.rfile.read(length)
+    self.posts.append(self.path)
+    if self.path == '/slow':
+      time.sleep(0.5)
+    self._respond(body)
+
+  def _respond(self, body, compress=False):
+    self.send_response(200)
+    if compress:
+      body = gzipped(body)
+      self.send_header('Content-Encoding', 'gzip')
+    self.send_header('Content-Length', str(len(body)))
+    self.send_header('X-Dummy', 'dummy')
+    self.end_headers()
+    self.wfile.write(body)
+
+  def log_message(self, *args):
+    pass
+
+
+class ThreadedServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+  daemon_threads = True
+
+
+class TransportMock(transport.Transport):
+  def __init__(self, content=''):
+    self.content = content
+    self.requests = []
+
+  def fetch(self, url, payload=None, method='GET', headers=None):
+    self.requests.append((url, payload, method, headers))
+    return transport.Response(200, self.content)
+
+
+#
+# test suite
+#
+
+class URLFetchTransportTestCase(TestMixin, unittest.TestCase):
+  def test_fetch(self):
+    self.set_urlfetch_response('https://dummy/profile', content='profile',
+                               headers={'X-Dummy': 'dummy'})
+    resp = transport.URLFetchTransport().fetch('https://dummy/profile')
+    self.assertEqual(resp.status_code, 200)
+    self.assertEqual(resp.status, 200)
+    self.assertEqual(resp.content, 'profile')
+    self.assertEqual(resp.headers['x-dummy'], 'dummy')
+
+  def test_fetch_async(self):
+    self.set_urlfetch_response('https://dummy/profile', content='profile')
+    future = transport.URLFetchTransport().fetch_async('https://dummy/profile')
+    self.assertEqual(future.get_result().content, 'profile')
+
+  def test_fetch_post(self):
+    self.set_urlfetch_response('https://dummy/token', content='token',
+                               method='POST')
+    resp = transport.URLFetchTransport().fetch(
+      'https://dummy/token', payload='code=1', method='POST')
+    self.assertEqual(resp.content, 'token')
+
+  def test_fetch_gzip(self):
+    content = '{"id": "123"}' * 100
+    self.set_urlfetch_response('https://dummy/profile',
+                               content=gzipped(content),
+                               headers={'Content-Encoding': 'gzip'})
+    t = transport.URLFetchTransport()
+    resp = t.fetch('https://dummy/profile')
+    self.assertEqual(resp.content, content)
+    self.assertEqual(resp.wire_size, len(gzipped(content)))
+
+    resp = t.fetch_async('https://dummy/profile').get_result()
+    self.assertEqual(resp.content, content)
+    self.assertEqual(t.stats(), {'responses': 2,
+                                 'wire_bytes': 2 * resp.wire_size,
+                                 'content_bytes': 2 * len(content)})
+
+  def test_fetch_deflate(self):
+    content = '{"id": "123"}' * 100
+    # with and without zlib header
+    for body in (zlib.compress(content), zlib.compress(content)[2:-4]):
+      self.set_urlfetch_response('https://dummy/profile', content=body,
+                                 headers={'Content-Encoding': 'deflate'})
+      resp = transport.URLFetchTransport().fetch('https://dummy/profile')
+      self.assertEqual(resp.content, content)
+
+  def test_accept_encoding(self):
+    t = transport.URLFetchTransport()
+    self.assertEqual(t._request_headers(None),
+                     {'Accept-Encoding': 'gzip, deflate'})
+    self.assertEqual(t._request_headers({'accept-encoding': 'identity'}),
+                     {'accept-encoding': 'identity'})
+    t.accept_encoding = None
+    self.assertEqual(t._request_headers({'X-Dummy': '1'}), {'X-Dummy': '1'})
+
+
+class PooledTransportTestCase(unittest.TestCase):
+  def setUp(self):
+    KeepAliveHandler.connections = []
+    KeepAliveHandler.posts = []
+    self.server = ThreadedServer(('127.0.0.1', 0), KeepAliveHandler)
+    self.base_url = 'http://127.0.0.1:%d' % self.server.server_address[1]
+    thread = threading.Thread(target=self.server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    self.transport = transport.PooledTransport()
+
+  def tearDown(self):
+    self.transport.clear()
+    self.server.shutdown()
+    self.server.server_close()
+
+  def test_reuses_connection(self):
+    for i in range(3):
+      resp = self.transport.fetch('%s/me?i=%d' % (self.base_url, i))
+      self.assertEqual(resp.content, 'GET /me?i=%d' % i)
+      self.assertEqual(resp.headers['x-dummy'], 'dummy')
+
+    resp = self.transport.fetch(self.base_url + '/token',
+                                payload='code=1', method='POST')
+    self.assertEqual(resp.status, 200)
+    self.assertEqual(resp.content, 'code=1')
+    self.assertEqual(len(KeepAliveHandler.connections), 1)
+
+  def test_fetch_async(self):
+    futures = [self.transport.fetch_async('%s/me?i=%d' % (self.base_url, i))
+               for i in range(3)]
+    for i, future in enumerate(futures):
+      self.assertEqual(future.get_result().content, 'GET /me?i=%d' % i)
+
+  def test_gzip(self):
+    plain = self.transport.fetch(self.base_url + '/large/plain')
+    resp = self.transport.fetch(self.base_url + '/large/gzip')
+    self.assertEqual(resp.content, plain.content.replace('plain', 'gzip'))
+    self.assertIn('gzip, deflate', resp.content[:100])
+    self.assertLess(resp.wire_size, len(resp.content) // 10)
+    self.assertEqual(len(KeepAliveHandler.connections), 1)
+
+    stats = self.transport.stats()
+    self.assertEqual(stats['responses'], 2)
+    self.assertEqual(stats['wire_bytes'], plain.wire_size + resp.wire_size)
+    self.assertEqual(stats['content_bytes'],
+                     len(plain.content) + len(resp.content))
+
+  def test_deadline(self):
+    self.transport.timeout = 30
+    self.transport.fetch(self.base_url + '/me', deadline=2.5)
+    conn = self.transport._pool[('http', self.base_url[7:])][0][0]
+    self.assertEqual(conn.sock.gettimeout(), 2.5)
+
+    # reused connection, deadline longer than transport timeout
+    self.transport.fetch(self.base_url + '/me', deadline=60)
+    self.assertIs(self.transport._pool[('http', self.base_url[7:])][0][0],
+                  conn)
+    self.assertEqual(conn.sock.gettimeout(), 30)
+
+  def test_resends_get_on_dropped_connection(self):
+    self.transport.fetch(self.base_url + '/drop')
+    resp = self.transport.fetch(self.base_url + '/me')
+    self.assertEqual(resp.content, 'GET /me')
+    self.assertEqual(len(KeepAliveHandler.connections), 2)
+
+  def test_post_after_dropped_connection(self):
+    self.transport.fetch(self.base_url + '/drop')
+    # let the server close it
+    time.sleep(0.05)
+    resp = self.transport.fetch(self.base_url + '/token',
+                                payload='code=1', method='POST')
+    self.assertEqual(resp.content, 'code=1')
+    self.assertEqual(len(KeepAliveHandler.connections), 2)
+
+  def test_no_post_resend_on_dropped_connection(self):
+    self.transport.fetch(self.base_url + '/drop')
+    time.sleep(0.05)
+    # the server closes the connection just as it's reused
+    closed = transport._closed
+    transport._closed = lambda conn: False
+    try:
+      self.assertRaises(transport.TransportError,
+                        self.transport.fetch, self.base_url + '/token',
+                        payload='code=1', method='POST')
+    finally:
+      transport._closed = closed
+    self.assertEqual(KeepAliveHandler.posts, [])
+    self.assertEqual(len(KeepAliveHandler.connections), 1)
+
+  def test_max_idle_time(self):
+    self.transport.max_idle_time = 0.01
+    self.transport.fetch(self.base_url + '/me')
+    time.sleep(0.02)
+    self.transport.fetch(self.base_url + '/me')
+    self.assertEqual(len(KeepAliveHandler.connections), 2)
+
+  def test_no_post_resend_on_timeout(self):
+    self.transport.fetch(self.base_url + '/me')
+    self.assertRaises(transport.TransportError, self.transport.fetch,
+                      self.base_url + '/slow', payload='code=1',
+                      method='POST', deadline=0.1)
+    time.sleep(0.6)
+    self.assertEqual(KeepAliveHandler.posts, ['/slow'])
+    self.assertEqual(len(KeepAliveHandler.connections), 1)
+
+  def test_reconnects_after_clear(self):
+    self.transport.fetch(self.base_url + '/me')
+    self.transport.clear()
+    resp = self.transport.fetch(self.base_url + '/me')
+    self.assertEqual(resp.content, 'GET /me')
+    self.assertEqual(len(KeepAliveHandler.connections), 2)
+
+
+class OAuth1ClientTestCase(unittest.TestCase):
+  def setUp(self):
+    self.consumer = oauth1.Consumer('cons_key', 'cons_secret')
+    self.token = oauth1.Token('token_key', 'token_secret')
+
+  def test_signed_get(self):
+    mock = TransportMock(content='{}')
+    client = transport.OAuth1Client(self.consumer, self.token, mock)
+    resp, content = client.request('https://dummy/me')
+
+    self.assertEqual(resp.status, 200)
+    self.assertEqual(content, '{}')
+    url, payload, method, headers = mock.requests[0]
+    self.assertEqual(method, 'GET')
+    self.assertIsNone(payload)
+    params = urlparse.parse_qs(urlparse.urlsplit(url).query)
+    self.assertEqual(params['oauth_consumer_key'], ['cons_key'])
+    self.assertEqual(params['oauth_token'], ['token_key'])
+    self.assertIn('oauth_signature', params)
+
+  def test_signed_post(self):
+    mock = TransportMock()
+    client = transport.OAuth1Client(self.consumer, transport=mock)
+    client.request('https://dummy/rtoken', 'POST', 'oauth_callback=/cb')
+
+    url, payload, method, headers = mock.requests[0]
+    self.assertEqual(url, 'https://dummy/rtoken')
+    self.assertEqual(headers['Content-Type'], transport.FORM_CONTENT_TYPE)
+    params = urlparse.parse_qs(payload)
+    self.assertEqual(params['oauth_callback'], ['/cb'])
+    self.assertIn('oauth_signature', params)
+    self.assertNotIn('oauth_token', params)
+
+  def test_per_request_token(self):
+    mock = TransportMock()
+    client = transport.OAuth1Client(self.consumer, transport=mock)
+    other = oauth1.Token('other_key', 'other_secret')
+    client.request('https://dummy/me', token=self.token)
+    client.request('https://dummy/me', token=other)
+    client.request('https://dummy/me')
+
+    tokens = [urlparse.parse_qs(urlparse.urlsplit(r[0]).query).get(
+              'oauth_token') for r in mock.requests]
+    self.assertEqual(tokens, [['token_key'], ['other_key'], None])
+    self.assertIsNone(client.token)
+
+
+if __name__ == '__main__':
+  unittest.main()